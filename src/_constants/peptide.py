@@ -1,72 +1,83 @@
-import numpy as np
-import utils
-import blosum as bl
-
-ALPHABET = np.fromiter("ARNDCQEGHILKMFPSTWYV", dtype="U1")
-
-bl45 = bl.BLOSUM(45)
-
-def calc_unsim_matrix() -> list[list[float]]:
-    unsimilarity_matrix = []
-    for key_i in bl45.keys():
-        if key_i in ALPHABET:
-            matrix_row = []
-            min_similarity = 0.0
-            max_similarity = 0.0
-            for key_j in bl45.keys():
-                if key_j in ALPHABET:
-                    if bl45[key_i][key_j] < min_similarity:
-                        min_similarity = bl45[key_i][key_j]
-                    if bl45[key_i][key_j] > max_similarity:
-                        max_similarity = bl45[key_i][key_j]
-            for key_j in bl45.keys():
-                if key_j in ALPHABET:
-                    if key_i == key_j:
-                        matrix_row.append(0.0)
-                    else:
-                        matrix_row.append((bl45[key_i][key_j] - max_similarity) / (min_similarity - max_similarity))
-            unsimilarity_matrix.append(matrix_row)
-    return unsimilarity_matrix
-
-UNSIMILARITY_MATRIX = np.array(calc_unsim_matrix(), dtype = float)
-
-# https://en.wikipedia.org/wiki/FASTA_format#Sequence_representation
-CHARACTER_VECTORS = {
-    'A' : utils.normalize(np.array([1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'R' : utils.normalize(np.array([0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'N' : utils.normalize(np.array([0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'D' : utils.normalize(np.array([0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'C' : utils.normalize(np.array([0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'Q' : utils.normalize(np.array([0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'E' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'G' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'H' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'I' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'L' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'K' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'M' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0])),
-    'F' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0])),
-    'P' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0])),
-    'S' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0])),
-    'T' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0])),
-    'W' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0])),
-    'Y' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0])),
-    'V' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1])),
-    'B' : utils.normalize(np.array([0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'J' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'Z' : utils.normalize(np.array([0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
-    'X' : utils.normalize(np.array([1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])),
-    # Note: it doesn't matter what the vectors of the gap positions are
-    # because when we do distance calculations, we never weight them
-    '-' : utils.normalize(np.array([1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])),
-    '.' : utils.normalize(np.array([1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])),
-    '*' : utils.normalize(np.array([1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]))
-}
-
-def CORRECTION(raw_dist: float) -> float:
-    if raw_dist >= 1:
-        return float("inf")
-    return -1.3 * np.log(1 - raw_dist)
-
-def IS_GAP(c : str) -> bool:
-    return c in ['-', '.', '*']
+import numpy as np
+import utils
+
+ALPHABET = np.fromiter("ARNDCQEGHILKMFPSTWYV", dtype="U1")
+
+# BLOSUM45 restricted to ALPHABET (in that order), as given by blosum.BLOSUM(45). It is shipped
+# as a table so that the blosum package does not have to be imported at startup.
+BLOSUM45 = np.array([
+    #  A   R   N   D   C   Q   E   G   H   I   L   K   M   F   P   S   T   W   Y   V
+    [ 5, -2, -1, -2, -1, -1, -1,  0, -2, -1, -1, -1, -1, -2, -1,  1,  0, -2, -2,  0],  # A
+    [-2,  7,  0, -1, -3,  1,  0, -2,  0, -3, -2,  3, -1, -2, -2, -1, -1, -2, -1, -2],  # R
+    [-1,  0,  6,  2, -2,  0,  0,  0,  1, -2, -3,  0, -2, -2, -2,  1,  0, -4, -2, -3],  # N
+    [-2, -1,  2,  7, -3,  0,  2, -1,  0, -4, -3,  0, -3, -4, -1,  0, -1, -4, -2, -3],  # D
+    [-1, -3, -2, -3, 12, -3, -3, -3, -3, -3, -2, -3, -2, -2, -4, -1, -1, -5, -3, -1],  # C
+    [-1,  1,  0,  0, -3,  6,  2, -2,  1, -2, -2,  1,  0, -4, -1,  0, -1, -2, -1, -3],  # Q
+    [-1,  0,  0,  2, -3,  2,  6, -2,  0, -3, -2,  1, -2, -3,  0,  0, -1, -3, -2, -3],  # E
+    [ 0, -2,  0, -1, -3, -2, -2,  7, -2, -4, -3, -2, -2, -3, -2,  0, -2, -2, -3, -3],  # G
+    [-2,  0,  1,  0, -3,  1,  0, -2, 10, -3, -2, -1,  0, -2, -2, -1, -2, -3,  2, -3],  # H
+    [-1, -3, -2, -4, -3, -2, -3, -4, -3,  5,  2, -3,  2,  0, -2, -2, -1, -2,  0,  3],  # I
+    [-1, -2, -3, -3, -2, -2, -2, -3, -2,  2,  5, -3,  2,  1, -3, -3, -1, -2,  0,  1],  # L
+    [-1,  3,  0,  0, -3,  1,  1, -2, -1, -3, -3,  5, -1, -3, -1, -1, -1, -2, -1, -2],  # K
+    [-1, -1, -2, -3, -2,  0, -2, -2,  0,  2,  2, -1,  6,  0, -2, -2, -1, -2,  0,  1],  # M
+    [-2, -2, -2, -4, -2, -4, -3, -3, -2,  0,  1, -3,  0,  8, -3, -2, -1,  1,  3,  0],  # F
+    [-1, -2, -2, -1, -4, -1,  0, -2, -2, -2, -3, -1, -2, -3,  9, -1, -1, -3, -3, -3],  # P
+    [ 1, -1,  1,  0, -1,  0,  0,  0, -1, -2, -3, -1, -2, -2, -1,  4,  2, -4, -2, -1],  # S
+    [ 0, -1,  0, -1, -1, -1, -1, -2, -2, -1, -1, -1, -1, -1, -1,  2,  5, -3, -1,  0],  # T
+    [-2, -2, -4, -4, -5, -2, -3, -2, -3, -2, -2, -2, -2,  1, -3, -4, -3, 15,  3, -3],  # W
+    [-2, -1, -2, -2, -3, -1, -2, -3,  2,  0,  0, -1,  0,  3, -3, -2, -1,  3,  8, -1],  # Y
+    [ 0, -2, -3, -3, -1, -3, -3, -3, -3,  3,  1, -2,  1,  0, -3, -1,  0, -3, -1,  5],  # V
+], dtype=int)
+
+def calc_unsim_matrix() -> np.typing.NDArray:
+    """Rescales each row of BLOSUM45 so that the most similar pair (or 0) maps to 0 and the least
+    similar pair (or 0) maps to 1, with zeros on the diagonal.
+    """
+    min_similarity = np.minimum(BLOSUM45.min(axis=1), 0)[:, None]
+    max_similarity = np.maximum(BLOSUM45.max(axis=1), 0)[:, None]
+    unsimilarity_matrix = (BLOSUM45 - max_similarity) / (min_similarity - max_similarity)
+    np.fill_diagonal(unsimilarity_matrix, 0.0)
+    return unsimilarity_matrix
+
+UNSIMILARITY_MATRIX = calc_unsim_matrix()
+
+# https://en.wikipedia.org/wiki/FASTA_format#Sequence_representation
+CHARACTER_VECTORS = {
+    'A' : utils.normalize(np.array([1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'R' : utils.normalize(np.array([0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'N' : utils.normalize(np.array([0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'D' : utils.normalize(np.array([0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'C' : utils.normalize(np.array([0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'Q' : utils.normalize(np.array([0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'E' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'G' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'H' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'I' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'L' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'K' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'M' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0])),
+    'F' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0])),
+    'P' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0])),
+    'S' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0])),
+    'T' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0])),
+    'W' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0])),
+    'Y' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0])),
+    'V' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1])),
+    'B' : utils.normalize(np.array([0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'J' : utils.normalize(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'Z' : utils.normalize(np.array([0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])),
+    'X' : utils.normalize(np.array([1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])),
+    # Note: it doesn't matter what the vectors of the gap positions are
+    # because when we do distance calculations, we never weight them
+    '-' : utils.normalize(np.array([1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])),
+    '.' : utils.normalize(np.array([1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])),
+    '*' : utils.normalize(np.array([1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]))
+}
+
+def CORRECTION(raw_dist: float) -> float:
+    if raw_dist >= 1:
+        return float("inf")
+    return -1.3 * np.log(1 - raw_dist)
+
+def IS_GAP(c : str) -> bool:
+    return c in ['-', '.', '*']
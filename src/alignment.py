@@ -1,6 +1,13 @@
-from typing import Dict
+import copy
+import numpy as np
+import sys
 
-from profile import Profile
+from numpy.typing import NDArray
+from typing import Dict, List, Optional, Tuple
+
+import constants
+from profile import (SPARSE_GAP_FRACTION, AnyProfile, SparseProfile, _encode_aligned_sequence,
+                     profile_from_aligned_sequence)
 
 class Alignment:
     """
@@ -10,13 +17,41 @@ class Alignment:
         alignment (Dict[str, str]): a dictionary with the multiple alignment;
             the labels of the sequences are the keys, the sequences are the values
         alignment_size (int): how many sequences are aligned
+        unique_alignment_size (int): how many distinct sequences are aligned if duplicates were
+            collapsed, otherwise the same as alignment_size
+        duplicates (Dict[str, List[str]]): for each label kept in profile_dict, the labels of
+            the sequences identical to it that were collapsed into it
         alignment_length (int): the length of the aligned sequences
-        profile_dict (Dict[str, Profile]): a dictionary with the profile for each sequence
+        profile_length (int): the length of the profiles, which is smaller than alignment_length
+            if the columns were compressed
+        column_weights (Optional[NDArray[float]]): the number of alignment columns represented by
+            each profile column, or None if the columns were not compressed
+        column_map (NDArray[int]): the profile column representing each alignment column, or -1
+            for dropped columns
+        profile_dict (Dict[str, Union[Profile, SparseProfile]]): a dictionary with the profile for
+            each sequence; sequences with more than sparse_gap_fraction gapped columns are stored
+            as SparseProfiles
+        leaf_codes (Optional[NDArray[np.uint8]]): the character codes of the sequence of each
+            profile in profile_dict, over the profile columns (unique_alignment_size x
+            profile_length), or None if the profiles do not all come from single sequences
     """
-    def __init__(self, alignment: Dict[str, str]):
+    def __init__(self,
+                 alignment: Dict[str, str],
+                 sparse_gap_fraction: Optional[float] = SPARSE_GAP_FRACTION,
+                 compress_columns: bool = False,
+                 collapse_duplicates: bool = False):
         """
         The input is given as a dictionary with the labels as the keys and
-        the sequences as the values.
+        the sequences as the values. Setting sparse_gap_fraction to None disables
+        sparse profiles.
+
+        If compress_columns is set, columns that are gapped in every sequence are
+        dropped and columns with identical site patterns are collapsed into a single
+        profile column weighted by its multiplicity. Profile distances are unchanged.
+
+        If collapse_duplicates is set, only the first of each group of identical
+        sequences gets a profile; the others are recorded in duplicates so that they
+        can be re-attached to the finished tree (see utils.expand_duplicates).
         """
         if not alignment:
             raise ValueError("Alignment must be initialized with at least one sequence.")
@@ -29,7 +64,26 @@ class Alignment:
         if not all(len(seq) == self._alignment_length for seq in alignment.values()):
             raise ValueError("Sequences in alignment do not all have the same length.")
 
-        self._profile_dict = {label: Profile.from_aligned_sequence(seq) for label, seq in alignment.items()}
+        if collapse_duplicates:
+            profile_sequences, self._duplicates = _collapse_duplicates(alignment)
+        else:
+            profile_sequences, self._duplicates = alignment, dict()
+        self._unique_alignment_size = len(profile_sequences)
+
+        if compress_columns:
+            profile_sequences, self._column_weights, self._column_map = \
+                _compress_columns(profile_sequences)
+        else:
+            self._column_weights = None
+            self._column_map = np.arange(self._alignment_length)
+        self._profile_length = len(next(iter(profile_sequences.values())))
+
+        self._profile_dict = {
+            label: profile_from_aligned_sequence(seq, sparse_gap_fraction, self._column_weights)
+                for label, seq in profile_sequences.items()
+        }
+        self._leaf_codes = np.stack([_encode_aligned_sequence(seq)
+                                     for seq in profile_sequences.values()])
 
     @property
     def alignment(self): return self._alignment
@@ -37,8 +91,184 @@ class Alignment:
     @property
     def alignment_size(self): return self._alignment_size
 
+    @property
+    def unique_alignment_size(self): return self._unique_alignment_size
+
+    @property
+    def duplicates(self): return self._duplicates
+
     @property
     def alignment_length(self): return self._alignment_length
 
+    @property
+    def profile_length(self): return self._profile_length
+
+    @property
+    def column_weights(self): return self._column_weights
+
+    @property
+    def column_map(self): return self._column_map
+
     @property
     def profile_dict(self): return self._profile_dict
+
+    @property
+    def leaf_codes(self): return self._leaf_codes
+
+    @property
+    def profile_nbytes(self) -> int:
+        """The number of bytes held by the arrays of the leaf profiles and the leaf codes."""
+        memory_usage = self.memory_usage()
+        return memory_usage["leaf profiles"] + memory_usage["leaf codes"]
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Returns the number of bytes held by the sequences, the leaf profiles and the leaf
+        codes of the alignment (see memory_report.MemoryReport).
+        """
+        return {
+            "sequences": sum(sys.getsizeof(seq) for seq in self._alignment.values()),
+            "leaf profiles": sum(p.profile.nbytes + p.ungapped.nbytes
+                                 + (p.columns.nbytes if isinstance(p, SparseProfile) else 0)
+                                 for p in self._profile_dict.values()),
+            "leaf codes": self._leaf_codes.nbytes if self._leaf_codes is not None else 0,
+        }
+
+    def reweighted(self, column_weights: NDArray[float]) -> "Alignment":
+        """Returns a copy of this alignment whose profile columns are weighted by column_weights
+        instead of their multiplicities, e.g. for a bootstrap replicate. The profile matrices are
+        shared with this alignment, not copied.
+        """
+        if len(column_weights) != self._profile_length:
+            raise ValueError("Column weights must have one entry per profile column.")
+        reweighted = copy.copy(self)
+        reweighted._column_weights = column_weights
+        reweighted._profile_dict = {label: profile.with_column_weights(column_weights)
+                                    for label, profile in self._profile_dict.items()}
+        return reweighted
+
+    def subset(self, labels: List[str]) -> "Alignment":
+        """Returns a copy of this alignment restricted to the given labels of profile_dict,
+        together with their duplicates. The profiles are shared with this alignment, not copied.
+        """
+        restricted = self.with_profiles({label: self._profile_dict[label] for label in labels},
+                                        {label: self._duplicates[label] for label in labels
+                                         if label in self._duplicates})
+        if self._leaf_codes is not None:
+            index = {label: i for i, label in enumerate(self._profile_dict)}
+            restricted._leaf_codes = self._leaf_codes[[index[label] for label in labels]]
+        return restricted
+
+    def with_profiles(self,
+                      profile_dict: Dict[str, AnyProfile],
+                      duplicates: Optional[Dict[str, List[str]]] = None) -> "Alignment":
+        """Returns a copy of this alignment whose leaves are the given profiles, e.g. profiles
+        that summarize whole subtrees. The profiles must have the columns (and column weights)
+        of this alignment. The copy has no leaf_codes.
+        """
+        if not profile_dict:
+            raise ValueError("Alignment must be initialized with at least one sequence.")
+        duplicates = duplicates if duplicates is not None else dict()
+        restricted = copy.copy(self)
+        restricted._profile_dict = profile_dict
+        restricted._duplicates = duplicates
+        restricted._leaf_codes = None
+        restricted._unique_alignment_size = len(profile_dict)
+        restricted._alignment_size = (len(profile_dict)
+                                      + sum(len(labels) for labels in duplicates.values()))
+        all_labels = list(profile_dict) + [label for labels in duplicates.values()
+                                           for label in labels]
+        restricted._alignment = {label: self._alignment[label]
+                                 for label in all_labels if label in self._alignment}
+        return restricted
+
+
+def save_encoded_alignment(path: str, labels: List[str], codes: NDArray[np.uint8]):
+    """Saves an alignment in encoded binary form: the labels and the (num_sequences x
+    alignment_length) matrix of the character codes of the sequences, as an .npz file.
+    """
+    np.savez(path, labels=np.array(labels, dtype=str), codes=codes)
+
+def load_encoded_alignment(path: str) -> Dict[str, str]:
+    """Loads an alignment saved by save_encoded_alignment into a dictionary from labels to
+    sequences.
+    """
+    with np.load(path) as encoded:
+        return {str(label): row.tobytes().decode("ascii")
+                for label, row in zip(encoded["labels"], encoded["codes"])}
+
+def read_alignment(path: str) -> Dict[str, str]:
+    """Reads an alignment from a FASTA file, or from an encoded binary (.npz) alignment."""
+    if path.endswith(".npz"):
+        return load_encoded_alignment(path)
+    with open(path) as f:
+        return parse_fasta(f.read())
+
+def parse_fasta(fasta_text: str) -> Dict[str, str]:
+    """Parses a FASTA file with one line per sequence into a dictionary from labels (the first
+    word of each header) to sequences.
+    """
+    fasta_data = fasta_text.strip().split('\n')
+
+    alignment_dict = dict()
+    for label_line, seq in zip(fasta_data[::2], fasta_data[1::2]):
+        label = label_line[1:].split(' ', 1)[0]
+        alignment_dict[label] = seq
+    return alignment_dict
+
+
+def _collapse_duplicates(alignment: Dict[str, str]) -> Tuple[Dict[str, str], Dict[str, List[str]]]:
+    """Keeps the first occurrence of every distinct sequence of an alignment.
+
+    Returns:
+        A Tuple of the alignment restricted to the kept sequences and a dictionary
+            mapping each kept label with duplicates to the labels of its duplicates.
+    """
+    first_label = dict()
+    unique_alignment = dict()
+    duplicates = dict()
+    for label, seq in alignment.items():
+        if seq in first_label:
+            duplicates.setdefault(first_label[seq], []).append(label)
+        else:
+            first_label[seq] = label
+            unique_alignment[label] = seq
+    return unique_alignment, duplicates
+
+
+def _compress_columns(alignment: Dict[str, str]) -> Tuple[Dict[str, str], NDArray[float], NDArray[int]]:
+    """Collapses identical columns of an alignment and drops all-gap columns.
+
+    Returns:
+        A Tuple of the compressed alignment (with columns in order of first occurrence),
+            the multiplicity of each of its columns and the compressed column representing
+            each original column (-1 for dropped columns).
+    """
+    labels = list(alignment.keys())
+    char_matrix = np.array([np.frombuffer(alignment[label].encode("ascii"), dtype=np.uint8)
+                            for label in labels])
+
+    # All gap characters are equivalent in profiles, so they are mapped to one byte
+    # before comparing columns.
+    gap_chars = [c for c in np.unique(char_matrix) if constants.IS_GAP(chr(c))]
+    is_gap = np.isin(char_matrix, gap_chars)
+    if gap_chars:
+        char_matrix = np.where(is_gap, gap_chars[0], char_matrix).astype(np.uint8)
+
+    kept_columns = np.flatnonzero(~np.all(is_gap, axis=0))
+    if kept_columns.size == 0:
+        raise ValueError("Alignment has no columns with non-gap characters.")
+    _, first_index, inverse, counts = np.unique(char_matrix[:, kept_columns].T, axis=0,
+                                                return_index=True, return_inverse=True,
+                                                return_counts=True)
+    order = np.argsort(first_index)
+    pattern_columns = kept_columns[first_index[order]]
+
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    column_map = np.full(char_matrix.shape[1], -1, dtype=int)
+    column_map[kept_columns] = rank[inverse.ravel()]
+
+    compressed = char_matrix[:, pattern_columns]
+    compressed_alignment = {label: compressed[i].tobytes().decode("ascii")
+                            for i, label in enumerate(labels)}
+    return compressed_alignment, counts[order].astype(float), column_map
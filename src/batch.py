@@ -0,0 +1,193 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+
+import newick
+
+from alignment import read_alignment
+from main import add_build_arguments, build_tree, unsupported_with_clusters
+from memory_report import peak_memory_mb, reset_peak_memory
+from server import _init_worker as _init_server_worker
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+# Extensions of the alignment files picked up from an input directory.
+ALIGNMENT_EXTENSIONS = (".fa", ".fasta", ".fas", ".fna", ".faa", ".npz")
+
+# Columns of the summary file, in order.
+SUMMARY_FIELDS = ["input_file", "output_file", "status", "num_sequences", "alignment_length",
+                  "time", "peak_memory_mb", "worker"]
+
+def list_jobs(input_path: str, output_dir: str) -> List[Tuple[str, str]]:
+    """Lists the (input_file, output_file) pairs of a batch.
+
+    Args:
+
+        input_path (str): Either a directory, whose alignment files (see ALIGNMENT_EXTENSIONS)
+            are all built, or a manifest with one alignment path per line, optionally followed
+            by a tab and the output path. Relative paths in a manifest are relative to the
+            manifest. Blank lines and lines starting with "#" are ignored.
+
+        output_dir (str): The directory of the trees whose output path is not given; the tree
+            of an alignment is written to <output_dir>/<alignment name without extension>.nwk.
+
+    Returns:
+        List[Tuple[str, str]]: The input and output paths of each job.
+
+    Raises:
+        ValueError: Raised if two jobs would write the same output file.
+    """
+    def default_output(input_file: str) -> str:
+        name = os.path.splitext(os.path.basename(input_file))[0]
+        return os.path.join(output_dir, f"{name}.nwk")
+
+    jobs = []
+    if os.path.isdir(input_path):
+        for name in sorted(os.listdir(input_path)):
+            if name.lower().endswith(ALIGNMENT_EXTENSIONS):
+                input_file = os.path.join(input_path, name)
+                jobs.append((input_file, default_output(input_file)))
+    else:
+        base_dir = os.path.dirname(os.path.abspath(input_path))
+        with open(input_path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                input_file, _, output_file = line.partition("\t")
+                input_file = os.path.join(base_dir, input_file.strip())
+                output_file = (os.path.join(base_dir, output_file.strip()) if output_file.strip()
+                               else default_output(input_file))
+                jobs.append((input_file, output_file))
+
+    output_files = [output_file for _, output_file in jobs]
+    if len(set(output_files)) != len(output_files):
+        raise ValueError("Several alignments of the batch would write the same output file.")
+    return jobs
+
+def _init_worker():
+    _init_server_worker()
+    sys.setrecursionlimit(10_000)
+
+def run_batch_job(input_file: str, output_file: str, args: argparse.Namespace) -> Dict:
+    """Builds the tree of one alignment of a batch and writes it to output_file.
+
+    Returns:
+        Dict: The summary of the job (see SUMMARY_FIELDS). A failed job has the error as its
+            status instead of "ok".
+    """
+    reset_peak_memory()
+    summary = dict(input_file=input_file, output_file=output_file, worker=os.getpid(),
+                   num_sequences=None, alignment_length=None)
+    time_elapsed = time.perf_counter()
+    try:
+        alignment_dict = read_alignment(input_file)
+        summary["num_sequences"] = len(alignment_dict)
+        summary["alignment_length"] = len(next(iter(alignment_dict.values()), ""))
+        tree = build_tree(alignment_dict, args)
+        os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+        with open(output_file, "w") as f:
+            newick.dump(tree, f)
+        summary["status"] = "ok"
+    except Exception as e:
+        summary["status"] = f"error: {e!r}"
+    summary["time"] = time.perf_counter() - time_elapsed
+    summary["peak_memory_mb"] = peak_memory_mb()
+    return summary
+
+def run_batch(jobs: List[Tuple[str, str]],
+              args: argparse.Namespace,
+              num_jobs: Optional[int] = None) -> List[Dict]:
+    """Builds the trees of many alignments on a pool of warm worker processes.
+
+    Each worker loads the modules and alphabet tables once and then builds trees one after the
+    other. Jobs are submitted largest file first, so that the largest alignments do not end up
+    running alone at the end of the batch.
+
+    Args:
+
+        jobs (List[Tuple[str, str]]): The input and output paths of each job (see list_jobs).
+
+        args (argparse.Namespace): The build options of every job (see
+            main.add_build_arguments).
+
+        num_jobs (Optional[int]): The number of worker processes. Defaults to the number of
+            CPUs.
+
+    Returns:
+        List[Dict]: The summary of each job (see run_batch_job), in the order of jobs.
+    """
+    def file_size(path: str) -> int:
+        # Unreadable inputs are left for run_batch_job to report as failed jobs.
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    order = sorted(range(len(jobs)), key=lambda k: -file_size(jobs[k][0]))
+    summaries = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers=num_jobs, initializer=_init_worker) as executor:
+        futures = {executor.submit(run_batch_job, *jobs[k], args): k for k in order}
+        for num_done, future in enumerate(as_completed(futures), start=1):
+            summary = future.result()
+            summaries[futures[future]] = summary
+            logger.info(f"[{num_done}/{len(jobs)}] {summary['input_file']}: {summary['status']} "
+                        f"in {summary['time']:.3f} s, {summary['peak_memory_mb']:.1f} MiB")
+    return summaries
+
+def write_summary(path: str, summaries: List[Dict]):
+    """Writes the job summaries as a tab-separated file with a header line."""
+    with open(path, "w") as f:
+        f.write("\t".join(SUMMARY_FIELDS) + "\n")
+        for summary in summaries:
+            f.write("\t".join("" if summary[field] is None
+                              else f"{summary[field]:.3f}" if isinstance(summary[field], float)
+                              else str(summary[field])
+                              for field in SUMMARY_FIELDS) + "\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds the trees of many alignments")
+    add_build_arguments(parser)
+    parser.add_argument("--jobs",
+                        type=int,
+                        help="the number of alignments built in parallel (default: number of "
+                        "CPUs)")
+    parser.add_argument("--summary",
+                        type=str,
+                        help="the file to write the per-job summary to (default: "
+                        "<output_dir>/summary.tsv)")
+    parser.add_argument("input",
+                        type=str,
+                        help="a directory of alignments, or a manifest listing one alignment "
+                        "per line (optionally followed by a tab and its output file)")
+    parser.add_argument("output_dir",
+                        type=str,
+                        help="the directory to write the trees to")
+    args = parser.parse_args()
+    unsupported = unsupported_with_clusters(args)
+    if unsupported:
+        parser.error(f"--clusters cannot be combined with {', '.join(unsupported)}")
+
+    jobs = list_jobs(args.input, args.output_dir)
+    logger.info(f"Building {len(jobs)} trees")
+    os.makedirs(args.output_dir, exist_ok=True)
+    time_elapsed = time.perf_counter()
+    summaries = run_batch(jobs, args, args.jobs)
+    time_elapsed = time.perf_counter() - time_elapsed
+
+    summary_file = args.summary or os.path.join(args.output_dir, "summary.tsv")
+    write_summary(summary_file, summaries)
+    num_failed = sum(summary["status"] != "ok" for summary in summaries)
+    logger.info(f"Built {len(jobs) - num_failed} of {len(jobs)} trees in {time_elapsed:.3f} s "
+                f"(summary: {summary_file})")
+    if num_failed:
+        sys.exit(f"{num_failed} jobs failed")
+
+if __name__ == "__main__":
+    main()
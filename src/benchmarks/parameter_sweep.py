@@ -0,0 +1,254 @@
+import argparse
+import csv
+import itertools
+import json
+import logging
+import multiprocessing
+import random
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from math import isqrt
+from typing import Dict, List, Optional, Tuple
+
+import newick
+
+import constants
+from alignment import Alignment, read_alignment
+from bootstrap import tree_splits
+from memory_report import current_memory_mb, peak_memory_mb, reset_peak_memory
+from tree_builder import TreeBuilder
+from benchmarks.neighbor_joining import neighbor_joining
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+NUCLEOTIDES = "ACGT"
+
+# Columns of the CSV output, in order.
+FIELDS = ["thresh_cp", "refresh_factor", "refresh_interval", "enable_tophits_approx",
+          "time", "distances", "peak_memory_mb", "rf", "pareto"]
+
+# The alignment swept over, inherited by the forked worker processes.
+_sweep_alignment: Optional[Alignment] = None
+
+def simulate_alignment(num_sequences: int,
+                       length: int,
+                       seed: Optional[int] = None,
+                       min_rate: float = 0.005,
+                       max_rate: float = 0.03) -> Tuple[Dict[str, str], newick.Node]:
+    """Simulates an alignment of nucleotide sequences along a random tree.
+
+    Starting from a random root sequence, a random lineage is split into two until there are
+    num_sequences lineages. Each new branch substitutes every site with probability drawn
+    uniformly from [min_rate, max_rate] (a substitution may keep the nucleotide).
+
+    Returns:
+        Tuple[Dict[str, str], newick.Node]: The alignment, and the true tree with the
+            substitution probabilities as branch lengths.
+    """
+    rng = random.Random(seed)
+    root = newick.Node()
+    lineages = [(root, [rng.choice(NUCLEOTIDES) for _ in range(length)])]
+    while len(lineages) < num_sequences:
+        node, seq = lineages.pop(rng.randrange(len(lineages)))
+        for _ in range(2):
+            rate = rng.uniform(min_rate, max_rate)
+            child = newick.Node(length=rate)
+            node.add_descendant(child)
+            lineages.append((child, [rng.choice(NUCLEOTIDES) if rng.random() < rate else c
+                                     for c in seq]))
+
+    alignment_dict = dict()
+    for i, (node, seq) in enumerate(lineages):
+        node.name = f"t{i}"
+        alignment_dict[node.name] = "".join(seq)
+    return alignment_dict, root
+
+def robinson_foulds(tree: newick.Node, reference: newick.Node) -> float:
+    """Returns the Robinson-Foulds distance between two trees on the same leaves, normalized by
+    the total number of non-trivial splits of both trees (0 for identical topologies).
+    """
+    splits, reference_splits = tree_splits(tree), tree_splits(reference)
+    if not splits and not reference_splits:
+        return 0.
+    return len(splits ^ reference_splits) / (len(splits) + len(reference_splits))
+
+def pareto_front(rows: List[Dict], objectives: List[str]) -> List[Dict]:
+    """Returns the rows that no other row matches or beats on every objective (all of which are
+    minimized) while beating them on at least one.
+    """
+    def dominates(row1: Dict, row2: Dict) -> bool:
+        return (all(row1[key] <= row2[key] for key in objectives)
+                and any(row1[key] < row2[key] for key in objectives))
+    return [row for row in rows if not any(dominates(other, row) for other in rows)]
+
+def _init_worker(alignment: Alignment, alphabet_name: str):
+    global _sweep_alignment
+    _sweep_alignment = alignment
+    constants.set_alphabet(alphabet_name)
+    logging.getLogger("tree_builder").setLevel(logging.WARNING)
+
+def _run_config(config: Dict) -> Tuple[str, Dict]:
+    """Builds a tree with one parameter configuration in a fresh worker process.
+
+    A forked worker starts out with the resident memory of the sweep process (the alignment,
+    the reference tree, ...), so the peak memory of the build is measured above the resident
+    memory of the worker before the build, after resetting the peak of the process.
+    """
+    reset_peak_memory()
+    baseline_mb = current_memory_mb()
+    time_elapsed = time.perf_counter()
+    tree_builder = TreeBuilder(_sweep_alignment,
+                               thresh_cp=config["thresh_cp"],
+                               refresh_interval=config["refresh_interval"],
+                               enable_tophits_approx=config["enable_tophits_approx"])
+    tree = tree_builder.build()
+    time_elapsed = time.perf_counter() - time_elapsed
+    return newick.dumps(tree), dict(time=time_elapsed,
+                                    distances=tree_builder.num_distances,
+                                    peak_memory_mb=peak_memory_mb() - baseline_mb)
+
+def parameter_sweep(alignment: Alignment,
+                    reference: newick.Node,
+                    thresh_cps: List[int],
+                    refresh_factors: List[float],
+                    tophits_approx: List[bool]) -> List[Dict]:
+    """Builds a tree with every combination of parameters and scores it against a reference.
+
+    Each build runs in a fresh process, one at a time, so that timings do not interfere and
+    the peak memory of one build does not carry over to the next (see _run_config).
+
+    Args:
+
+        alignment (Alignment): The alignment.
+
+        reference (newick.Node): The reference tree.
+
+        thresh_cps (List[int]): The values of thresh_cp.
+
+        refresh_factors (List[float]): The refresh intervals, in multiples of sqrt(N). 0 means
+            no refreshes.
+
+        tophits_approx (List[bool]): The values of enable_tophits_approx.
+
+    Returns:
+        List[Dict]: One row per configuration with its parameters, wall time, number of
+            distances, peak memory above the worker's baseline, normalized Robinson-Foulds
+            distance to the reference ("rf") and whether it is on the Pareto front of time and
+            RF ("pareto").
+    """
+    num_sequences = alignment.unique_alignment_size
+    configs = [dict(thresh_cp=thresh_cp,
+                    refresh_factor=refresh_factor,
+                    refresh_interval=(max(int(refresh_factor * isqrt(num_sequences)), 1)
+                                      if refresh_factor > 0 else None),
+                    enable_tophits_approx=approx)
+               for thresh_cp, refresh_factor, approx
+                   in itertools.product(thresh_cps, refresh_factors, tophits_approx)]
+
+    # With fork, workers inherit the alignment instead of unpickling a copy of it.
+    if "fork" in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context("fork")
+    else:
+        mp_context = None
+
+    rows = []
+    for i, config in enumerate(configs):
+        with ProcessPoolExecutor(max_workers=1,
+                                 mp_context=mp_context,
+                                 initializer=_init_worker,
+                                 initargs=(alignment, constants.ALPHABET_NAME)) as executor:
+            tree, measurements = executor.submit(_run_config, config).result()
+        row = dict(config, **measurements)
+        row["rf"] = robinson_foulds(newick.loads(tree)[0], reference)
+        rows.append(row)
+        logger.info(f"Configuration {i+1} of {len(configs)}: {config} took "
+                    f"{row['time']:.3f} s, RF {row['rf']:.3f}")
+
+    front = pareto_front(rows, ["time", "rf"])
+    for row in rows:
+        row["pareto"] = any(row is front_row for front_row in front)
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures how TreeBuilder parameters trade runtime against tree quality")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input-file",
+                        type=str,
+                        help="the aligned sequences in fasta format")
+    source.add_argument("--simulate",
+                        type=int,
+                        nargs=2,
+                        metavar=("N", "L"),
+                        help="simulate N sequences of length L along a random tree")
+    parser.add_argument("--reference",
+                        type=str,
+                        default="nj",
+                        help="the reference tree: 'nj' (exact neighbor joining), 'true' (the "
+                        "simulated tree) or a Newick file (default: nj)")
+    parser.add_argument("--thresh-cp",
+                        type=int,
+                        nargs="+",
+                        default=[1, 2, 3],
+                        help="the values of thresh_cp (default: 1 2 3)")
+    parser.add_argument("--refresh-factor",
+                        type=float,
+                        nargs="+",
+                        default=[0.5, 1, 2, 0],
+                        help="the refresh intervals in multiples of sqrt(N), 0 for no refreshes "
+                        "(default: 0.5 1 2 0)")
+    parser.add_argument("--tophits-approx",
+                        type=str,
+                        default="both",
+                        choices=["on", "off", "both"],
+                        help="the values of enable_tophits_approx (default: both)")
+    parser.add_argument("--seed",
+                        type=int,
+                        help="seed of the simulation")
+    parser.add_argument("output_prefix",
+                        type=str,
+                        help="the results are written to <output_prefix>.csv and "
+                        "<output_prefix>.json")
+    args = parser.parse_args()
+
+    true_tree = None
+    if args.simulate is not None:
+        alignment_dict, true_tree = simulate_alignment(*args.simulate, seed=args.seed)
+    else:
+        alignment_dict = read_alignment(args.input_file)
+    constants.set_alphabet(constants.detect_alphabet(alignment_dict.values()))
+    alignment = Alignment(alignment_dict)
+
+    if args.reference == "true":
+        if true_tree is None:
+            raise ValueError("The true tree is only known for simulated alignments.")
+        reference = true_tree
+    elif args.reference == "nj":
+        logging.getLogger("benchmarks.neighbor_joining").setLevel(logging.WARNING)
+        logger.info("Building the neighbor-joining reference tree")
+        reference = neighbor_joining(alignment)
+    else:
+        reference = newick.read(args.reference)[0]
+
+    tophits_approx = {"on": [True], "off": [False], "both": [True, False]}[args.tophits_approx]
+    rows = parameter_sweep(alignment, reference, args.thresh_cp, args.refresh_factor,
+                           tophits_approx)
+
+    with open(f"{args.output_prefix}.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(f"{args.output_prefix}.json", "w") as f:
+        json.dump(dict(results=rows, pareto_front=[row for row in rows if row["pareto"]]),
+                  f, indent=2)
+    for row in rows:
+        if row["pareto"]:
+            logger.info(f"Pareto optimal: thresh_cp={row['thresh_cp']}, "
+                        f"refresh_factor={row['refresh_factor']}, "
+                        f"enable_tophits_approx={row['enable_tophits_approx']}: "
+                        f"{row['time']:.3f} s, RF {row['rf']:.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import logging
+import multiprocessing
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from numpy.typing import NDArray
+from typing import Dict, FrozenSet, List, Optional, Set
+
+import newick
+
+import constants
+from alignment import Alignment
+from tree_builder import TreeBuilder
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+Split = FrozenSet[str]
+
+# The alignment shared (read-only) by the replicates run in a worker process.
+_worker_alignment: Optional[Alignment] = None
+
+def bootstrap_column_weights(alignment: Alignment,
+                             num_replicates: int,
+                             seed: Optional[int] = None) -> List[NDArray[float]]:
+    """Draws bootstrap replicates of an alignment as profile column weights.
+
+    Each replicate resamples the alignment_length columns of the alignment with replacement. The
+    resampled columns are then counted per profile column (see Alignment.column_map), so that a
+    replicate never has to be materialized as a new alignment.
+
+    Args:
+
+        alignment (Alignment): The alignment to resample.
+
+        num_replicates (int): The number of replicates to draw.
+
+        seed (Optional[int]): Seed of the random number generator.
+
+    Returns:
+        List[NDArray[float]]: The column weights of each replicate.
+    """
+    rng = np.random.default_rng(seed)
+    column_map = alignment.column_map
+    kept = column_map >= 0
+    replicates = []
+    for _ in range(num_replicates):
+        sampled_columns = rng.integers(0, alignment.alignment_length, alignment.alignment_length)
+        column_counts = np.bincount(sampled_columns, minlength=alignment.alignment_length)
+        replicates.append(np.bincount(column_map[kept],
+                                      weights=column_counts[kept],
+                                      minlength=alignment.profile_length))
+    return replicates
+
+def _node_split(node: newick.Node, all_labels: Split) -> Optional[Split]:
+    """Computes the split induced by the edge above a node, or None if the split is trivial.
+
+    A split is represented by the side that does not contain the smallest leaf label, so that
+    splits are independent of where the tree is rooted.
+    """
+    split = frozenset(node.get_leaf_names())
+    if min(all_labels) in split:
+        split = all_labels - split
+    if 1 < len(split) < len(all_labels) - 1:
+        return split
+    return None
+
+def tree_splits(tree: newick.Node) -> Set[Split]:
+    """Computes the non-trivial splits (bipartitions of the leaves) of a tree.
+    """
+    all_labels = frozenset(tree.get_leaf_names())
+    splits = set()
+    for node in tree.walk():
+        if node is not tree and not node.is_leaf:
+            split = _node_split(node, all_labels)
+            if split is not None:
+                splits.add(split)
+    return splits
+
+def _init_worker(alignment: Alignment, alphabet_name: str):
+    global _worker_alignment
+    _worker_alignment = alignment
+    constants.set_alphabet(alphabet_name)
+    logging.getLogger("tree_builder").setLevel(logging.WARNING)
+
+def _run_replicate(column_weights: NDArray[float], tree_builder_kwargs: Dict) -> Set[Split]:
+    tree_builder = TreeBuilder(_worker_alignment.reweighted(column_weights), **tree_builder_kwargs)
+    return tree_splits(tree_builder.build())
+
+def bootstrap_support(alignment: Alignment,
+                      tree: newick.Node,
+                      num_replicates: int,
+                      num_workers: Optional[int] = None,
+                      seed: Optional[int] = None,
+                      **tree_builder_kwargs) -> newick.Node:
+    """Annotates the internal nodes of a tree with bootstrap support values.
+
+    The replicates are built with TreeBuilder on a process pool. Every worker receives the
+    alignment (and thus the leaf profiles) once, and each replicate only ships its column
+    weights. The support of a node is the fraction of replicate trees that contain the split
+    induced by the node, and is stored as the node's name.
+
+    Args:
+
+        alignment (Alignment): The alignment the tree was built from.
+
+        tree (newick.Node): The tree to annotate.
+
+        num_replicates (int): The number of bootstrap replicates.
+
+        num_workers (Optional[int]): The number of worker processes. Defaults to the number of
+            CPUs.
+
+        seed (Optional[int]): Seed used to draw the replicates.
+
+        tree_builder_kwargs: Keyword arguments passed to each replicate's TreeBuilder.
+
+    Returns:
+        newick.Node: The annotated tree.
+    """
+    logger.info(f"Running {num_replicates} bootstrap replicates")
+    replicate_weights = bootstrap_column_weights(alignment, num_replicates, seed)
+
+    # With fork, workers inherit the alignment instead of unpickling a copy of it.
+    if "fork" in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context("fork")
+    else:
+        mp_context = None
+
+    split_counts = dict()
+    with ProcessPoolExecutor(max_workers=num_workers,
+                             mp_context=mp_context,
+                             initializer=_init_worker,
+                             initargs=(alignment, constants.ALPHABET_NAME)) as executor:
+        futures = [executor.submit(_run_replicate, column_weights, tree_builder_kwargs)
+                   for column_weights in replicate_weights]
+        for i, future in enumerate(futures):
+            for split in future.result():
+                split_counts[split] = split_counts.get(split, 0) + 1
+            logger.info(f"Bootstrap replicate {i+1} of {num_replicates} completed")
+
+    all_labels = frozenset(tree.get_leaf_names())
+    for node in tree.walk():
+        if node is not tree and not node.is_leaf:
+            split = _node_split(node, all_labels)
+            if split is not None:
+                node.name = f"{split_counts.get(split, 0) / num_replicates:.3f}"
+    return tree
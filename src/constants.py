@@ -1,13 +1,109 @@
-import _constants.dna as ConstantsSource
+import importlib
+import numpy as np
 
-ALPHALEN = len(ConstantsSource.ALPHABET)
+from typing import Iterable
 
-ALPHABET = ConstantsSource.ALPHABET
+# The alphabet constants are loaded lazily from the module of the selected alphabet, either
+# explicitly through set_alphabet() or, on first access, from the default alphabet.
+ALPHABET_MODULES = {
+    "dna": "_constants.dna",
+    "peptide": "_constants.peptide",
+}
 
-UNSIMILARITY_MATRIX = ConstantsSource.UNSIMILARITY_MATRIX
+DEFAULT_ALPHABET = "dna"
 
-CHARACTER_VECTORS = ConstantsSource.CHARACTER_VECTORS
+_CONSTANT_NAMES = {
+    "ALPHALEN",
+    "ALPHABET",
+    "UNSIMILARITY_MATRIX",
+    "CHARACTER_VECTORS",
+    "CORRECTION",
+    "IS_GAP",
+    "CODE_VECTORS",
+    "CODE_IS_GAP",
+    "CODE_IS_VALID",
+    "CODE_PAIR_UNSIMILARITY",
+}
 
-CORRECTION = ConstantsSource.CORRECTION
+ALPHABET_NAME = None
 
-IS_GAP = ConstantsSource.IS_GAP
+# The constants of every alphabet loaded so far, so that switching back to one is free.
+_loaded_tables = dict()
+
+# Characters that make up nucleotide sequences; used to tell nucleotide alignments apart from
+# peptide alignments.
+_NUCLEOTIDE_CHARACTERS = set("ACGTUN")
+
+def set_alphabet(name: str):
+    """Loads the constants of the given alphabet ("dna" or "peptide").
+
+    Loaded constants are kept, so switching between alphabets (e.g. in a long-running server)
+    only pays for loading each alphabet once. Besides the constants of the alphabet module, this
+    derives lookup tables indexed by the ASCII code of a character:
+
+        CODE_VECTORS (NDArray[float]): the character vector of each code (256 x ALPHALEN).
+
+        CODE_IS_GAP (NDArray[bool]): whether each code is a gap.
+
+        CODE_IS_VALID (NDArray[bool]): whether each code is a known character.
+
+        CODE_PAIR_UNSIMILARITY (NDArray[float]): the dissimilarity of each pair of codes, i.e.
+            the dissimilarity of the profile columns of two sequences with these characters
+            (256 x 256). Ambiguity codes (e.g. B, J, Z and X) are weighted by their character
+            vectors; entries involving gaps are never used.
+    """
+    global ALPHABET_NAME
+    if name not in ALPHABET_MODULES:
+        raise ValueError(f"Unknown alphabet: {name}")
+    if name in _loaded_tables:
+        globals().update(_loaded_tables[name])
+        ALPHABET_NAME = name
+        return
+    source = importlib.import_module(ALPHABET_MODULES[name])
+
+    code_vectors = np.zeros((256, len(source.ALPHABET)), dtype=float)
+    code_is_gap = np.zeros(256, dtype=bool)
+    code_is_valid = np.zeros(256, dtype=bool)
+    for char, vector in source.CHARACTER_VECTORS.items():
+        code_vectors[ord(char)] = vector
+        code_is_gap[ord(char)] = source.IS_GAP(char)
+        code_is_valid[ord(char)] = True
+    code_pair_unsimilarity = code_vectors @ source.UNSIMILARITY_MATRIX @ code_vectors.T
+
+    _loaded_tables[name] = dict(
+        ALPHALEN=len(source.ALPHABET),
+        ALPHABET=source.ALPHABET,
+        UNSIMILARITY_MATRIX=source.UNSIMILARITY_MATRIX,
+        CHARACTER_VECTORS=source.CHARACTER_VECTORS,
+        CORRECTION=source.CORRECTION,
+        IS_GAP=source.IS_GAP,
+        CODE_VECTORS=code_vectors,
+        CODE_IS_GAP=code_is_gap,
+        CODE_IS_VALID=code_is_valid,
+        CODE_PAIR_UNSIMILARITY=code_pair_unsimilarity,
+    )
+    globals().update(_loaded_tables[name])
+    ALPHABET_NAME = name
+
+def detect_alphabet(sequences: Iterable[str], num_sequences: int = 10) -> str:
+    """Guesses the alphabet of an alignment from its first num_sequences sequences. The alignment
+    is taken to be nucleotides if at least 90% of the non-gap characters are A, C, G, T, U or N.
+    """
+    num_nucleotides, num_characters = 0, 0
+    for i, seq in enumerate(sequences):
+        if i == num_sequences:
+            break
+        for c in seq.upper():
+            if c in "-.*":
+                continue
+            num_characters += 1
+            num_nucleotides += c in _NUCLEOTIDE_CHARACTERS
+    if num_characters > 0 and num_nucleotides < 0.9 * num_characters:
+        return "peptide"
+    return "dna"
+
+def __getattr__(name: str):
+    if name in _CONSTANT_NAMES:
+        set_alphabet(DEFAULT_ALPHABET)
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
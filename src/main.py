@@ -7,7 +7,16 @@ import sys
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
-from alignment import Alignment
+import constants
+from alignment import Alignment, read_alignment
+from bootstrap import bootstrap_support
+from memory_report import MemoryReport
+from utils import expand_duplicates
+from partition import partitioned_build
+from planner import DEFAULT_SPEED_PRESET, SPEED_PRESETS, plan_build
+from profile import SPARSE_GAP_FRACTION
+from sharding import SHARD_SIZE, sharded_tophits
+from sketch import SketchIndex
 from tree_builder import TreeBuilder
 from benchmarks.neighbor_joining import neighbor_joining
 from benchmarks.random_joining import random_joining
@@ -15,6 +24,8 @@ from math import isqrt
 import newick
 import time
 
+from typing import Dict, List, Optional
+
 def get_peak_mem_mb():
     # ru_maxrss is in kilobytes on Linux, bytes on macOS
     peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
@@ -23,50 +34,275 @@ def get_peak_mem_mb():
     else:
         return peak / 1024
 
-def main():
-    sys.setrecursionlimit(10_000)
-    print("Recursion limit:", sys.getrecursionlimit())
-
-    parser = argparse.ArgumentParser(description="FastTree implemented in Python")
+def add_build_arguments(parser: argparse.ArgumentParser):
+    """Registers the options that control how a tree is built (see build_tree)."""
     parser.add_argument("--algo",
                         type=str,
                         help="the algorithm used to construct the tree",
                         required=True,
                         choices=["nj", "random", "slowtree"])
-    parser.add_argument("input_file",
-                        type=argparse.FileType("r"),
-                        help="the aligned nucleotide sequences in fasta format")
-    parser.add_argument("output_file",
-                        type=argparse.FileType("w"),
-                        help="the file to output the tree to")
+    parser.add_argument("--alphabet",
+                        type=str,
+                        default="auto",
+                        choices=["auto"] + list(constants.ALPHABET_MODULES),
+                        help="the alphabet of the sequences (default: detected from the first "
+                        "sequences)")
+    parser.add_argument("--sparse-gap-fraction",
+                        type=float,
+                        default=SPARSE_GAP_FRACTION,
+                        help="store sequences with a larger fraction of gapped columns as sparse "
+                        f"profiles (default: {SPARSE_GAP_FRACTION}; use 1 to disable)")
+    parser.add_argument("--compress-columns",
+                        action="store_true",
+                        help="collapse identical alignment columns into weighted profile columns "
+                        "and drop all-gap columns")
+    parser.add_argument("--collapse-duplicates",
+                        action="store_true",
+                        help="build the tree over distinct sequences only and re-attach "
+                        "duplicates as zero-length clades")
+    parser.add_argument("--bootstrap",
+                        type=int,
+                        default=0,
+                        help="annotate the slowtree tree with support values from this many "
+                        "bootstrap replicates (default: 0)")
+    parser.add_argument("--workers",
+                        type=int,
+                        help="the number of worker processes used for bootstrap replicates and "
+                        "cluster subtrees (default: number of CPUs)")
+    parser.add_argument("--clusters",
+                        type=int,
+                        default=0,
+                        help="divide the sequences into this many clusters whose subtrees are "
+                        "built in parallel and then joined (default: 0, build a single tree)")
+    parser.add_argument("--shard-queue",
+                        type=str,
+                        help="compute the initial top hits in shards dispatched through this "
+                        "(empty) queue directory, which workers on other machines can serve with "
+                        "sharding.py; --workers local workers are started")
+    parser.add_argument("--shard-size",
+                        type=int,
+                        default=SHARD_SIZE,
+                        help=f"the number of nodes per shard (default: {SHARD_SIZE})")
+    parser.add_argument("--shard-timeout",
+                        type=float,
+                        help="the number of seconds after which a round of shards that is not "
+                        "done is abandoned with an error (default: no timeout)")
+    parser.add_argument("--threads",
+                        type=int,
+                        help="the number of threads used to compute top-hit distances "
+                        "(default: 1)")
+    parser.add_argument("--max-memory",
+                        type=float,
+                        help="the memory budget of the slowtree builder in MiB; the build "
+                        "parameters are degraded to fit it (default: no budget)")
+    parser.add_argument("--speed-preset",
+                        type=str,
+                        default=DEFAULT_SPEED_PRESET,
+                        choices=list(SPEED_PRESETS),
+                        help="trade accuracy for speed by choosing the top-hit threshold and "
+                        f"refresh interval (default: {DEFAULT_SPEED_PRESET})")
+    parser.add_argument("--thresh-cp",
+                        type=int,
+                        help="the top-hit threshold multiplier (default: set by the preset)")
+    parser.add_argument("--refresh-interval",
+                        type=int,
+                        help="the number of joins between top-hit refreshes (default: set by the "
+                        "preset)")
+    parser.add_argument("--sketch",
+                        action="store_true",
+                        help="compute the initial top hits of each sequence from candidates "
+                        "found by MinHash sketches instead of from all sequences (see sketch.py "
+                        "for a recall report)")
+    parser.add_argument("--adaptive-refresh",
+                        action="store_true",
+                        help="refresh top-hits lists when they become stale instead of every "
+                        "refresh interval")
+    parser.add_argument("--batch-joins",
+                        action="store_true",
+                        help="join several mutually best pairs per scan of the active nodes when "
+                        "a one-join-per-scan build would have joined them next")
+    parser.add_argument("--bounded-distances",
+                        action="store_true",
+                        help="abandon top-hit candidate distances as soon as they provably exceed "
+                        "the current top-hits list (the lists are unchanged)")
+    parser.add_argument("--estimate-join-distances",
+                        action="store_true",
+                        help="estimate the distances of each joined node to its top-hit "
+                        "candidates from the cached distances of its children, computing only "
+                        "the closest candidates exactly")
+    parser.add_argument("--time-budget",
+                        type=float,
+                        help="the number of seconds the slowtree build should fit in; the top-hit "
+                        "refreshes, join batching and top-hits list size are adapted during the "
+                        "build to meet it (default: no budget)")
+    parser.add_argument("--seed",
+                        type=int,
+                        help="seed of the random number generator used for bootstrapping")
 
-    args = parser.parse_args()
-    logger.info(f"Loading fasta file: {args.input_file.name}")
-    fasta_data = args.input_file.read().strip().split('\n')
+def build_args(**options) -> argparse.Namespace:
+    """Returns the build options of add_build_arguments with their defaults overridden by options
+    (using attribute names, e.g. compress_columns=True).
+
+    Raises:
+        ValueError: Raised if an option is unknown.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    add_build_arguments(parser)
+    args = parser.parse_args(["--algo", options.pop("algo", "slowtree")])
+    for name, value in options.items():
+        if not hasattr(args, name):
+            raise ValueError(f"Unknown build option: {name}")
+        setattr(args, name, value)
+    return args
+
+def unsupported_with_clusters(args: argparse.Namespace, memory_report: bool = False) -> List[str]:
+    """Returns the build options that are set in args (or the memory report, if memory_report
+    is set) but not supported together with --clusters, whose subtrees are built by separate
+    tree builders.
+    """
+    if not args.clusters:
+        return []
+    options = dict(shard_queue=args.shard_queue is not None,
+                   sketch=args.sketch,
+                   time_budget=args.time_budget is not None,
+                   memory_report=memory_report)
+    return ["--" + name.replace("_", "-") for name, is_set in options.items() if is_set]
+
+def build_tree(alignment_dict: Dict[str, str],
+               args: argparse.Namespace,
+               memory_report: Optional[MemoryReport] = None) -> newick.Node:
+    """Builds the tree of an alignment with the given build options (see add_build_arguments).
+
+    If memory_report is given, it tracks the alignment from the construction of the profiles
+    on, and the tree builder of the slowtree algorithm (see TreeBuilder).
 
-    alignment_dict = dict()
-    for label_line, seq in zip(fasta_data[::2], fasta_data[1::2]):
-        label = label_line[1:].split(' ', 1)[0]
-        alignment_dict[label] = seq
+    Raises:
+        ValueError: Raised if --clusters is combined with options it does not support (see
+            unsupported_with_clusters).
+    """
+    unsupported = unsupported_with_clusters(args, memory_report is not None)
+    if unsupported:
+        raise ValueError(f"--clusters cannot be combined with {', '.join(unsupported)}.")
+    alphabet = args.alphabet
+    if alphabet == "auto":
+        alphabet = constants.detect_alphabet(alignment_dict.values())
+    logger.info(f"Using {alphabet} alphabet")
+    constants.set_alphabet(alphabet)
 
     logger.info(f"Constructing profile matrices")
-    alignment = Alignment(alignment_dict)
+    alignment = Alignment(alignment_dict,
+                          args.sparse_gap_fraction,
+                          args.compress_columns,
+                          args.collapse_duplicates)
     logger.info(f"Profile matrices of {alignment.alignment_size} sequences "
         f"of length {alignment.alignment_length} successfully constructed")
+    if memory_report is not None:
+        memory_report.track("alignment", alignment.memory_usage)
+        memory_report.snapshot("profiles")
+    if args.collapse_duplicates:
+        logger.info(f"Collapsed {alignment.alignment_size} sequences into "
+            f"{alignment.unique_alignment_size} distinct sequences")
+    if args.compress_columns:
+        logger.info(f"Compressed {alignment.alignment_length} columns into "
+            f"{alignment.profile_length} weighted profile columns")
 
-    time_elapsed = time.perf_counter()
     if args.algo == "nj":
-        newick.dump(neighbor_joining(alignment), args.output_file)
+        return expand_duplicates(neighbor_joining(alignment), alignment.duplicates)
     elif args.algo == "random":
-        newick.dump(random_joining(alignment), args.output_file)
+        return expand_duplicates(random_joining(alignment), alignment.duplicates)
+
+    plan = plan_build(alignment.unique_alignment_size,
+                      alignment.profile_length,
+                      constants.ALPHALEN,
+                      max_memory_mb=args.max_memory,
+                      speed_preset=args.speed_preset,
+                      leaf_profile_bytes=alignment.profile_nbytes,
+                      thresh_cp=args.thresh_cp,
+                      refresh_interval=args.refresh_interval)
+    logger.info("Build plan:\n" + "\n".join(plan.report()))
+    tree_builder_kwargs = dict(plan.tree_builder_kwargs(),
+                               adaptive_refresh=args.adaptive_refresh,
+                               batch_joins=args.batch_joins,
+                               num_threads=args.threads,
+                               bounded_distances=args.bounded_distances,
+                               estimate_join_distances=args.estimate_join_distances)
+    initial_tophits = None
+    if args.shard_queue is not None:
+        alignment_options = dict(sparse_gap_fraction=args.sparse_gap_fraction,
+                                 compress_columns=args.compress_columns,
+                                 collapse_duplicates=args.collapse_duplicates)
+        initial_tophits = sharded_tophits(alignment, alignment_options, args.shard_queue,
+                                          plan.thresh_cp * isqrt(alignment.unique_alignment_size),
+                                          args.shard_size, args.workers,
+                                          timeout=args.shard_timeout)
+    if args.clusters:
+        tree = partitioned_build(alignment, args.clusters, args.workers, args.seed,
+                                 thresh_cp=plan.thresh_cp,
+                                 distance_cache_layout=plan.distance_cache_layout,
+                                 adaptive_refresh=args.adaptive_refresh,
+                                 batch_joins=args.batch_joins,
+                                 num_threads=args.threads,
+                                 bounded_distances=args.bounded_distances,
+                                 estimate_join_distances=args.estimate_join_distances)
     else:
-        tree_builder = TreeBuilder(alignment,
-                                   refresh_interval=isqrt(alignment.alignment_size))
-        newick.dump(tree_builder.build(), args.output_file)
+        sketch_index = None
+        if args.sketch and initial_tophits is None:
+            tophits_size = plan.thresh_cp * isqrt(alignment.unique_alignment_size)
+            sketch_index = SketchIndex(alignment, 4 * tophits_size, seed=args.seed)
+            logger.info(f"Sketched {alignment.unique_alignment_size} sequences into "
+                        f"{sketch_index.num_buckets} buckets")
+        tree_builder = TreeBuilder(alignment, initial_tophits=initial_tophits,
+                                   sketch_index=sketch_index, memory_report=memory_report,
+                                   time_budget=args.time_budget, **tree_builder_kwargs)
+        tree = tree_builder.build()
+    if args.bootstrap > 0:
+        tree = bootstrap_support(alignment, tree, args.bootstrap, args.workers, args.seed,
+                                 **tree_builder_kwargs)
+    return tree
+
+def main():
+    sys.setrecursionlimit(10_000)
+    print("Recursion limit:", sys.getrecursionlimit())
+
+    parser = argparse.ArgumentParser(description="FastTree implemented in Python")
+    add_build_arguments(parser)
+    parser.add_argument("input_file",
+                        type=str,
+                        help="the aligned sequences in fasta format, or an encoded alignment "
+                        "(.npz) written by sampler.py")
+    parser.add_argument("--memory-report",
+                        type=str,
+                        help="write the memory held by each data structure at the end of every "
+                        "phase to this JSON file")
+    parser.add_argument("--tracemalloc",
+                        action="store_true",
+                        help="also record the traced memory and its largest allocation sites in "
+                        "the memory report (slow)")
+    parser.add_argument("output_file",
+                        type=argparse.FileType("w"),
+                        help="the file to output the tree to")
+
+    args = parser.parse_args()
+    unsupported = unsupported_with_clusters(args, args.memory_report is not None)
+    if unsupported:
+        parser.error(f"--clusters cannot be combined with {', '.join(unsupported)}")
+    memory_report = None
+    if args.memory_report is not None:
+        memory_report = MemoryReport(use_tracemalloc=args.tracemalloc)
+    logger.info(f"Loading alignment: {args.input_file}")
+    alignment_dict = read_alignment(args.input_file)
+    if memory_report is not None:
+        memory_report.snapshot("parsing", {"input": {
+            "sequences": sum(sys.getsizeof(seq) for seq in alignment_dict.values())}})
+
+    time_elapsed = time.perf_counter()
+    newick.dump(build_tree(alignment_dict, args, memory_report), args.output_file)
 
     time_elapsed = time.perf_counter() - time_elapsed
     logger.info(f"Elapsed time: {time_elapsed:.3f} s")
     logger.info(f"Peak memory usage: {get_peak_mem_mb():.2f} MiB")
+    if memory_report is not None:
+        memory_report.write(args.memory_report)
 
 if __name__ == "__main__":
     main()
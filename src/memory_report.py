@@ -0,0 +1,135 @@
+import json
+import logging
+import resource
+import sys
+import time
+import tracemalloc
+
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+def _process_memory_mb() -> Dict[str, float]:
+    """Returns the current ("rss_mb", Linux only) and peak ("peak_rss_mb") resident memory of
+    the process in MiB.
+    """
+    memory = dict()
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    memory["rss_mb"] = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    memory["peak_rss_mb"] = peak / (1024**2) if sys.platform == "darwin" else peak / 1024
+    return memory
+
+def reset_peak_memory() -> bool:
+    """Resets the peak resident memory of the process (Linux only), e.g. so that the peak of a
+    job can be told apart from the peaks of the jobs run before it in the same process.
+
+    Returns:
+        bool: Whether the peak was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_memory_mb() -> float:
+    """Returns the peak resident memory of the process in MiB, since the last reset if any."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return _process_memory_mb()["peak_rss_mb"]
+
+def current_memory_mb() -> float:
+    """Returns the current resident memory of the process in MiB (the peak if unknown)."""
+    memory = _process_memory_mb()
+    return memory.get("rss_mb", memory["peak_rss_mb"])
+
+class MemoryReport:
+    """Records the memory held by the data structures of a build at phase boundaries (e.g. after
+    parsing, after building the profiles, after the initial top hits, during the joins and at
+    export), and writes the snapshots as a JSON report.
+
+    Data structures are registered with track() as a function returning the bytes held by each
+    of their parts (e.g. Alignment.memory_usage or TreeBuilder.memory_usage), which is called at
+    every later snapshot. Each snapshot also records the resident memory of the process, and,
+    if enabled, the memory traced by tracemalloc with its largest allocation sites.
+
+    Attributes:
+
+        _sources (Dict[str, Callable[[], Dict[str, int]]]): The tracked data structures.
+
+        _snapshots (List[Dict]): The snapshots taken so far.
+
+        _start_time (float): The time the report was created, from time.perf_counter().
+
+        _top_allocations (int): The number of allocation sites recorded per snapshot when
+            tracemalloc is enabled.
+
+    Args:
+
+        use_tracemalloc (bool, optional): Whether to trace allocations with tracemalloc, which
+            slows the build down considerably. Defaults to False.
+
+        top_allocations (int, optional): The number of largest allocation sites recorded per
+            snapshot when tracing. Defaults to 10.
+    """
+
+    def __init__(self, use_tracemalloc: bool = False, top_allocations: int = 10):
+        self._sources = dict()
+        self._snapshots = []
+        self._start_time = time.perf_counter()
+        self._top_allocations = top_allocations
+        if use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @property
+    def snapshots(self) -> List[Dict]: return self._snapshots
+
+    def track(self, name: str, memory_usage: Callable[[], Dict[str, int]]):
+        """Registers a data structure whose parts are measured by memory_usage at every snapshot.
+        """
+        self._sources[name] = memory_usage
+
+    def snapshot(self, phase: str, structures: Optional[Dict[str, Dict[str, int]]] = None):
+        """Records the memory held by the tracked data structures (and by the given untracked
+        ones) at the end of a phase.
+        """
+        structures = dict(structures) if structures is not None else dict()
+        for name, memory_usage in self._sources.items():
+            structures[name] = memory_usage()
+        snapshot = dict(phase=phase,
+                        time=time.perf_counter() - self._start_time,
+                        structures=structures,
+                        **_process_memory_mb())
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            statistics = tracemalloc.take_snapshot().statistics("lineno")
+            snapshot["traced_mb"] = current / 2**20
+            snapshot["traced_peak_mb"] = peak / 2**20
+            snapshot["top_allocations"] = [
+                dict(location=f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                     bytes=stat.size, count=stat.count)
+                for stat in statistics[:self._top_allocations]]
+        self._snapshots.append(snapshot)
+
+        total = sum(sum(parts.values()) for parts in structures.values())
+        logger.info(f"Memory after {phase}: {total / 2**20:.1f} MiB in tracked structures, "
+                    f"{snapshot['peak_rss_mb']:.1f} MiB peak resident")
+
+    def write(self, path: str):
+        """Writes the snapshots to a JSON file."""
+        with open(path, "w") as f:
+            json.dump(dict(snapshots=self._snapshots), f, indent=2)
@@ -1,8 +1,10 @@
 import numpy as np
 
+from numpy.typing import NDArray
 from typing import Optional, Tuple, Union
 
-from profile import Profile, profile_distance_uncorrected, profile_weighted_join
+from profile import (AnyProfile, Profile, profile_distance_uncorrected,
+                     profile_distance_uncorrected_bounded, profile_weighted_join)
 from sequence import Sequence, sequence_distance_uncorrected
 
 class NodeInfo:
@@ -13,7 +15,8 @@ class NodeInfo:
 
         _sequence (Optional[Sequence]): The Sequence object if the node represents a leaf.
 
-        _profile (Optional[Profile]): The Profile object if the node represents an internal node.
+        _profile (Optional[Union[Profile, SparseProfile]]): The profile if the node represents an
+            internal node.
 
         _up_distance (float): The distance from this node upward to its parent node.
 
@@ -34,7 +37,7 @@ class NodeInfo:
 
     def __init__(
             self,
-            sequence_or_profile: Union[Sequence, Profile],
+            sequence_or_profile: Union[Sequence, AnyProfile],
             up_distance: float = 0.0,
             variance: float = 0.0,
             label: Optional[str] = None,
@@ -56,7 +59,7 @@ class NodeInfo:
     def sequence(self) -> Optional[Sequence]: return self._sequence
 
     @property
-    def profile(self) -> Optional[Profile]: return self._profile
+    def profile(self) -> Optional[AnyProfile]: return self._profile
 
     @property
     def up_distance(self) -> float: return self._up_distance
@@ -69,6 +72,12 @@ class NodeInfo:
 
     def set_variance(self, variance: float): self._variance = variance
 
+    def release_profile(self):
+        """Drops the reference to the profile once it is no longer needed for distance
+        computations, e.g. after the node has been joined.
+        """
+        self._profile = None
+
 def nodeinfo_distance(n1: NodeInfo, n2: NodeInfo) -> float:
     """Computes the distance between two NodeInfos.
 
@@ -93,7 +102,48 @@ def nodeinfo_distance(n1: NodeInfo, n2: NodeInfo) -> float:
 
     return delta - n1.up_distance - n2.up_distance
 
-def nodeinfo_join(n1: NodeInfo, n2: NodeInfo, d: Optional[float] = None) -> Tuple[NodeInfo, float, float]:
+def nodeinfo_distance_bounded(n1: NodeInfo,
+                              n2: NodeInfo,
+                              bound: float) -> Tuple[Optional[float], int]:
+    """Computes nodeinfo_distance, unless it exceeds bound (see
+    profile.profile_distance_uncorrected_bounded).
+
+    Returns:
+        Tuple[Optional[float], int]: The distance, or None if it is proven to exceed bound, and
+            the number of profile columns whose dissimilarities were computed.
+    """
+    if n1.profile is None or n2.profile is None:
+        return nodeinfo_distance(n1, n2), 0
+    up_distance = n1.up_distance + n2.up_distance
+    delta, num_columns = profile_distance_uncorrected_bounded(n1.profile, n2.profile,
+                                                              bound + up_distance)
+    if delta is None:
+        return None, num_columns
+    return delta - up_distance, num_columns
+
+def join_weight(n1: NodeInfo, n2: NodeInfo) -> float:
+    """Returns the weight alpha of n1 (and 1 - alpha of n2) in their join, which favors the node
+    with the smaller variance.
+    """
+    v1, v2 = n1.variance, n2.variance
+    # Nodes without variance estimates (e.g. in a recomputed tree) are weighted equally.
+    return np.clip(0.5 + (v2 - v1) / (2 * (v1 + v2)), 0, 1) if v1 + v2 > 0 else 0.5
+
+def joined_profile_weight(n1: NodeInfo, n2: NodeInfo) -> float:
+    """Returns the fraction of the profile of the join of n1 and n2 that comes from n1: the
+    weight alpha of n1 scaled by the number of sequences of each node (see
+    profile_weighted_join), ignoring gaps. The distances of the joined node are, up to gaps, the
+    same mixture of the distances of n1 and n2.
+    """
+    alpha = join_weight(n1, n2)
+    size1 = n1.profile.num_sequences if n1.profile is not None else 1
+    size2 = n2.profile.num_sequences if n2.profile is not None else 1
+    return alpha * size1 / (alpha * size1 + (1. - alpha) * size2)
+
+def nodeinfo_join(n1: NodeInfo,
+                  n2: NodeInfo,
+                  d: Optional[float] = None,
+                  out: Optional[Tuple[NDArray[float], NDArray[float]]] = None) -> Tuple[NodeInfo, float, float]:
     """Joins two NodeInfos into a single NodeInfo.
 
     A node can be either a Sequence (leaf) or a Profile (internal node). Returned
@@ -103,6 +153,9 @@ def nodeinfo_join(n1: NodeInfo, n2: NodeInfo, d: Optional[float] = None) -> Tupl
     Args:
         n1 (NodeInfo): The first node to compare.
         n2 (NodeInfo): The second node to compare.
+        d (Optional[float]): The distance between n1 and n2, computed if not provided.
+        out (Optional[Tuple[NDArray[float], NDArray[float]]]): Buffers that the joined profile
+            is written into (see profile_weighted_join).
 
     Returns:
         A Tuple containing a NodeInfo object with parameters specified above,
@@ -116,11 +169,11 @@ def nodeinfo_join(n1: NodeInfo, n2: NodeInfo, d: Optional[float] = None) -> Tupl
     v1 = n1.variance
     v2 = n2.variance
 
-    alpha = np.clip(0.5 + (v2 - v1) / (2 * (v1 + v2)), 0, 1)
+    alpha = join_weight(n1, n2)
     left_dist = alpha * d
     right_dist = (1.-alpha) * d
 
-    up_distance = (d / 2.) + abs(v1 - v2) / (2. * d)
+    up_distance = (d / 2.) + (abs(v1 - v2) / (2. * d) if d != 0 else 0.)
     variance = alpha ** 2 * v1 + (1.-alpha)**2 * v2
 
     p1 = (n1.profile if n1.profile is not None 
@@ -128,5 +181,5 @@ def nodeinfo_join(n1: NodeInfo, n2: NodeInfo, d: Optional[float] = None) -> Tupl
     p2 = (n2.profile if n2.profile is not None 
             else Profile.from_aligned_sequence(n2.sequence))   
 
-    p = profile_weighted_join(p1, p2, alpha, 1.-alpha)
+    p = profile_weighted_join(p1, p2, alpha, 1.-alpha, out)
     return (NodeInfo(p, up_distance, variance), left_dist, right_dist)
@@ -0,0 +1,147 @@
+import logging
+import multiprocessing
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from math import isqrt
+from typing import Dict, List, Optional, Tuple
+
+import newick
+
+import constants
+from alignment import Alignment
+from node_info import NodeInfo
+from profile import profile_distance_uncorrected
+from tree_builder import TreeBuilder
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+# The alignment shared (read-only) by the tasks run in a worker process.
+_worker_alignment: Optional[Alignment] = None
+
+# Number of sequences assigned to anchors per task.
+ASSIGNMENT_CHUNK_SIZE = 1024
+
+def _init_worker(alignment: Alignment, alphabet_name: str):
+    global _worker_alignment
+    _worker_alignment = alignment
+    constants.set_alphabet(alphabet_name)
+    logging.getLogger("tree_builder").setLevel(logging.WARNING)
+
+def _assign_to_anchors(labels: List[str], anchor_labels: List[str]) -> List[int]:
+    """Returns, for each label, the index of the anchor closest to its sequence."""
+    profiles = _worker_alignment.profile_dict
+    anchor_profiles = [profiles[label] for label in anchor_labels]
+    return [int(np.argmin([profile_distance_uncorrected(profiles[label], anchor_profile)
+                           for anchor_profile in anchor_profiles]))
+            for label in labels]
+
+def _build_subtree(labels: List[str], tree_builder_kwargs: Dict) -> Tuple[str, NodeInfo]:
+    """Builds the tree of a cluster and returns it in Newick format, together with the NodeInfo
+    of its root.
+    """
+    tree_builder = TreeBuilder(_worker_alignment.subset(labels),
+                               refresh_interval=isqrt(len(labels)),
+                               **tree_builder_kwargs)
+    tree = tree_builder.build()
+    return newick.dumps(tree), tree_builder.root_node_info
+
+def partitioned_build(alignment: Alignment,
+                      num_clusters: Optional[int] = None,
+                      num_workers: Optional[int] = None,
+                      seed: Optional[int] = None,
+                      **tree_builder_kwargs) -> newick.Node:
+    """Builds a tree by dividing the sequences into clusters, building the subtree of each
+    cluster in parallel, and joining the subtrees.
+
+    num_clusters anchor sequences are drawn at random and every sequence joins the cluster of
+    its closest anchor. The subtree of each cluster is built with its own TreeBuilder on a
+    process pool, largest clusters first. Since the profile of the root of a subtree summarizes
+    the whole subtree, a final TreeBuilder pass over the root profiles (with their
+    up-distances) joins the subtrees into a single tree.
+
+    Sequences are only compared to sequences of their own cluster (and to the anchors), so a
+    sequence that is assigned to the wrong cluster stays in it.
+
+    Args:
+
+        alignment (Alignment): The alignment to build the tree of.
+
+        num_clusters (Optional[int]): The number of clusters. Defaults to sqrt(N).
+
+        num_workers (Optional[int]): The number of worker processes. Defaults to the number of
+            CPUs.
+
+        seed (Optional[int]): Seed used to draw the anchors.
+
+        tree_builder_kwargs: Keyword arguments passed to each TreeBuilder. The refresh interval
+            of each TreeBuilder is set to the square root of its number of leaves.
+
+    Returns:
+        newick.Node: The tree.
+    """
+    labels = list(alignment.profile_dict)
+    if num_clusters is None:
+        num_clusters = isqrt(len(labels))
+    num_clusters = min(num_clusters, len(labels))
+    if num_clusters < 2:
+        return TreeBuilder(alignment, refresh_interval=isqrt(len(labels)),
+                           **tree_builder_kwargs).build()
+
+    rng = np.random.default_rng(seed)
+    anchor_labels = [labels[i] for i in rng.choice(len(labels), num_clusters, replace=False)]
+
+    # With fork, workers inherit the alignment instead of unpickling a copy of it.
+    if "fork" in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context("fork")
+    else:
+        mp_context = None
+
+    with ProcessPoolExecutor(max_workers=num_workers,
+                             mp_context=mp_context,
+                             initializer=_init_worker,
+                             initargs=(alignment, constants.ALPHABET_NAME)) as executor:
+        logger.info(f"Assigning {len(labels)} sequences to {num_clusters} anchors")
+        chunks = [labels[start:start+ASSIGNMENT_CHUNK_SIZE]
+                  for start in range(0, len(labels), ASSIGNMENT_CHUNK_SIZE)]
+        clusters = [[] for _ in range(num_clusters)]
+        for chunk, assignment in zip(chunks, executor.map(_assign_to_anchors, chunks,
+                                                          [anchor_labels] * len(chunks))):
+            for label, cluster in zip(chunk, assignment):
+                clusters[cluster].append(label)
+        # Anchors with identical sequences tie, and all their sequences go to the first one.
+        anchor_labels = [anchor for anchor, cluster in zip(anchor_labels, clusters) if cluster]
+        clusters = [cluster for cluster in clusters if cluster]
+        if len(clusters) < num_clusters:
+            logger.info(f"Dropped {num_clusters - len(clusters)} empty clusters")
+            num_clusters = len(clusters)
+        clusters.sort(key=len, reverse=True)
+        logger.info(f"Cluster sizes range from {len(clusters[-1])} to {len(clusters[0])}")
+
+        futures = [executor.submit(_build_subtree, cluster, tree_builder_kwargs)
+                   for cluster in clusters]
+        subtrees, root_profiles, up_distances = dict(), dict(), dict()
+        for i, future in enumerate(futures):
+            subtree, root_info = future.result()
+            cluster_label = f"cluster{i}"
+            subtrees[cluster_label] = newick.loads(subtree)[0]
+            root_profiles[cluster_label] = root_info.profile
+            up_distances[cluster_label] = root_info.up_distance
+            logger.info(f"Subtree {i+1} of {num_clusters} completed")
+
+    logger.info("Joining subtrees")
+    tree = TreeBuilder(alignment.with_profiles(root_profiles),
+                       refresh_interval=isqrt(num_clusters),
+                       up_distances=up_distances,
+                       **tree_builder_kwargs).build()
+    for leaf in list(tree.walk()):
+        if leaf.is_leaf:
+            subtree = subtrees[leaf.name]
+            if leaf.ancestor is None:
+                return subtree
+            subtree.length = leaf.length
+            ancestor = leaf.ancestor
+            ancestor.descendants[ancestor.descendants.index(leaf)] = subtree
+            subtree.ancestor = ancestor
+    return tree
@@ -0,0 +1,182 @@
+import argparse
+import logging
+
+import newick
+
+import constants
+from alignment import Alignment, parse_fasta
+from node_info import NodeInfo, nodeinfo_distance, nodeinfo_join
+from profile import AnyProfile
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+class TreePlacer:
+    """Inserts new sequences into an existing tree without rebuilding it.
+
+    The profiles and up-distances of the internal nodes of the tree are recomputed once, bottom
+    up, by joining the profiles of their children with nodeinfo_join. Each new sequence is then
+    placed by a beam search from the root: at every level, the children of the beam_width
+    closest nodes found so far are compared to the sequence, and the closest node overall
+    becomes its sibling. The edge above that node is split by a new internal node whose profile
+    and branch lengths come from nodeinfo_join.
+
+    Nodes inserted by earlier placements are searched like any other node, so a batch of
+    related sequences can attach to each other. The profiles of the ancestors of an insertion
+    are not updated.
+
+    Attributes:
+
+        _tree (newick.Node): The root of the tree being extended.
+
+        _node_infos (Dict[int, NodeInfo]): The NodeInfo of every node of the tree, keyed by the
+            id() of its newick.Node.
+
+        _beam_width (int): The number of nodes kept at each level of the search.
+
+        _num_distances (int): The number of distances computed by placements so far.
+
+    Args:
+
+        tree (newick.Node): The tree, e.g. as exported by TreeBuilder.
+
+        alignment (Alignment): An alignment holding (at least) the sequences of the leaves of
+            the tree.
+
+        beam_width (int, optional): The number of nodes kept at each level of the search.
+            Wider beams rarely find better placements but cost beam_width distances per level.
+            Defaults to 4.
+    """
+
+    def __init__(self, tree: newick.Node, alignment: Alignment, beam_width: int=4):
+        leaf_profiles = dict(alignment.profile_dict)
+        for label, duplicate_labels in alignment.duplicates.items():
+            for duplicate_label in duplicate_labels:
+                leaf_profiles[duplicate_label] = leaf_profiles[label]
+
+        self._tree = tree
+        self._node_infos = dict()
+        self._num_distances = 0
+        self._beam_width = beam_width
+        self._profile_length = alignment.profile_length
+
+        logger.info("Recomputing internal profiles of the tree")
+        for node in tree.walk(mode="postorder"):
+            if node.is_leaf:
+                if node.name not in leaf_profiles:
+                    raise ValueError(f"Leaf {node.name} has no sequence in the alignment.")
+                self._node_infos[id(node)] = NodeInfo(leaf_profiles[node.name], label=node.name)
+                continue
+            node_info = self._node_infos[id(node.descendants[0])]
+            for child in node.descendants[1:]:
+                node_info, _, _ = nodeinfo_join(node_info, self._node_infos[id(child)])
+            self._node_infos[id(node)] = node_info
+
+    @property
+    def tree(self) -> newick.Node: return self._tree
+
+    @property
+    def num_distances(self) -> int: return self._num_distances
+
+    def _distance(self, node_info: NodeInfo, node: newick.Node) -> float:
+        self._num_distances += 1
+        return nodeinfo_distance(node_info, self._node_infos[id(node)])
+
+    def _find_sibling(self, node_info: NodeInfo) -> newick.Node:
+        """Returns the node of the tree closest to node_info, found by a beam search from the
+        root.
+        """
+        best_node, best_distance = self._tree, self._distance(node_info, self._tree)
+        beam = [self._tree]
+        while beam:
+            candidates = [(self._distance(node_info, child), i, child)
+                          for i, child in enumerate(c for nd in beam for c in nd.descendants)]
+            candidates.sort(key=lambda candidate: candidate[:2])
+            if candidates and candidates[0][0] < best_distance:
+                best_distance, _, best_node = candidates[0]
+            beam = [child for _, _, child in candidates[:self._beam_width]]
+        return best_node
+
+    def place(self, label: str, profile: AnyProfile) -> newick.Node:
+        """Inserts a sequence into the tree.
+
+        Args:
+
+            label (str): The label of the new leaf.
+
+            profile (Union[Profile, SparseProfile]): The profile of the sequence, built like the
+                profiles of the alignment the placer was created with.
+
+        Returns:
+            newick.Node: The new leaf.
+        """
+        if profile.profile_length != self._profile_length:
+            raise ValueError("New sequences must have the same profile length as the tree.")
+        leaf_info = NodeInfo(profile, label=label)
+        sibling = self._find_sibling(leaf_info)
+        sibling_info = self._node_infos[id(sibling)]
+
+        d = nodeinfo_distance(sibling_info, leaf_info)
+        parent_info, sibling_dist, leaf_dist = nodeinfo_join(sibling_info, leaf_info, d)
+        sibling_length = constants.CORRECTION(max(sibling_dist, 0.))
+
+        leaf = newick.Node(label, length=constants.CORRECTION(max(leaf_dist, 0.)))
+        parent = newick.Node()
+        ancestor = sibling.ancestor
+        if ancestor is None:
+            self._tree = parent
+        else:
+            ancestor.descendants[ancestor.descendants.index(sibling)] = parent
+            parent.ancestor = ancestor
+            parent.length = max((sibling.length or 0.) - sibling_length, 0.)
+        sibling.length = sibling_length
+        parent.add_descendant(sibling)
+        parent.add_descendant(leaf)
+
+        self._node_infos[id(leaf)] = leaf_info
+        self._node_infos[id(parent)] = parent_info
+        return leaf
+
+    def place_alignment(self, alignment: Alignment) -> newick.Node:
+        """Inserts every sequence of an alignment into the tree, in order. The columns of the
+        alignment must match the columns of the alignment the placer was created with.
+
+        Returns:
+            newick.Node: The root of the extended tree.
+        """
+        for i, (label, profile) in enumerate(alignment.profile_dict.items()):
+            self.place(label, profile)
+            logger.info(f"Placed sequence {i+1} of {alignment.unique_alignment_size}")
+        return self._tree
+
+def main():
+    parser = argparse.ArgumentParser(description="Inserts new sequences into an existing tree")
+    parser.add_argument("--beam-width",
+                        type=int,
+                        default=4,
+                        help="the number of nodes kept at each level of the search (default: 4)")
+    parser.add_argument("tree_file",
+                        type=argparse.FileType("r"),
+                        help="the existing tree in Newick format")
+    parser.add_argument("reference_file",
+                        type=argparse.FileType("r"),
+                        help="the aligned sequences of the leaves of the tree in fasta format")
+    parser.add_argument("new_file",
+                        type=argparse.FileType("r"),
+                        help="the new sequences, aligned to the reference, in fasta format")
+    parser.add_argument("output_file",
+                        type=argparse.FileType("w"),
+                        help="the file to output the extended tree to")
+    args = parser.parse_args()
+
+    tree = newick.load(args.tree_file)[0]
+    reference_dict = parse_fasta(args.reference_file.read())
+    new_dict = parse_fasta(args.new_file.read())
+    constants.set_alphabet(constants.detect_alphabet(reference_dict.values()))
+
+    placer = TreePlacer(tree, Alignment(reference_dict), args.beam_width)
+    newick.dump(placer.place_alignment(Alignment(new_dict)), args.output_file)
+    logger.info(f"Computed {placer.num_distances} distances")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import logging
+import math
+
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+# Parameters of each speed preset, as (thresh_cp, refresh interval in multiples of sqrt(N)).
+SPEED_PRESETS = {
+    "fast": (1, 2.),
+    "balanced": (2, 1.),
+    "accurate": (3, .5),
+}
+DEFAULT_SPEED_PRESET = "balanced"
+
+# Approximate sizes (in bytes) of the Python objects making up the builder's data structures.
+LIST_SLOT_BYTES = 8
+FLOAT_BYTES = 24
+DICT_ENTRY_BYTES = 130
+SET_ENTRY_BYTES = 50
+NODE_BYTES = 600
+
+class BuildPlan:
+    """The parameters of a TreeBuilder chosen to fit a memory budget, together with the memory
+    estimates they were chosen from.
+
+    Attributes:
+
+        _thresh_cp (int): The top-hit threshold multiplier.
+
+        _refresh_interval (Optional[int]): The interval between top-hit refreshes, or None to
+            never refresh.
+
+        _distance_cache_layout (str): The layout of the distance cache ("dense" or "sparse").
+
+        _arena_capacity (Optional[int]): The number of preallocated profile arena slots, or None
+            for the TreeBuilder default.
+
+        _estimates (Dict[str, int]): The estimated peak size in bytes of each data structure.
+
+        _max_memory_bytes (Optional[int]): The memory budget, if any.
+
+        _notes (List[str]): The adjustments made to fit the budget.
+    """
+
+    def __init__(self,
+                 thresh_cp: int,
+                 refresh_interval: Optional[int],
+                 distance_cache_layout: str,
+                 arena_capacity: Optional[int],
+                 estimates: Dict[str, int],
+                 max_memory_bytes: Optional[int],
+                 notes: List[str]):
+        self._thresh_cp = thresh_cp
+        self._refresh_interval = refresh_interval
+        self._distance_cache_layout = distance_cache_layout
+        self._arena_capacity = arena_capacity
+        self._estimates = estimates
+        self._max_memory_bytes = max_memory_bytes
+        self._notes = notes
+
+    @property
+    def thresh_cp(self) -> int: return self._thresh_cp
+
+    @property
+    def refresh_interval(self) -> Optional[int]: return self._refresh_interval
+
+    @property
+    def distance_cache_layout(self) -> str: return self._distance_cache_layout
+
+    @property
+    def arena_capacity(self) -> Optional[int]: return self._arena_capacity
+
+    @property
+    def estimates(self) -> Dict[str, int]: return self._estimates
+
+    @property
+    def total_bytes(self) -> int: return sum(self._estimates.values())
+
+    @property
+    def fits(self) -> bool:
+        return self._max_memory_bytes is None or self.total_bytes <= self._max_memory_bytes
+
+    def tree_builder_kwargs(self) -> Dict:
+        """Returns the keyword arguments that configure a TreeBuilder according to the plan.
+        """
+        return dict(thresh_cp=self._thresh_cp,
+                    refresh_interval=self._refresh_interval,
+                    distance_cache_layout=self._distance_cache_layout,
+                    arena_capacity=self._arena_capacity)
+
+    def report(self) -> List[str]:
+        """Returns a human-readable description of the plan, one line per item.
+        """
+        refresh = (f"every {self._refresh_interval} joins" if self._refresh_interval
+                   else "never")
+        lines = [f"thresh_cp={self._thresh_cp}, top-hit refresh {refresh}, "
+                 f"{self._distance_cache_layout} distance cache"]
+        for name, size in self._estimates.items():
+            lines.append(f"  {name}: {size / 2**20:.1f} MiB")
+        budget = ("" if self._max_memory_bytes is None
+                  else f" (budget {self._max_memory_bytes / 2**20:.1f} MiB)")
+        lines.append(f"  total: {self.total_bytes / 2**20:.1f} MiB{budget}")
+        lines.extend(self._notes)
+        return lines
+
+def _estimate_num_distances(num_sequences: int, tophits_size: int,
+                            refresh_interval: Optional[int]) -> int:
+    """Estimates the number of distances computed (and cached) while building a tree.
+
+    The initial top-hits lists cost a full row of distances per seed node, i.e. N^2/m in total
+    for top-hits lists of size m. Every node then compares itself against the top hits of its
+    seed and every join against the top hits of its children, about 3Nm in total. A refresh
+    with n active nodes costs another n^2/m, which sums to N^3/(3rm) over refreshes every r
+    joins. Measured counts fall somewhat below this estimate.
+    """
+    n, m = num_sequences, max(tophits_size, 1)
+    num_distances = n * n / m + 3 * n * m
+    if refresh_interval and refresh_interval < n:
+        num_distances += n ** 3 / (3 * refresh_interval * m)
+    return int(min(num_distances, n * (2 * n - 1)))
+
+def _estimate(num_sequences: int,
+              profile_length: int,
+              alphabet_size: int,
+              leaf_profile_bytes: Optional[int],
+              thresh_cp: int,
+              refresh_interval: Optional[int],
+              distance_cache_layout: str,
+              arena_capacity: Optional[int]) -> Dict[str, int]:
+    n = num_sequences
+    tophits_size = thresh_cp * math.isqrt(n)
+    num_distances = _estimate_num_distances(n, tophits_size, refresh_interval)
+    if distance_cache_layout == "dense":
+        # Triangular lists over all 2N-1 nodes, plus a float object per computed distance.
+        cache_bytes = LIST_SLOT_BYTES * n * (2 * n - 1) + FLOAT_BYTES * num_distances
+    else:
+        cache_bytes = DICT_ENTRY_BYTES * num_distances
+
+    profile_bytes = (alphabet_size + 1) * profile_length * 8
+    if leaf_profile_bytes is None:
+        leaf_profile_bytes = n * profile_bytes
+    if arena_capacity is None:
+        arena_capacity = n // 2 + 1
+
+    return {
+        "distance cache": int(cache_bytes),
+        "leaf profiles": int(leaf_profile_bytes),
+        # The arena reserves every preallocated slot up front, but only the slots written to
+        # become resident, so this is an upper bound rather than an estimate of resident memory.
+        "profile arena (reserved)": arena_capacity * profile_bytes,
+        "top-hits lists": n * tophits_size * SET_ENTRY_BYTES,
+        "nodes": 2 * n * NODE_BYTES,
+    }
+
+def plan_build(num_sequences: int,
+               profile_length: int,
+               alphabet_size: int,
+               max_memory_mb: Optional[float] = None,
+               speed_preset: str = DEFAULT_SPEED_PRESET,
+               leaf_profile_bytes: Optional[int] = None,
+               thresh_cp: Optional[int] = None,
+               refresh_interval: Optional[int] = None) -> BuildPlan:
+    """Chooses the parameters of a TreeBuilder from the size of the input and a memory budget.
+
+    The parameters start from the speed preset (overridden by thresh_cp and refresh_interval if
+    given). If the estimated peak memory exceeds the budget, the plan degrades in order: it
+    switches the distance cache to the sparse layout (if that is smaller), preallocates only
+    sqrt(N) profile arena slots, and then refreshes the top hits less and less often. A plan
+    that still does not fit is returned with a warning.
+
+    Args:
+
+        num_sequences (int): The number of (distinct) sequences N.
+
+        profile_length (int): The number of profile columns.
+
+        alphabet_size (int): The size of the alphabet.
+
+        max_memory_mb (Optional[float]): The memory budget in MiB, or None for no budget.
+
+        speed_preset (str): One of SPEED_PRESETS.
+
+        leaf_profile_bytes (Optional[int]): The size of the leaf profiles of the alignment, if
+            known. Defaults to the size of N dense profiles.
+
+        thresh_cp (Optional[int]): Overrides the top-hit threshold multiplier of the preset.
+
+        refresh_interval (Optional[int]): Overrides the refresh interval of the preset.
+
+    Returns:
+        BuildPlan: The plan.
+
+    Raises:
+        ValueError: Raised if the speed preset is unknown.
+    """
+    if speed_preset not in SPEED_PRESETS:
+        raise ValueError(f"Unknown speed preset: {speed_preset}")
+    preset_thresh_cp, refresh_factor = SPEED_PRESETS[speed_preset]
+    if thresh_cp is None:
+        thresh_cp = preset_thresh_cp
+    if refresh_interval is None:
+        refresh_interval = max(int(refresh_factor * math.isqrt(num_sequences)), 1)
+    max_memory_bytes = None if max_memory_mb is None else int(max_memory_mb * 2**20)
+
+    params = dict(thresh_cp=thresh_cp,
+                  refresh_interval=refresh_interval,
+                  distance_cache_layout="dense",
+                  arena_capacity=None)
+    estimate = lambda: _estimate(num_sequences, profile_length, alphabet_size,
+                                 leaf_profile_bytes, **params)
+    notes = []
+    fits = lambda estimates: max_memory_bytes is None or sum(estimates.values()) <= max_memory_bytes
+
+    def estimate_smallest_cache():
+        # Picks whichever distance cache layout is smaller under the current parameters.
+        candidates = []
+        for layout in ["dense", "sparse"]:
+            params["distance_cache_layout"] = layout
+            candidates.append(estimate())
+        estimates = min(candidates, key=lambda estimates: estimates["distance cache"])
+        params["distance_cache_layout"] = ["dense", "sparse"][candidates.index(estimates)]
+        return estimates
+
+    estimates = estimate()
+    if not fits(estimates):
+        estimates = estimate_smallest_cache()
+    if not fits(estimates):
+        params["arena_capacity"] = math.isqrt(num_sequences) + 1
+        estimates = estimate_smallest_cache()
+        notes.append("Reduced the preallocated profile arena to fit the memory budget")
+    while not fits(estimates) and params["refresh_interval"] is not None:
+        params["refresh_interval"] *= 2
+        if params["refresh_interval"] >= num_sequences:
+            params["refresh_interval"] = None
+        estimates = estimate_smallest_cache()
+    if params["distance_cache_layout"] == "sparse":
+        notes.append("Switched to the sparse distance cache to fit the memory budget")
+    if params["refresh_interval"] != refresh_interval:
+        notes.append("Refreshed top hits less often to fit the memory budget")
+
+    plan = BuildPlan(estimates=estimates, max_memory_bytes=max_memory_bytes, notes=notes,
+                     **params)
+    if not plan.fits:
+        logger.warning(f"Estimated peak memory of {plan.total_bytes / 2**20:.1f} MiB exceeds "
+                       f"the budget of {max_memory_mb} MiB")
+    return plan
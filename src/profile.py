@@ -1,10 +1,31 @@
 import numpy as np
 
 from numpy.typing import NDArray
-from typing import Union
+from typing import List, Optional, Tuple, Union
 
 import constants
-from constants import ALPHALEN
+
+# Profiles with a larger fraction of gapped columns than this are stored as SparseProfiles.
+SPARSE_GAP_FRACTION = 0.5
+
+# Number of sequence pairs whose distances are computed at once from their character codes.
+CODE_PAIR_BLOCK_SIZE = 256
+
+# Number of columns processed at once by profile_distance_uncorrected_bounded.
+DISTANCE_BLOCK_SIZE = 256
+
+def _encode_aligned_sequence(aligned_seq: str) -> NDArray[np.uint8]:
+    """Converts an aligned sequence to the array of its character codes, which index the lookup
+    tables in constants.
+
+    Raises:
+        ValueError: Raised if the sequence contains a character unknown to the alphabet.
+    """
+    codes = np.frombuffer(aligned_seq.encode("ascii", errors="replace"), dtype=np.uint8)
+    invalid = ~constants.CODE_IS_VALID[codes]
+    if np.any(invalid):
+        raise ValueError(f"Encountered unknown character: {aligned_seq[np.argmax(invalid)]}")
+    return codes
 
 class Profile:
     """A class representing a profile matrix.
@@ -20,30 +41,119 @@ class Profile:
         num_sequences (int): the number of sequences stored
 
         ungapped (NDArray[float]): the proportion of non-gaps in each column
+
+        column_weights (Optional[NDArray[float]]): the multiplicity of each column if the
+            alignment was compressed (see Alignment), or None if every column has weight 1
     """
 
-    def __init__(self, p_mat: NDArray[NDArray[float]], num_sequences: int, ungapped: NDArray[float]):
+    def __init__(self,
+                 p_mat: NDArray[NDArray[float]],
+                 num_sequences: int,
+                 ungapped: NDArray[float],
+                 column_weights: Optional[NDArray[float]] = None):
         self._profile = p_mat
         self._profile_length = len(p_mat[0])
         self._num_sequences = num_sequences
         self._ungapped = ungapped
+        self._column_weights = column_weights
 
     @classmethod
-    def from_aligned_sequence(self, aligned_seq: str):
-        s_len = len(aligned_seq)
-    
-        profile = np.zeros((constants.ALPHALEN, s_len), dtype=float)
-        ungapped = np.zeros(s_len, dtype=float)
-        
-        for col_idx, char in enumerate(aligned_seq):
-            try:
-                profile[:, col_idx] = constants.CHARACTER_VECTORS[char]
-                if not constants.IS_GAP(char):
-                    ungapped[col_idx] = 1
-            except KeyError:
-                raise ValueError(f"Encountered unknown character: {char}")
+    def from_aligned_sequence(self, aligned_seq: str, column_weights: Optional[NDArray[float]] = None):
+        codes = _encode_aligned_sequence(aligned_seq)
+        profile = constants.CODE_VECTORS[codes].T.copy()
+        ungapped = (~constants.CODE_IS_GAP[codes]).astype(float)
+        return Profile(profile, 1, ungapped, column_weights)
+
+    @property
+    def profile(self) -> NDArray[float]: return self._profile
+
+    @property
+    def profile_length(self) -> int: return self._profile_length
+
+    @property
+    def num_sequences(self) -> int: return self._num_sequences
+
+    @property
+    def ungapped(self) -> NDArray[float]: return self._ungapped
+
+    @property
+    def column_weights(self) -> Optional[NDArray[float]]: return self._column_weights
+
+    def with_column_weights(self, column_weights: Optional[NDArray[float]]) -> "Profile":
+        """Returns a profile sharing this profile's matrices but with different column weights.
+        """
+        return Profile(self._profile, self._num_sequences, self._ungapped, column_weights)
+
+
+class SparseProfile:
+    """A profile that only stores its non-gapped columns.
+
+    Highly gapped alignments (e.g. 16S rRNA alignments against a wide reference) leave most
+    columns of a profile gapped. Since gapped columns never contribute to distances, only the
+    column indices and values of the remaining columns are kept.
+
+    Properties:
+
+        columns (NDArray[int]): the sorted indices of the stored (non-gapped) columns
+
+        profile (NDArray[NDArray[float]]): the profile matrix restricted to the stored columns
+
+        profile_length (int): the length of the profile, including gapped columns
+
+        num_sequences (int): the number of sequences stored
+
+        ungapped (NDArray[float]): the proportion of non-gaps in each stored column
 
-        return Profile(profile, 1, ungapped)
+        column_weights (Optional[NDArray[float]]): the multiplicity of every column (indexed by
+            column, not by stored column), or None if every column has weight 1
+
+        sparse_gap_fraction (float): the gap fraction above which profiles of the alignment are
+            stored sparsely, which decides whether joins with this profile stay sparse
+    """
+
+    def __init__(self,
+                 columns: NDArray[int],
+                 p_mat: NDArray[NDArray[float]],
+                 profile_length: int,
+                 num_sequences: int,
+                 ungapped: NDArray[float],
+                 column_weights: Optional[NDArray[float]] = None,
+                 sparse_gap_fraction: float = SPARSE_GAP_FRACTION):
+        self._columns = columns
+        self._profile = p_mat
+        self._profile_length = profile_length
+        self._num_sequences = num_sequences
+        self._ungapped = ungapped
+        self._column_weights = column_weights
+        self._sparse_gap_fraction = sparse_gap_fraction
+
+    @classmethod
+    def from_aligned_sequence(self,
+                              aligned_seq: str,
+                              column_weights: Optional[NDArray[float]] = None,
+                              sparse_gap_fraction: float = SPARSE_GAP_FRACTION):
+        codes = _encode_aligned_sequence(aligned_seq)
+        columns = np.flatnonzero(~constants.CODE_IS_GAP[codes])
+        profile = constants.CODE_VECTORS[codes[columns]].T.copy()
+        return SparseProfile(columns, profile, len(aligned_seq), 1,
+                             np.ones(len(columns), dtype=float), column_weights,
+                             sparse_gap_fraction)
+
+    @classmethod
+    def from_profile(self, p: Profile, sparse_gap_fraction: float = SPARSE_GAP_FRACTION):
+        columns = np.flatnonzero(p.ungapped > 0)
+        return SparseProfile(columns, p.profile[:, columns], p.profile_length, p.num_sequences,
+                             p.ungapped[columns], p.column_weights, sparse_gap_fraction)
+
+    def to_dense(self) -> Profile:
+        profile = np.full((constants.ALPHALEN, self._profile_length), 0.25, dtype=float)
+        ungapped = np.zeros(self._profile_length, dtype=float)
+        profile[:, self._columns] = self._profile
+        ungapped[self._columns] = self._ungapped
+        return Profile(profile, self._num_sequences, ungapped, self._column_weights)
+
+    @property
+    def columns(self) -> NDArray[int]: return self._columns
 
     @property
     def profile(self) -> NDArray[float]: return self._profile
@@ -57,13 +167,92 @@ class Profile:
     @property
     def ungapped(self) -> NDArray[float]: return self._ungapped
 
+    @property
+    def column_weights(self) -> Optional[NDArray[float]]: return self._column_weights
+
+    @property
+    def sparse_gap_fraction(self) -> float: return self._sparse_gap_fraction
+
+    def with_column_weights(self, column_weights: Optional[NDArray[float]]) -> "SparseProfile":
+        """Returns a profile sharing this profile's matrices but with different column weights.
+        """
+        return SparseProfile(self._columns, self._profile, self._profile_length,
+                             self._num_sequences, self._ungapped, column_weights,
+                             self._sparse_gap_fraction)
+
+    @property
+    def gap_fraction(self) -> float: return 1. - len(self._columns) / self._profile_length
+
+
+AnyProfile = Union[Profile, SparseProfile]
+
+def profile_from_aligned_sequence(aligned_seq: str,
+                                  sparse_gap_fraction: Optional[float] = SPARSE_GAP_FRACTION,
+                                  column_weights: Optional[NDArray[float]] = None) -> AnyProfile:
+    """Builds the profile of a single aligned sequence, choosing the sparse representation if
+    more than sparse_gap_fraction of its columns are gapped.
+
+    Args:
+
+        aligned_seq (str): The aligned sequence.
+
+        sparse_gap_fraction (Optional[float]): The gap fraction above which a SparseProfile is
+            returned. If None, a dense Profile is always returned.
+
+        column_weights (Optional[NDArray[float]]): The multiplicity of each column.
 
-def profile_distance_uncorrected(p1: Profile, p2: Profile) -> float:
+    Returns:
+        Union[Profile, SparseProfile]: The profile of the sequence.
+    """
+    if sparse_gap_fraction is not None and len(aligned_seq) > 0:
+        num_gaps = np.count_nonzero(constants.CODE_IS_GAP[_encode_aligned_sequence(aligned_seq)])
+        if num_gaps > sparse_gap_fraction * len(aligned_seq):
+            return SparseProfile.from_aligned_sequence(aligned_seq, column_weights,
+                                                       sparse_gap_fraction)
+    return Profile.from_aligned_sequence(aligned_seq, column_weights)
+
+
+def _sparse_profile_distance_uncorrected(p1: AnyProfile, p2: AnyProfile) -> float:
+    """Computes profile_distance_uncorrected when at least one profile is sparse, restricting the
+    computation to the columns that are non-gapped in both profiles.
+    """
+    if isinstance(p1, SparseProfile) and isinstance(p2, SparseProfile):
+        columns, idx1, idx2 = np.intersect1d(p1.columns, p2.columns,
+                                             assume_unique=True, return_indices=True)
+        p1_mat, p1_ungapped = p1.profile[:, idx1], p1.ungapped[idx1]
+        p2_mat, p2_ungapped = p2.profile[:, idx2], p2.ungapped[idx2]
+    else:
+        if isinstance(p2, SparseProfile):
+            p1, p2 = p2, p1
+        columns = p1.columns
+        p1_mat, p1_ungapped = p1.profile, p1.ungapped
+        p2_mat, p2_ungapped = p2.profile[:, columns], p2.ungapped[columns]
+
+    column_weights = p1_ungapped * p2_ungapped
+    if p1.column_weights is not None:
+        column_weights *= p1.column_weights[columns]
+    column_mask = column_weights > 0.0
+    if not np.any(column_mask):
+        return 0.0
+
+    column_weights = column_weights[column_mask]
+    pos_dissimilarities = np.einsum("ij,ik,kj->j",
+                                    p1_mat[:, column_mask],
+                                    constants.UNSIMILARITY_MATRIX,
+                                    p2_mat[:, column_mask])
+    return np.sum(pos_dissimilarities * column_weights) / np.sum(column_weights)
+
+
+def profile_distance_uncorrected(p1: AnyProfile, p2: AnyProfile) -> float:
     """Compute the distance between two profiles.
 
     Specifically, profile distance is calculated by
       1. Summing the position-wise dissimilarity
       2. Weighting by the fraction of non-gapped position in each profile
+         (and by the multiplicity of each column, if the alignment was compressed)
+
+    If either profile is a SparseProfile, only the columns that are non-gapped in both profiles
+    are visited.
     
     [ToDo]: add eigendecomposition optimization
 
@@ -79,15 +268,18 @@ def profile_distance_uncorrected(p1: Profile, p2: Profile) -> float:
                - If the raw distance is at or beyond a model limit, returns float("inf").
     """
 
+    if isinstance(p1, SparseProfile) or isinstance(p2, SparseProfile):
+        return _sparse_profile_distance_uncorrected(p1, p2)
+
     p1_mat, p2_mat = p1.profile, p2.profile
-    profile_length = p1.profile_length
-    
-    pos_dissimilarities = np.array(
-        [p1_mat[:, i] @ (constants.UNSIMILARITY_MATRIX @ p2_mat[:, i])
-        for i in range(profile_length)],
-    dtype=float)
-    
+
+    # Computed for all columns at once so that the work stays inside NumPy (which releases the
+    # GIL, see TreeBuilder's num_threads).
+    pos_dissimilarities = np.sum(p1_mat * (constants.UNSIMILARITY_MATRIX @ p2_mat), axis=0)
+
     column_weights = p1.ungapped * p2.ungapped
+    if p1.column_weights is not None:
+        column_weights *= p1.column_weights
 
     column_mask = column_weights > 0.0
     if not np.any(column_mask):
@@ -100,7 +292,107 @@ def profile_distance_uncorrected(p1: Profile, p2: Profile) -> float:
     return raw_dist
 
 
-def profile_distance_corrected(p1: Profile, p2: Profile) -> float:
+def profile_distance_uncorrected_bounded(p1: AnyProfile,
+                                         p2: AnyProfile,
+                                         bound: float,
+                                         block_size: int = DISTANCE_BLOCK_SIZE) -> Tuple[Optional[float], int]:
+    """Computes profile_distance_uncorrected, unless it exceeds bound.
+
+    The weights of the columns (which are cheap) are computed first, and the dissimilarities
+    are then accumulated block_size columns at a time. Since dissimilarities are non-negative,
+    the weighted dissimilarity accumulated so far, divided by the total weight, is a lower bound
+    on the distance, and the computation stops as soon as it exceeds bound. The sum is taken in
+    a different order than in profile_distance_uncorrected, so the two may differ in the last
+    bits. Pairs involving a SparseProfile, profiles of at most one block and infinite bounds
+    are computed in full by profile_distance_uncorrected.
+
+    Args:
+
+        p1 (Profile): The first profile to compare.
+
+        p2 (Profile): The second profile to compare.
+
+        bound (float): The distance above which the computation may stop.
+
+        block_size (int): The number of columns processed at once.
+
+    Returns:
+        Tuple[Optional[float], int]: The distance, or None if it is proven to exceed bound,
+            and the number of columns whose dissimilarities were computed.
+    """
+    if (isinstance(p1, SparseProfile) or isinstance(p2, SparseProfile)
+            or bound == float("inf") or p1.profile_length <= block_size):
+        return profile_distance_uncorrected(p1, p2), p1.profile_length
+
+    column_weights = p1.ungapped * p2.ungapped
+    if p1.column_weights is not None:
+        column_weights *= p1.column_weights
+    total_weight = np.sum(column_weights[column_weights > 0.0])
+    if total_weight == 0.0:
+        return 0.0, 0
+
+    profile_length = p1.profile_length
+    max_weighted_dissimilarity = bound * total_weight
+    weighted_dissimilarity = 0.0
+    for start in range(0, profile_length, block_size):
+        block = slice(start, start + block_size)
+        weighted_dissimilarity += np.einsum(
+            "ij,ij,j->", p1.profile[:, block],
+            constants.UNSIMILARITY_MATRIX @ p2.profile[:, block], column_weights[block])
+        if (weighted_dissimilarity > max_weighted_dissimilarity
+                and start + block_size < profile_length):
+            return None, start + block_size
+    return weighted_dissimilarity / total_weight, profile_length
+
+
+def code_pair_distances_uncorrected(codes: NDArray[np.uint8],
+                                    ids1: List[int],
+                                    ids2: List[int],
+                                    column_weights: Optional[NDArray[float]] = None,
+                                    block_size: int = CODE_PAIR_BLOCK_SIZE) -> NDArray[float]:
+    """Computes profile_distance_uncorrected between the profiles of pairs of single sequences,
+    given the character codes of the sequences (see _encode_aligned_sequence).
+
+    Rather than building one-hot profiles and multiplying them through the dissimilarity
+    matrix, the dissimilarity of each column is looked up in constants.CODE_PAIR_UNSIMILARITY
+    and summed over the jointly non-gapped columns. The pairs are processed block_size at a
+    time, and the codes of each block are gathered from codes only when it is processed, which
+    bounds the temporary arrays to block_size x profile_length entries.
+
+    Args:
+
+        codes (NDArray[np.uint8]): The codes of the sequences (N x L).
+
+        ids1 (List[int]): The row of codes of the first sequence of each pair (K).
+
+        ids2 (List[int]): The row of codes of the second sequence of each pair (K).
+
+        column_weights (Optional[NDArray[float]]): The multiplicity of each column.
+
+        block_size (int): The number of pairs processed at once.
+
+    Returns:
+        NDArray[float]: The uncorrected distance of each pair, 0 for pairs with no jointly
+            non-gapped column.
+    """
+    pair_table = constants.CODE_PAIR_UNSIMILARITY.ravel()
+    distances = np.empty(len(ids1))
+    for start in range(0, len(ids1), block_size):
+        block1 = codes[ids1[start:start+block_size]]
+        block2 = codes[ids2[start:start+block_size]]
+        weights = ~constants.CODE_IS_GAP[block1] & ~constants.CODE_IS_GAP[block2]
+        weights = weights.astype(float)
+        if column_weights is not None:
+            weights *= column_weights
+        dissimilarities = pair_table[(block1.astype(np.intp) << 8) | block2]
+        total_weights = weights.sum(axis=1)
+        distances[start:start+block_size] = np.divide(
+            (dissimilarities * weights).sum(axis=1), total_weights,
+            out=np.zeros(len(block1)), where=total_weights > 0)
+    return distances
+
+
+def profile_distance_corrected(p1: AnyProfile, p2: AnyProfile) -> float:
     """Computes the corrected distance between two profiles.
 
     Specifically, profile distance is calculated by
@@ -124,22 +416,159 @@ def profile_distance_corrected(p1: Profile, p2: Profile) -> float:
     corrected_dist = constants.CORRECTION(raw_dist)
     return corrected_dist
 
-def profile_weighted_join(p1: Profile, p2: Profile, w1: float, w2: float) -> Profile:
+def _sparse_profile_weighted_join(p1: SparseProfile,
+                                  p2: SparseProfile,
+                                  w1: float,
+                                  w2: float,
+                                  columns: NDArray[int]) -> SparseProfile:
+    """Computes profile_weighted_join of two sparse profiles over the union of their columns.
+    """
+    new_p_mat = np.zeros((constants.ALPHALEN, len(columns)), dtype=float)
+    new_p_mat[:, np.searchsorted(columns, p1.columns)] += \
+        p1.profile * (p1.ungapped * (p1.num_sequences * w1))
+    new_p_mat[:, np.searchsorted(columns, p2.columns)] += \
+        p2.profile * (p2.ungapped * (p2.num_sequences * w2))
+    counts = np.sum(new_p_mat, axis=0)
+
+    # Columns only supported by a zero-weighted profile end up gapped and are dropped.
+    keep = counts > 0
+    counts = counts[keep]
+    return SparseProfile(columns[keep],
+                         new_p_mat[:, keep] / counts,
+                         p1.profile_length,
+                         p1.num_sequences + p2.num_sequences,
+                         counts / (p1.num_sequences * w1 + p2.num_sequences * w2),
+                         p1.column_weights,
+                         p1.sparse_gap_fraction)
+
+def profile_weighted_join(p1: AnyProfile,
+                          p2: AnyProfile,
+                          w1: float,
+                          w2: float,
+                          out: Optional[Tuple[NDArray[float], NDArray[float]]] = None) -> AnyProfile:
     """
     Compute the profile formed by joining profiles p1 and p2 with weights w1 and w2.
+
+    If out is given as a (profile matrix, ungapped) pair of buffers, e.g. a slot acquired from a
+    ProfileArena, the joined profile is written into those buffers instead of newly allocated
+    arrays. The buffers must not alias the storage of p1 or p2.
+
+    If both profiles are sparse and the union of their columns still leaves more than
+    the sparse_gap_fraction of the profiles gapped, the result is a SparseProfile and out is
+    unused.
+    Otherwise any sparse profile is expanded and the result is a dense Profile.
     """
     if w1 == 0. and w2 == 0.:
         w1, w2 = 1., 1.
-    freq_mat_1 = p1.profile * p1.ungapped * p1.num_sequences
-    freq_mat_2 = p2.profile * p2.ungapped * p2.num_sequences
-    freq_mat_weighted = freq_mat_1 * w1 + freq_mat_2 * w2
-    counts = np.sum(freq_mat_weighted, axis=0)
-    new_p_mat = np.divide(freq_mat_weighted,
-                          counts,
-                          out=(0.25 * np.ones_like(freq_mat_weighted)),
-                          where=(counts != 0))
-    new_ungapped = counts / (p1.num_sequences * w1 + p2.num_sequences * w2)
+    if isinstance(p1, SparseProfile) and isinstance(p2, SparseProfile):
+        columns = np.union1d(p1.columns, p2.columns)
+        if len(columns) < (1. - p1.sparse_gap_fraction) * p1.profile_length:
+            return _sparse_profile_weighted_join(p1, p2, w1, w2, columns)
+    if isinstance(p1, SparseProfile):
+        p1 = p1.to_dense()
+    if isinstance(p2, SparseProfile):
+        p2 = p2.to_dense()
+    if out is None:
+        out = (np.empty_like(p1.profile), np.empty_like(p1.ungapped))
+    new_p_mat, new_ungapped = out
+
+    np.multiply(p1.profile, p1.ungapped * (p1.num_sequences * w1), out=new_p_mat)
+    new_p_mat += p2.profile * (p2.ungapped * (p2.num_sequences * w2))
+    counts = np.sum(new_p_mat, axis=0, out=new_ungapped)
+    empty_cols = counts == 0
+    np.divide(new_p_mat, counts, out=new_p_mat, where=~empty_cols)
+    new_p_mat[:, empty_cols] = 0.25
+    new_ungapped /= (p1.num_sequences * w1 + p2.num_sequences * w2)
 
     return Profile(new_p_mat,
                    p1.num_sequences + p2.num_sequences,
-                   new_ungapped)
+                   new_ungapped,
+                   p1.column_weights)
+
+
+class ProfileArena:
+    """A pool of preallocated profile buffers that are handed out and recycled by slot index.
+
+    Joined profiles are written into slots acquired from the arena, and a slot is released as
+    soon as the profile stored in it is no longer needed, so that the memory held by profiles is
+    bounded by the number of profiles alive at the same time rather than by the number of joins.
+
+    Attributes:
+
+        _profile_length (int): The length of every profile stored in the arena.
+
+        _matrices (List[NDArray[float]]): The profile matrix buffer of each slot.
+
+        _ungapped (List[NDArray[float]]): The ungapped buffer of each slot.
+
+        _free_slots (List[int]): Slots that are not currently in use.
+
+        _peak_used (int): The largest number of slots in use at the same time so far. Slots are
+            reused last-released first, so this is also the number of slots ever written to.
+
+    Args:
+
+        profile_length (int): The length of the profiles stored in the arena.
+
+        capacity (int): The number of slots to preallocate. The arena grows by one slot at a
+            time if more are requested.
+    """
+
+    def __init__(self, profile_length: int, capacity: int):
+        block = np.empty((capacity, constants.ALPHALEN, profile_length), dtype=float)
+        ungapped_block = np.empty((capacity, profile_length), dtype=float)
+        self._profile_length = profile_length
+        self._matrices = list(block)
+        self._ungapped = list(ungapped_block)
+        self._free_slots = list(range(capacity - 1, -1, -1))
+        self._peak_used = 0
+
+    def acquire(self) -> int:
+        """Returns the index of a free slot, growing the arena if none is available.
+        """
+        if not self._free_slots:
+            self._matrices.append(np.empty((constants.ALPHALEN, self._profile_length), dtype=float))
+            self._ungapped.append(np.empty(self._profile_length, dtype=float))
+            slot = len(self._matrices) - 1
+        else:
+            slot = self._free_slots.pop()
+        self._peak_used = max(self._peak_used, self.num_used)
+        return slot
+
+    def release(self, slot: int):
+        """Marks a slot as free so that a later acquire() can reuse its buffers.
+        """
+        self._free_slots.append(slot)
+
+    def buffers(self, slot: int) -> Tuple[NDArray[float], NDArray[float]]:
+        """Returns the (profile matrix, ungapped) buffers of a slot.
+        """
+        return self._matrices[slot], self._ungapped[slot]
+
+    @property
+    def profile_length(self) -> int: return self._profile_length
+
+    @property
+    def capacity(self) -> int: return len(self._matrices)
+
+    @property
+    def num_used(self) -> int: return len(self._matrices) - len(self._free_slots)
+
+    @property
+    def peak_used(self) -> int: return self._peak_used
+
+    @property
+    def nbytes(self) -> int:
+        """The number of bytes reserved by the buffers of every slot, used or not. The buffers
+        are allocated uninitialized, so the pages of slots never written to are not resident.
+        """
+        return sum(matrix.nbytes + ungapped.nbytes
+                   for matrix, ungapped in zip(self._matrices, self._ungapped))
+
+    @property
+    def touched_nbytes(self) -> int:
+        """The number of bytes of the slots written to so far (peak_used slots), which bounds the
+        resident memory of the arena.
+        """
+        slot_nbytes = (constants.ALPHALEN + 1) * self._profile_length * 8
+        return self._peak_used * slot_nbytes
@@ -1,49 +1,136 @@
 import argparse
+import numpy as np
 import random
 
+from numpy.typing import NDArray
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from alignment import save_encoded_alignment
+
+def read_fasta_records(fasta_file: BinaryIO) -> Iterator[Tuple[bytes, List[bytes]]]:
+    """Reads the records of a FASTA file one at a time, as the header line (without ">") and the
+    lines of the sequence. Sequences may span several lines.
+    """
+    header, lines = None, []
+    for line in fasta_file:
+        line = line.strip()
+        if line.startswith(b">"):
+            if header is not None:
+                yield header, lines
+            header, lines = line[1:], []
+        elif line:
+            lines.append(line)
+    if header is not None:
+        yield header, lines
+
+def reservoir_sample(fasta_file: BinaryIO,
+                     num_samples: Optional[int],
+                     num_columns: Optional[int],
+                     rng: random.Random) -> Tuple[List[bytes], List[NDArray[np.uint8]], int]:
+    """Samples records from a FASTA file in a single pass (reservoir sampling), keeping only the
+    sampled records in memory.
+
+    The sampled columns are drawn once the length of the first sequence is known, and are
+    selected from each sampled sequence as soon as it is read.
+
+    Args:
+
+        fasta_file (BinaryIO): The FASTA file, opened in binary mode.
+
+        num_samples (Optional[int]): The number of records to sample, or None for all.
+
+        num_columns (Optional[int]): The number of columns to sample, or None for all.
+
+        rng (random.Random): The random number generator.
+
+    Returns:
+        Tuple[List[bytes], List[NDArray[np.uint8]], int]: The headers and the sampled columns of
+            the sampled records, in file order, and the number of records in the file.
+
+    Raises:
+        ValueError: Raised if the file has fewer records or columns than requested, or if its
+            sequences do not all have the same length.
+    """
+    if num_samples is not None and num_samples <= 0:
+        raise ValueError("Must sample at least 1 sequence")
+    if num_columns is not None and num_columns <= 0:
+        raise ValueError("Must sample at least 1 column")
+
+    reservoir = []
+    seq_length, column_samples = None, None
+    num_sequences = 0
+    for i, (header, lines) in enumerate(read_fasta_records(fasta_file)):
+        num_sequences += 1
+        length = sum(len(line) for line in lines)
+        if seq_length is None:
+            seq_length = length
+            if num_columns is not None:
+                if num_columns > seq_length:
+                    raise ValueError(f"Cannot sample {num_columns} columns from sequences with "
+                                     f"length {seq_length}")
+                column_samples = np.array(sorted(rng.sample(range(seq_length), num_columns)))
+        elif length != seq_length:
+            raise ValueError("Sequences in alignment do not all have the same length.")
+
+        if num_samples is None or i < num_samples:
+            slot = len(reservoir)
+            reservoir.append(None)
+        else:
+            slot = rng.randrange(i + 1)
+            if slot >= num_samples:
+                continue
+
+        codes = np.frombuffer(b"".join(lines), dtype=np.uint8)
+        if column_samples is not None:
+            codes = codes[column_samples]
+        reservoir[slot] = (i, header, codes)
+
+    if num_samples is not None and num_samples > num_sequences:
+        raise ValueError(f"Cannot sample {num_samples} sequences from a file with "
+                         f"{num_sequences} sequences")
+    reservoir.sort(key=lambda record: record[0])
+    return ([header for _, header, _ in reservoir],
+            [codes for _, _, codes in reservoir],
+            num_sequences)
+
 def main():
     parser = argparse.ArgumentParser(
         description="Samples sequences from a FASTA file")
     parser.add_argument("-n",
-                        type=int, 
+                        type=int,
                         help="the number of sequences to sample "
                         "(default: sample all)")
     parser.add_argument("-c",
-                        type=int, 
+                        type=int,
                         help="the number of columns to sample "
                         "(default: sample all)")
+    parser.add_argument("--seed",
+                        type=int,
+                        help="seed of the random number generator")
+    parser.add_argument("--format",
+                        type=str,
+                        default="fasta",
+                        choices=["fasta", "npz"],
+                        help="write the samples as FASTA or as an encoded alignment that "
+                        "main.py reads directly (default: fasta)")
     parser.add_argument("input_file",
-                        type=argparse.FileType("r"),
+                        type=argparse.FileType("rb"),
                         help="the FASTA file to sample from")
     parser.add_argument("output_file",
-                        type=argparse.FileType("w"),
+                        type=str,
                         help="the file to output the samples to")
     args = parser.parse_args()
 
-    fasta_data = args.input_file.read().strip().split('\n')
-    num_sequences = len(fasta_data) // 2
-    seq_length = len(fasta_data[1])
-    if args.n is None:
-        args.n = num_sequences
-    if args.c is None:
-        args.c = seq_length
-    if args.n <= 0:
-        raise ValueError("Must sample at least 1 sequence")
-    if args.n > num_sequences:
-        raise ValueError(f"Cannot sample {args.n} sequences from a file with "
-                         f"{num_sequences} sequences")
-    if args.c <= 0:
-        raise ValueError("Must sample at least 1 column")
-    if args.c > seq_length:
-        raise ValueError(f"Cannot sample {args.c} columns from sequences with "
-                         f"length {seq_length}")
-    seq_samples = random.sample(range(num_sequences), args.n)
-    column_samples = sorted(random.sample(range(seq_length), args.c))
-    for i in seq_samples:
-        args.output_file.write(fasta_data[2*i] + '\n')
-        seq = fasta_data[2*i+1]
-        sampled_seq = ''.join(seq[j] for j in column_samples)
-        args.output_file.write(sampled_seq + '\n')
+    headers, sequences, _ = reservoir_sample(args.input_file, args.n, args.c,
+                                             random.Random(args.seed))
+    if args.format == "npz":
+        labels = [header.split(b" ", 1)[0].decode() for header in headers]
+        save_encoded_alignment(args.output_file, labels, np.stack(sequences))
+        return
+    with open(args.output_file, "wb") as output_file:
+        for header, codes in zip(headers, sequences):
+            output_file.write(b">" + header + b"\n")
+            output_file.write(codes.tobytes() + b"\n")
 
 if __name__ == "__main__":
     main()
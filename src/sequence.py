@@ -3,7 +3,7 @@ import numpy as np
 from typing import Union
 from numpy.typing import NDArray
 
-from constants import ALPHABET, CORRECTION
+import constants
 
 class Sequence:
     """Class representing a generic biological sequence.
@@ -29,7 +29,7 @@ class Sequence:
 
         if isinstance(sequence, str):
             try: 
-                sequence = np.array([ALPHABET.index(c) for c in sequence])
+                sequence = np.array([list(constants.ALPHABET).index(c) for c in sequence])
             except ValueError:
                 raise ValueError("Provided sequence contains invalid nucleotide characters.")
 
@@ -91,5 +91,5 @@ def sequence_distance_corrected(s1: Sequence, s2: Sequence) -> float:
     """
 
     raw_dist = sequence_distance_uncorrected(s1, s2)
-    corrected_dist = CORRECTION(raw_dist)
+    corrected_dist = constants.CORRECTION(raw_dist)
     return corrected_dist
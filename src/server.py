@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+
+import newick
+
+import constants
+from alignment import parse_fasta, read_alignment
+from main import add_build_arguments, build_args, build_tree
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+# Size of the pieces in which a finished Newick result is written back to the client.
+CHUNK_SIZE = 1 << 16
+
+def _init_worker():
+    """Warms up a worker process: loads the tables of every alphabet and silences the per-step
+    logging of the tree builders.
+    """
+    for name in constants.ALPHABET_MODULES:
+        constants.set_alphabet(name)
+    for name in ["tree_builder", "main", "bootstrap",
+                 "benchmarks.neighbor_joining", "benchmarks.random_joining"]:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+def run_job(request: Dict) -> str:
+    """Runs a single tree-building job and returns the tree in Newick format.
+
+    Args:
+
+        request (Dict): The job. The alignment is given either inline as "fasta" (the text of a
+            FASTA file) or as "input_file" (a path readable by the server, to a FASTA file or an
+            encoded .npz alignment). "algo" selects the algorithm (default: slowtree) and
+            "options" holds further build options by attribute name (see
+            main.add_build_arguments), e.g. {"compress_columns": true}.
+
+    Raises:
+        ValueError: Raised if the request is malformed.
+    """
+    if "fasta" in request:
+        alignment_dict = parse_fasta(request["fasta"])
+    elif "input_file" in request:
+        alignment_dict = read_alignment(request["input_file"])
+    else:
+        raise ValueError("Job must provide either 'fasta' or 'input_file'.")
+    args = build_args(algo=request.get("algo", "slowtree"), **request.get("options", dict()))
+    return newick.dumps(build_tree(alignment_dict, args))
+
+class TreeServer:
+    """Serves tree-building jobs from a pool of warm worker processes.
+
+    Jobs are accepted by an asyncio front end, either on a Unix socket or on a localhost TCP
+    port. On a Unix socket, a client sends its job as one line of JSON and receives a status
+    line ("OK" or "ERROR: <message>") followed by the Newick tree. On a TCP port, the job is the
+    JSON body of an HTTP POST request and the tree is the body of the response.
+
+    The tree only exists once its build has finished, so results are not streamed while the job
+    runs: the complete Newick string is sent after the job, in CHUNK_SIZE pieces, waiting for
+    the client to drain each piece so that a large tree is not buffered whole in the socket.
+
+    Args:
+
+        num_workers (Optional[int]): The number of worker processes. Defaults to the number of
+            CPUs.
+    """
+
+    def __init__(self, num_workers: Optional[int] = None):
+        # Workers must not be forked from the server itself: they would inherit the sockets of
+        # the connections open at that time and keep them from closing. A fork server started
+        # with the modules preloaded keeps worker startup cheap.
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context("forkserver")
+            mp_context.set_forkserver_preload(["server"])
+        else:
+            mp_context = multiprocessing.get_context("spawn")
+        self._executor = ProcessPoolExecutor(max_workers=num_workers,
+                                             mp_context=mp_context,
+                                             initializer=_init_worker)
+        self._num_jobs = 0
+
+    async def _run(self, request: Dict) -> str:
+        self._num_jobs += 1
+        job_id = self._num_jobs
+        logger.info(f"Starting job {job_id}")
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self._executor, run_job, request)
+        logger.info(f"Job {job_id} completed")
+        return result
+
+    async def _write_chunked(self, writer: asyncio.StreamWriter, data: bytes):
+        """Writes a finished result in CHUNK_SIZE pieces, draining the writer after each."""
+        for start in range(0, len(data), CHUNK_SIZE):
+            writer.write(data[start:start+CHUNK_SIZE])
+            await writer.drain()
+
+    async def _handle_socket(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = json.loads(await reader.readline())
+            result = await self._run(request)
+        except Exception as e:
+            logger.warning(f"Job failed: {e!r}")
+            writer.write(f"ERROR: {e}\n".encode())
+        else:
+            writer.write(b"OK\n")
+            await self._write_chunked(writer, result.encode())
+        await writer.drain()
+        writer.close()
+
+    async def _handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        status, body = "200 OK", b""
+        try:
+            request_line = (await reader.readline()).decode().split()
+            headers = dict()
+            while (line := (await reader.readline()).decode().strip()):
+                key, _, value = line.partition(":")
+                headers[key.strip().lower()] = value.strip()
+            if len(request_line) < 2 or request_line[0] != "POST":
+                status, body = "405 Method Not Allowed", b"Jobs must be submitted with POST.\n"
+            else:
+                content = await reader.readexactly(int(headers.get("content-length", 0)))
+                body = (await self._run(json.loads(content))).encode()
+        except Exception as e:
+            logger.warning(f"Job failed: {e!r}")
+            status, body = "400 Bad Request", f"{e}\n".encode()
+
+        writer.write(f"HTTP/1.1 {status}\r\n"
+                     f"Content-Type: text/plain\r\n"
+                     f"Content-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode())
+        await self._write_chunked(writer, body)
+        writer.close()
+
+    async def serve(self, socket_path: Optional[str] = None, port: Optional[int] = None):
+        """Serves jobs until cancelled, on socket_path if given and otherwise on localhost:port.
+        """
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self._handle_socket, path=socket_path)
+            logger.info(f"Serving on Unix socket {socket_path}")
+        else:
+            server = await asyncio.start_server(self._handle_http, host="127.0.0.1", port=port)
+            logger.info(f"Serving on http://127.0.0.1:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self._executor.shutdown()
+            if socket_path is not None and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+async def submit(socket_path: str, request: Dict) -> str:
+    """Submits a job to a server listening on a Unix socket and returns the Newick tree.
+
+    Raises:
+        RuntimeError: Raised if the server reports that the job failed.
+    """
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write(json.dumps(request).encode() + b"\n")
+    await writer.drain()
+    status = (await reader.readline()).decode().strip()
+    result = (await reader.read()).decode()
+    writer.close()
+    if status != "OK":
+        raise RuntimeError(status)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves tree-building jobs from warm workers")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="start a server")
+    endpoint = serve_parser.add_mutually_exclusive_group(required=True)
+    endpoint.add_argument("--socket",
+                          type=str,
+                          help="the Unix socket to listen on")
+    endpoint.add_argument("--port",
+                          type=int,
+                          help="the localhost port to serve HTTP on")
+    serve_parser.add_argument("--workers",
+                              type=int,
+                              help="the number of worker processes (default: number of CPUs)")
+
+    submit_parser = subparsers.add_parser("submit", help="submit a job to a Unix socket server")
+    submit_parser.add_argument("--socket",
+                               type=str,
+                               required=True,
+                               help="the Unix socket of the server")
+    submit_parser.add_argument("--inline",
+                               action="store_true",
+                               help="send the alignment itself instead of its path")
+    add_build_arguments(submit_parser)
+    submit_parser.add_argument("input_file",
+                               type=str,
+                               help="the aligned sequences in fasta format")
+    submit_parser.add_argument("output_file",
+                               type=argparse.FileType("w"),
+                               help="the file to output the tree to")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        try:
+            asyncio.run(TreeServer(args.workers).serve(args.socket, args.port))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    options = {name: value for name, value in vars(args).items()
+               if hasattr(build_args(), name) and name != "algo"}
+    request = dict(algo=args.algo, options=options)
+    if args.inline:
+        with open(args.input_file) as f:
+            request["fasta"] = f.read()
+    else:
+        request["input_file"] = os.path.abspath(args.input_file)
+    try:
+        args.output_file.write(asyncio.run(submit(args.socket, request)))
+    except RuntimeError as e:
+        sys.exit(str(e))
+
+if __name__ == "__main__":
+    main()
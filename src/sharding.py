@@ -0,0 +1,359 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os
+import socket
+import time
+
+from numpy.typing import NDArray
+from typing import Dict, List, Optional, Set, Tuple
+
+import constants
+from alignment import Alignment, parse_fasta
+from profile import profile_distance_uncorrected
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+# Default number of nodes per shard.
+SHARD_SIZE = 64
+
+# Seconds between two looks at the queue directory.
+POLL_INTERVAL = 0.1
+
+def _shard_path(queue_dir: str, subdir: str, name: str) -> str:
+    return os.path.join(queue_dir, subdir, name)
+
+def _worker_name(pid: int) -> str:
+    """Returns the name a worker process appends to the shards it claims."""
+    return f"{socket.gethostname()}-{pid}"
+
+def _top_candidates(nd_id: int,
+                    profiles: List,
+                    candidates: NDArray[int],
+                    size: int) -> Tuple[NDArray[int], NDArray[float]]:
+    """Returns the size candidates closest to leaf nd_id (excluding itself) with their
+    distances. Ties are broken by candidate order.
+    """
+    candidates = candidates[candidates != nd_id]
+    distances = np.array([profile_distance_uncorrected(profiles[nd_id], profiles[j])
+                          for j in candidates])
+    order = np.argsort(distances, kind="stable")[:size]
+    return candidates[order], distances[order]
+
+def _padded(rows: List[NDArray], width: int, fill, dtype) -> NDArray:
+    out = np.full((len(rows), width), fill, dtype=dtype)
+    for i, row in enumerate(rows):
+        out[i, :len(row)] = row
+    return out
+
+class _ShardWorker:
+    """Computes the shards of a queue directory.
+
+    Attributes:
+
+        _queue_dir (str): The queue directory.
+
+        _profiles (List[Union[Profile, SparseProfile]]): The leaf profiles, indexed by node ID.
+
+        _tophits_size (int): The size m of the top-hits lists.
+
+        _seed_tophits (Optional[Dict[int, NDArray[int]]]): The 2m closest leaves of each seed,
+            loaded from the results of the seeds shards when the first neighbors shard is run.
+    """
+
+    def __init__(self, queue_dir: str):
+        with open(os.path.join(queue_dir, "job.json")) as f:
+            job = json.load(f)
+        with open(os.path.join(queue_dir, "alignment.fasta")) as f:
+            alignment_dict = parse_fasta(f.read())
+        constants.set_alphabet(job["alphabet"])
+        alignment = Alignment(alignment_dict, **job["alignment_options"])
+        self._queue_dir = queue_dir
+        self._profiles = list(alignment.profile_dict.values())
+        self._tophits_size = job["tophits_size"]
+        self._seed_tophits = None
+
+    def _load_seed_tophits(self) -> Dict[int, NDArray[int]]:
+        if self._seed_tophits is None:
+            self._seed_tophits = dict()
+            results_dir = os.path.join(self._queue_dir, "results")
+            for name in sorted(os.listdir(results_dir)):
+                if name.startswith("seeds-"):
+                    with np.load(os.path.join(results_dir, name)) as result:
+                        for nd_id, tophits in zip(result["node_ids"], result["tophit_ids"]):
+                            self._seed_tophits[int(nd_id)] = tophits[tophits >= 0]
+        return self._seed_tophits
+
+    def run_shard(self, task: Dict) -> Dict[str, NDArray]:
+        """Computes a shard and returns its output arrays."""
+        all_ids = np.arange(len(self._profiles))
+        node_ids, tophit_rows, distance_rows = task["node_ids"], [], []
+        if task["kind"] == "seeds":
+            for nd_id in node_ids:
+                tophits, distances = _top_candidates(nd_id, self._profiles, all_ids,
+                                                     2 * self._tophits_size)
+                tophit_rows.append(tophits)
+                distance_rows.append(distances)
+            width = 2 * self._tophits_size
+        else:
+            seed_tophits = self._load_seed_tophits()
+            seed_ids = np.array(sorted(seed_tophits))
+            for nd_id, seed_id in zip(node_ids, task["seed_ids"]):
+                if seed_id < 0:
+                    seed_id = _top_candidates(nd_id, self._profiles, seed_ids, 1)[0][0]
+                candidates = np.concatenate([[seed_id], seed_tophits[seed_id]])
+                tophits, distances = _top_candidates(nd_id, self._profiles, candidates,
+                                                     self._tophits_size)
+                tophit_rows.append(tophits)
+                distance_rows.append(distances)
+            width = self._tophits_size
+        return dict(node_ids=np.array(node_ids, dtype=np.int32),
+                    tophit_ids=_padded(tophit_rows, width, -1, np.int32),
+                    distances=_padded(distance_rows, width, np.nan, np.float64))
+
+def run_worker(queue_dir: str, poll_interval: float = POLL_INTERVAL):
+    """Claims and computes shards from a queue directory until the coordinator marks the job
+    as done.
+    """
+    worker = None
+    tasks_dir = os.path.join(queue_dir, "tasks")
+    worker_name = _worker_name(os.getpid())
+    while not os.path.exists(os.path.join(queue_dir, "done")):
+        names = sorted(name for name in os.listdir(tasks_dir)
+                       if not name.startswith(".")) if os.path.isdir(tasks_dir) else []
+        for name in names:
+            shard = os.path.splitext(name)[0]
+            claimed_name = f"{shard}.{worker_name}.json"
+            try:
+                os.rename(_shard_path(queue_dir, "tasks", name),
+                          _shard_path(queue_dir, "claimed", claimed_name))
+            except FileNotFoundError:
+                # Claimed by another worker.
+                continue
+            if worker is None:
+                worker = _ShardWorker(queue_dir)
+            with open(_shard_path(queue_dir, "claimed", claimed_name)) as f:
+                output = worker.run_shard(json.load(f))
+            tmp_path = _shard_path(queue_dir, "results", f".{shard}.{os.getpid()}.npz")
+            np.savez(tmp_path, **output)
+            os.replace(tmp_path, _shard_path(queue_dir, "results", f"{shard}.npz"))
+            logger.info(f"Computed shard {shard}")
+            break
+        else:
+            time.sleep(poll_interval)
+
+def _requeue_claimed(queue_dir: str, worker_name: str) -> List[str]:
+    """Moves the shards claimed by a worker back to the tasks directory.
+
+    Returns:
+        List[str]: The requeued shards.
+    """
+    requeued = []
+    for name in os.listdir(os.path.join(queue_dir, "claimed")):
+        shard, _, owner = name[:-len(".json")].partition(".")
+        if owner != worker_name:
+            continue
+        if os.path.exists(_shard_path(queue_dir, "results", f"{shard}.npz")):
+            continue
+        os.replace(_shard_path(queue_dir, "claimed", name),
+                   _shard_path(queue_dir, "tasks", f"{shard}.json"))
+        requeued.append(shard)
+    return requeued
+
+def _run_round(queue_dir: str,
+               kind: str,
+               shards: List[Dict],
+               poll_interval: float,
+               workers: List[multiprocessing.Process],
+               dead_workers: Set[int],
+               timeout: Optional[float] = None) -> List[Dict[str, NDArray]]:
+    """Enqueues the shards of a round and returns their outputs once every shard is done.
+
+    The shards claimed by a local worker that exits before the job is done are requeued, and its
+    pid is added to dead_workers, which is shared by the rounds of a job. If
+    local workers were started and all of them have exited, or if the round takes longer than
+    timeout seconds (e.g. because a remote worker disappeared with a shard), a RuntimeError is
+    raised.
+    """
+    names = [f"{kind}-{k:05d}" for k in range(len(shards))]
+    for name, shard in zip(names, shards):
+        tmp_path = _shard_path(queue_dir, "tasks", f".{name}.json")
+        with open(tmp_path, "w") as f:
+            json.dump(dict(shard, kind=kind), f)
+        os.replace(tmp_path, _shard_path(queue_dir, "tasks", f"{name}.json"))
+    logger.info(f"Enqueued {len(shards)} {kind} shards")
+
+    pending = set(names)
+    start_time = time.perf_counter()
+    while pending:
+        for worker in workers:
+            if worker.pid in dead_workers or worker.is_alive():
+                continue
+            dead_workers.add(worker.pid)
+            requeued = _requeue_claimed(queue_dir, _worker_name(worker.pid))
+            logger.warning(f"Shard worker {worker.pid} exited with code {worker.exitcode}; "
+                           f"requeued {len(requeued)} shards")
+        pending = {name for name in pending
+                   if not os.path.exists(_shard_path(queue_dir, "results", f"{name}.npz"))}
+        if not pending:
+            break
+        if workers and len(dead_workers) == len(workers):
+            raise RuntimeError(f"Every local shard worker exited with {len(pending)} {kind} "
+                               f"shards left.")
+        if timeout is not None and time.perf_counter() - start_time > timeout:
+            raise RuntimeError(f"Timed out after {timeout} s with {len(pending)} {kind} shards "
+                               f"left.")
+        time.sleep(poll_interval)
+
+    outputs = []
+    for name in names:
+        with np.load(_shard_path(queue_dir, "results", f"{name}.npz")) as result:
+            outputs.append({key: result[key] for key in result.files})
+    return outputs
+
+def sharded_tophits(alignment: Alignment,
+                    alignment_options: Dict,
+                    queue_dir: str,
+                    tophits_size: int,
+                    shard_size: int = SHARD_SIZE,
+                    num_local_workers: Optional[int] = None,
+                    poll_interval: float = POLL_INTERVAL,
+                    enable_tophits_approx: bool = True,
+                    timeout: Optional[float] = None) -> List[List[Tuple[int, float]]]:
+    """Computes the initial top-hits lists of the leaves of an alignment in shards, which are
+    dispatched to workers through a queue directory (see run_worker).
+
+    Every m-th leaf is a seed whose distances to all leaves are computed (the seeds shards).
+    Every other leaf then computes its top hits from the 2m closest leaves of a seed (the
+    neighbors shards): the first seed whose top hits contain it, or else the closest seed. This
+    differs from TreeBuilder, where each leaf not yet covered becomes a seed in turn and its
+    neighbors take the seed's m top hits as they are: fixing the seeds in advance lets them be
+    computed in parallel, but the lists, and so the tree, can differ from a serial build. With
+    enable_tophits_approx off, every leaf is a seed and the lists are those of TreeBuilder.
+
+    The queue directory is shared by every worker (e.g. on a network file system) and holds:
+
+        job.json              the alphabet, alignment options and top-hits size of the job
+        alignment.fasta       the alignment
+        tasks/<shard>.json    shards waiting for a worker
+        claimed/<shard>.json  shards being computed; a worker claims a shard by renaming it
+        results/<shard>.npz   the output of each shard
+        done                  created once every shard has been merged
+
+    Claimed shards are named <shard>.<host>-<pid>.json after their worker. The shards of a
+    local worker that dies are requeued (see _run_round); a remote worker that dies is only
+    noticed through timeout.
+
+    Args:
+
+        alignment (Alignment): The alignment.
+
+        alignment_options (Dict): The keyword arguments the alignment was built with (other
+            than the sequences), so that workers can rebuild it.
+
+        queue_dir (str): The queue directory, which must be empty or not exist.
+
+        tophits_size (int): The size m of the top-hits lists.
+
+        shard_size (int): The number of nodes per shard.
+
+        num_local_workers (Optional[int]): The number of worker processes started on this
+            machine. Defaults to the number of CPUs; with 0, every shard is left to workers
+            started elsewhere.
+
+        poll_interval (float): Seconds between two looks at the queue directory.
+
+        enable_tophits_approx (bool): Whether neighbors take their top hits from the lists of
+            seeds, as described above, instead of every leaf being a seed.
+
+        timeout (Optional[float]): Seconds after which a round of shards that is not done
+            raises a RuntimeError. Defaults to no timeout.
+
+    Returns:
+        List[List[Tuple[int, float]]]: The top hits of each leaf (in the order of
+            alignment.profile_dict) with their distances, as taken by TreeBuilder's
+            initial_tophits.
+
+    Raises:
+        ValueError: Raised if the queue directory is not empty.
+
+        RuntimeError: Raised if every local worker exited, or on timeout, before the shards
+            were done.
+    """
+    if os.path.isdir(queue_dir) and os.listdir(queue_dir):
+        raise ValueError(f"Shard queue directory {queue_dir} is not empty.")
+    for subdir in ["tasks", "claimed", "results"]:
+        os.makedirs(os.path.join(queue_dir, subdir), exist_ok=True)
+    with open(os.path.join(queue_dir, "alignment.fasta"), "w") as f:
+        for label, seq in alignment.alignment.items():
+            f.write(f">{label}\n{seq}\n")
+    with open(os.path.join(queue_dir, "job.json"), "w") as f:
+        json.dump(dict(alphabet=constants.ALPHABET_NAME,
+                       alignment_options=alignment_options,
+                       tophits_size=tophits_size), f)
+
+    if num_local_workers is None:
+        num_local_workers = os.cpu_count()
+    workers = [multiprocessing.Process(target=run_worker, args=(queue_dir, poll_interval))
+               for _ in range(num_local_workers)]
+    for worker in workers:
+        worker.start()
+
+    dead_workers = set()
+    try:
+        num_sequences = alignment.unique_alignment_size
+        seed_step = max(tophits_size, 1) if enable_tophits_approx else 1
+        seed_ids = list(range(0, num_sequences, seed_step))
+        seed_outputs = _run_round(queue_dir, "seeds",
+                                  [dict(node_ids=seed_ids[start:start+shard_size])
+                                   for start in range(0, len(seed_ids), shard_size)],
+                                  poll_interval, workers, dead_workers, timeout)
+
+        tophits = [None] * num_sequences
+        covering_seed = [-1] * num_sequences
+        for output in seed_outputs:
+            for seed_id, tophit_ids, distances in zip(output["node_ids"], output["tophit_ids"],
+                                                      output["distances"]):
+                keep = tophit_ids[:tophits_size] >= 0
+                tophits[seed_id] = list(zip(tophit_ids[:tophits_size][keep].tolist(),
+                                            distances[:tophits_size][keep].tolist()))
+                for nd_id, _ in tophits[seed_id]:
+                    if covering_seed[nd_id] < 0:
+                        covering_seed[nd_id] = int(seed_id)
+
+        neighbor_ids = [nd_id for nd_id in range(num_sequences) if tophits[nd_id] is None]
+        neighbor_outputs = _run_round(
+            queue_dir, "neighbors",
+            [dict(node_ids=neighbor_ids[start:start+shard_size],
+                  seed_ids=[covering_seed[nd_id] for nd_id in neighbor_ids[start:start+shard_size]])
+             for start in range(0, len(neighbor_ids), shard_size)],
+            poll_interval, workers, dead_workers, timeout)
+        for output in neighbor_outputs:
+            for nd_id, tophit_ids, distances in zip(output["node_ids"], output["tophit_ids"],
+                                                    output["distances"]):
+                keep = tophit_ids >= 0
+                tophits[nd_id] = list(zip(tophit_ids[keep].tolist(), distances[keep].tolist()))
+    finally:
+        open(os.path.join(queue_dir, "done"), "w").close()
+        for worker in workers:
+            worker.join()
+    logger.info(f"Merged the top hits of {len(seed_ids)} seeds and {len(neighbor_ids)} neighbors")
+    return tophits
+
+def main():
+    parser = argparse.ArgumentParser(description="Computes top-hits shards from a queue directory")
+    parser.add_argument("--poll-interval",
+                        type=float,
+                        default=POLL_INTERVAL,
+                        help=f"seconds between two looks at the queue (default: {POLL_INTERVAL})")
+    parser.add_argument("queue_dir",
+                        type=str,
+                        help="the queue directory shared with the coordinator")
+    args = parser.parse_args()
+    run_worker(args.queue_dir, args.poll_interval)
+
+if __name__ == "__main__":
+    main()
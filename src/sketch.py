@@ -0,0 +1,220 @@
+import argparse
+import logging
+import numpy as np
+
+from math import isqrt
+from numpy.typing import NDArray
+from typing import Dict, List, Optional
+
+import constants
+from alignment import Alignment, read_alignment
+from profile import _encode_aligned_sequence, profile_distance_uncorrected
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+# Multiplier of the rolling hash of k-mers, and of the position of a k-mer in its token.
+KMER_BASE = np.uint64(257)
+POSITION_BASE = np.uint64(0x9E3779B97F4A7C15)
+
+def _aligned_kmer_tokens(codes: NDArray[np.uint8], kmer_size: int) -> NDArray[np.uint64]:
+    """Returns a hash of every (column, k-mer) pair of an encoded aligned sequence whose k-mer
+    contains no gap. Two sequences share a token iff they agree on k consecutive ungapped
+    columns.
+    """
+    num_kmers = len(codes) - kmer_size + 1
+    if num_kmers <= 0:
+        return np.empty(0, dtype=np.uint64)
+    hashes = np.zeros(num_kmers, dtype=np.uint64)
+    ungapped = np.ones(num_kmers, dtype=bool)
+    is_gap = constants.CODE_IS_GAP[codes]
+    for j in range(kmer_size):
+        hashes = hashes * KMER_BASE + codes[j:j+num_kmers]
+        ungapped &= ~is_gap[j:j+num_kmers]
+    positions = np.arange(num_kmers, dtype=np.uint64)
+    return (hashes + positions * POSITION_BASE)[ungapped]
+
+class SketchIndex:
+    """A locality-sensitive hashing index over the sequences of an alignment, used to find the
+    candidate top hits of a sequence without comparing it to every other sequence.
+
+    Each sequence is sketched by MinHash over its aligned k-mers (k-mers tagged with their
+    column), whose Jaccard similarity grows with the identity of two aligned sequences. The
+    num_bands * band_size min-hashes of a sketch are cut into bands, and sequences that agree
+    on every min-hash of a band share a bucket. The candidates of a sequence are the sequences
+    it shares buckets with, ranked by the number of shared buckets.
+
+    Attributes:
+
+        _signatures (NDArray[np.uint64]): The min-hashes of each sequence (N x num_hashes).
+
+        _bucket_ids (NDArray[np.int64]): The bucket of each sequence in each band (N x
+            num_bands).
+
+        _buckets (List[List[int]]): The node IDs in each bucket.
+
+        _max_candidates (int): The largest number of candidates returned for a sequence.
+
+        _max_bucket_size (int): Buckets with more sequences than this (e.g. of a conserved
+            region) are ignored when retrieving candidates, so that retrieval stays cheap.
+
+    Args:
+
+        alignment (Alignment): The alignment. Node IDs follow the order of its profile_dict.
+
+        max_candidates (int): The largest number of candidates returned for a sequence.
+
+        max_bucket_size (Optional[int], optional): Buckets with more sequences than this are
+            ignored when retrieving candidates. Defaults to 8 * max_candidates.
+
+        kmer_size (int, optional): The length of the aligned k-mers. Defaults to 6.
+
+        num_bands (int, optional): The number of bands. Defaults to 32.
+
+        band_size (int, optional): The number of min-hashes per band. More min-hashes per band
+            make buckets more selective. Defaults to 1.
+
+        seed (Optional[int], optional): Seed of the hash functions.
+    """
+
+    def __init__(self,
+                 alignment: Alignment,
+                 max_candidates: int,
+                 max_bucket_size: Optional[int] = None,
+                 kmer_size: int = 6,
+                 num_bands: int = 32,
+                 band_size: int = 1,
+                 seed: Optional[int] = None):
+        rng = np.random.default_rng(seed)
+        num_hashes = num_bands * band_size
+        multipliers = rng.integers(1, 2**63, num_hashes, dtype=np.uint64) | np.uint64(1)
+        offsets = rng.integers(0, 2**63, num_hashes, dtype=np.uint64)
+
+        labels = list(alignment.profile_dict)
+        signatures = np.full((len(labels), num_hashes), np.iinfo(np.uint64).max, dtype=np.uint64)
+        for i, label in enumerate(labels):
+            tokens = _aligned_kmer_tokens(_encode_aligned_sequence(alignment.alignment[label]),
+                                          kmer_size)
+            if len(tokens) > 0:
+                signatures[i] = (tokens[None, :] * multipliers[:, None]
+                                 + offsets[:, None]).min(axis=1)
+
+        bucket_ids = np.empty((len(labels), num_bands), dtype=np.int64)
+        bucket_index = dict()
+        self._buckets = []
+        for band in range(num_bands):
+            band_signatures = signatures[:, band*band_size:(band+1)*band_size]
+            for i, band_signature in enumerate(band_signatures):
+                key = (band, band_signature.tobytes())
+                if key not in bucket_index:
+                    bucket_index[key] = len(self._buckets)
+                    self._buckets.append([])
+                bucket_ids[i, band] = bucket_index[key]
+                self._buckets[bucket_ids[i, band]].append(i)
+
+        self._signatures = signatures
+        self._bucket_ids = bucket_ids
+        self._max_candidates = max_candidates
+        self._max_bucket_size = (max_bucket_size if max_bucket_size is not None
+                                 else 8 * max_candidates)
+
+    @property
+    def num_buckets(self) -> int: return len(self._buckets)
+
+    def candidates(self, nd_id: int) -> List[int]:
+        """Returns up to max_candidates node IDs (other than nd_id) that share the most buckets
+        with nd_id, ties broken by node ID.
+        """
+        shared = dict()
+        for bucket_id in self._bucket_ids[nd_id]:
+            if len(self._buckets[bucket_id]) > self._max_bucket_size:
+                continue
+            for nd_id2 in self._buckets[bucket_id]:
+                shared[nd_id2] = shared.get(nd_id2, 0) + 1
+        shared.pop(nd_id, None)
+        ranked = sorted(shared, key=lambda nd_id2: (-shared[nd_id2], nd_id2))
+        return ranked[:self._max_candidates]
+
+def tophits_recall(alignment: Alignment,
+                   index: SketchIndex,
+                   tophits_size: int,
+                   num_samples: int = 100,
+                   seed: Optional[int] = None) -> Dict[str, float]:
+    """Compares the top hits found among the candidates of a sketch index to the exact top hits
+    (found by comparing to every sequence), for a random sample of sequences.
+
+    Returns:
+        Dict[str, float]: The mean fraction of the exact top hits that are found ("recall"),
+            the mean number of candidates per sequence ("candidates"), and the fraction of
+            sampled sequences with fewer candidates than tophits_size ("short").
+    """
+    profiles = list(alignment.profile_dict.values())
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(profiles), min(num_samples, len(profiles)), replace=False)
+
+    def top(nd_id: int, candidates: List[int]) -> set:
+        candidates = [j for j in candidates if j != nd_id]
+        distances = [profile_distance_uncorrected(profiles[nd_id], profiles[j])
+                     for j in candidates]
+        return {candidates[k] for k in np.argsort(distances, kind="stable")[:tophits_size]}
+
+    recalls, num_candidates, num_short = [], [], 0
+    for nd_id in sample:
+        candidates = index.candidates(nd_id)
+        exact = top(nd_id, list(range(len(profiles))))
+        recalls.append(len(top(nd_id, candidates) & exact) / len(exact))
+        num_candidates.append(len(candidates))
+        num_short += len(candidates) < tophits_size
+    return dict(recall=float(np.mean(recalls)),
+                candidates=float(np.mean(num_candidates)),
+                short=num_short / len(sample))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reports the recall of sketch-based top-hit candidates")
+    parser.add_argument("--thresh-cp",
+                        type=int,
+                        default=2,
+                        help="the top-hit threshold multiplier (default: 2)")
+    parser.add_argument("--max-candidates",
+                        type=int,
+                        help="the largest number of candidates per sequence (default: 4 times "
+                        "the top-hits size)")
+    parser.add_argument("--kmer-size",
+                        type=int,
+                        default=6,
+                        help="the length of the aligned k-mers (default: 6)")
+    parser.add_argument("--bands",
+                        type=int,
+                        default=32,
+                        help="the number of LSH bands (default: 32)")
+    parser.add_argument("--band-size",
+                        type=int,
+                        default=1,
+                        help="the number of min-hashes per band (default: 1)")
+    parser.add_argument("--samples",
+                        type=int,
+                        default=100,
+                        help="the number of sequences whose top hits are checked (default: 100)")
+    parser.add_argument("--seed",
+                        type=int,
+                        help="seed of the hash functions and of the sample")
+    parser.add_argument("input_file",
+                        type=str,
+                        help="the aligned sequences in fasta format")
+    args = parser.parse_args()
+
+    alignment_dict = read_alignment(args.input_file)
+    constants.set_alphabet(constants.detect_alphabet(alignment_dict.values()))
+    alignment = Alignment(alignment_dict)
+    tophits_size = args.thresh_cp * isqrt(alignment.unique_alignment_size)
+    max_candidates = args.max_candidates or 4 * tophits_size
+    index = SketchIndex(alignment, max_candidates, kmer_size=args.kmer_size,
+                        num_bands=args.bands, band_size=args.band_size, seed=args.seed)
+    report = tophits_recall(alignment, index, tophits_size, args.samples, args.seed)
+    logger.info(f"{index.num_buckets} buckets; {report['candidates']:.1f} candidates per "
+                f"sequence ({report['short'] * 100:.1f}% with fewer than {tophits_size})")
+    logger.info(f"Top-hits recall: {report['recall']:.3f}")
+
+if __name__ == "__main__":
+    main()
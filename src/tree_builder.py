@@ -1,13 +1,21 @@
+import heapq
 import math
+import sys
+import time
 
-from constants import CORRECTION
-from node_info import NodeInfo, nodeinfo_distance, nodeinfo_join
-from sequence import Sequence
+from concurrent.futures import ThreadPoolExecutor
+
+import constants
+from node_info import (NodeInfo, joined_profile_weight, nodeinfo_distance, nodeinfo_distance_bounded,
+                       nodeinfo_join)
 from alignment import Alignment
-from utils import UnionFind
+from memory_report import MemoryReport
+from profile import ProfileArena, SparseProfile, code_pair_distances_uncorrected
+from sketch import SketchIndex
+from utils import UnionFind, expand_duplicates
 import newick
 
-from typing import List, Optional, Set, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 
 NodeID = int
 
@@ -20,28 +28,54 @@ class TreeBuilder:
 
     Attributes:
 
-        _num_sequences (int): The number of input sequences.
+        _num_sequences (int): The number of input sequences (after collapsing duplicates).
+
+        _duplicates (Dict[str, List[str]]): The labels of the duplicate sequences collapsed into
+            each leaf, which are re-attached when the tree is exported.
 
         _tophits_threshold (int): The threshold factor (approximately sqrt(num_sequences))that 
             limits candidate join nodes.
 
         _refresh_interval (int): The interval (in steps) at which top hits are recomputed.
 
-        _distance_cache (List[List[float]]): A triangular cache storing pairwise distances between
-            nodes. (Lower triangular, so _distance_cache[i][j] is defined iff i > j)
+        _distance_cache (Union[List[List[float]], Dict[Tuple[int, int], float]]): A cache storing
+            pairwise distances between nodes. With the "dense" layout, a lower triangular matrix
+            (so _distance_cache[i][j] is defined iff i > j, and -1 if not yet computed); with the
+            "sparse" layout, a dictionary holding only the computed distances, keyed by (i, j)
+            with i > j.
+
+        _estimated_distances (Dict[Tuple[int, int], float]): Distances from joined nodes that
+            were estimated from the distances of their children (see _estimate_distances), keyed
+            by (i, j) with i > j. They are kept apart from _distance_cache, so that they are
+            never used to estimate further distances, and are replaced by exact distances when
+            they would decide a join.
 
         _nodes (List[TreeBuilder.Node]): List containing all nodes (both initial and merged) in the
             tree.
 
+        _leaf_codes (Optional[NDArray[np.uint8]]): The character codes of the leaves (see
+            Alignment.leaf_codes), from which distances between leaves are computed in blocks.
+
+        _profile_arena (ProfileArena): Pool of profile buffers holding the profiles of the active
+            internal nodes. Slots are released as soon as their node is joined.
+
         _num_nodes (int): The total number of nodes (original sequences + merged nodes).
 
         _active_ids (Set[int]): Set of active node IDs that have not yet been merged.
 
-        _steps (int): Counter for the number of join steps executed.
+        _steps (int): Counter for the number of steps (scans of the active nodes) executed.
+
+        _num_joins (int): Counter for the number of joins performed, which exceeds _steps if
+            joins are batched.
 
         _union_find (UnionFind): Union-find data structure used to efficiently manage node
             groupings during merges.
-        
+
+        _executor (Optional[ThreadPoolExecutor]): Thread pool used to compute batches of uncached
+            distances, or None if distances are computed serially.
+
+        _memory_report (Optional[MemoryReport]): The report that memory snapshots are taken for.
+
     Args:
 
         alignment (Alignment): The alignment used to construct the tree.
@@ -51,8 +85,85 @@ class TreeBuilder:
 
         refresh_interval (Optional[int], optional): The interval for refreshing top-hit candidates.
             If not provided, no refreshes will be performed.
+
+        distance_cache_layout (str, optional): "dense" preallocates a triangular distance matrix
+            over all nodes, which needs O(N^2) memory; "sparse" stores only the distances that
+            are computed. Defaults to "dense".
+
+        arena_capacity (Optional[int], optional): The number of profile buffers preallocated by
+            the profile arena, which grows on demand past it. Defaults to N/2 + 1, the largest
+            number of internal profiles that can be alive at once.
+
+        up_distances (Optional[Dict[str, float]], optional): The up-distances of leaves that
+            stand for whole subtrees (e.g. in a divide-and-conquer build), keyed by label. Leaves
+            that are not listed have an up-distance of 0.
+
+        initial_tophits (Optional[List[List[Tuple[NodeID, float]]]], optional): Precomputed
+            top-hits lists of the leaves, as (node ID, distance) pairs, e.g. from
+            sharding.sharded_tophits. If given, the initial top-hits computation is skipped and
+            the distances are added to the distance cache.
+
+        sketch_index (Optional[SketchIndex], optional): If given, the initial top-hits list of a
+            node is computed from the candidates retrieved from this index rather than from all
+            nodes. Nodes with fewer candidates than _tophits_threshold fall back to all nodes.
+
+        adaptive_refresh (bool, optional): If set, top-hits lists are refreshed when they become
+            stale instead of every refresh_interval steps: a node's list is recomputed once the
+            nodes in it have been merged into fewer than refresh_fraction * _tophits_threshold
+            distinct active nodes, as in FastTree. Defaults to False.
+
+        refresh_fraction (float, optional): See adaptive_refresh. Defaults to 0.8.
+
+        batch_joins (bool, optional): If set, a step does not stop after joining the best pair:
+            it goes on joining the next candidate pairs that are disjoint and mutually best, as
+            long as they are the pairs a one-join-per-step build would join next (see
+            _join_next_candidates). This cuts the number of scans of the active nodes. With
+            adaptive_refresh, stale lists are only refreshed during scans, so the tree can differ
+            from an unbatched build. Defaults to False.
+
+        num_threads (Optional[int], optional): If greater than 1, the uncached distances needed to
+            compute a top-hits list (during refreshes and after each join) are computed on a pool
+            of this many threads. The distance kernels run in NumPy, which releases the GIL.
+
+        memory_report (Optional[MemoryReport], optional): If given, the builder registers its
+            data structures with the report (see memory_usage) and takes snapshots after the
+            initial top hits, MEMORY_SNAPSHOTS times during the joins and after export.
+
+        bounded_distances (bool, optional): If set, the uncached distances of a top-hits search
+            are computed with a bound, the distance of the worst of the best candidates found so
+            far, and abandoned as soon as their partial sum proves they exceed it (see
+            _compute_single_tophits_list). The lists are unchanged. Defaults to False.
+
+        estimate_join_distances (bool, optional): If set, the distances from a newly joined node
+            to the candidates of its top-hits list are estimated from the cached distances of
+            its two children (see _estimate_distances), and only the ESTIMATE_EXACT_HITS
+            closest candidates are computed exactly. The estimates are exact for alignments
+            without gaps. Defaults to False.
+
+        time_budget (Optional[float], optional): If given, the number of seconds (counted from
+            the construction of the builder) the build should fit in. The cost of the steps and
+            refreshes is measured as the joins proceed, and whenever the remaining joins are
+            projected to overrun the budget, the build is made cheaper one decision at a time
+            (see _adapt_to_time_budget).
     """
 
+    # Smallest number of uncached distances worth dispatching to the thread pool.
+    MIN_PARALLEL_BATCH = 32
+
+    # Number of memory snapshots taken during the joins when a memory report is given.
+    MEMORY_SNAPSHOTS = 10
+
+    # Number of closest candidates of a newly joined node whose estimated distances are replaced
+    # by exact ones when estimate_join_distances is set.
+    ESTIMATE_EXACT_HITS = 3
+
+    # Number of times during the joins that the projected runtime is checked against the time
+    # budget, if any.
+    BUDGET_CHECKPOINTS = 20
+
+    # Factor by which the top-hits list size is shrunk by each decision of the time budget.
+    BUDGET_TOPHITS_SHRINK = 0.7
+
     class Node:
         """Internal representation of a tree node in TreeBuilder.
 
@@ -78,6 +189,9 @@ class TreeBuilder:
 
             _rightchild_dist (Optional[int]): Distance to the right child after a node join.
 
+            profile_slot (Optional[int]): The slot of the profile arena holding the profile of
+                this node, if it is an internal node whose profile is still alive.
+
         Args:
 
             id (int): Unique identifier for the node.
@@ -97,6 +211,8 @@ class TreeBuilder:
 
             rightchild_dist (Optional[int], optional): Distance to the right child after a node join.
 
+            profile_slot (Optional[int], optional): The profile arena slot of the node's profile.
+
         """
 
         def __init__(self,
@@ -106,7 +222,8 @@ class TreeBuilder:
                      leftchild_id: Optional[int]=None,
                      leftchild_dist: Optional[int]=None,
                      rightchild_id: Optional[int]=None,
-                     rightchild_dist: Optional[int]=None):
+                     rightchild_dist: Optional[int]=None,
+                     profile_slot: Optional[int]=None):
             self._id = id
             self._node_info = node_info
 
@@ -117,6 +234,8 @@ class TreeBuilder:
             self._rightchild_id = rightchild_id
             self._rightchild_dist = rightchild_dist
 
+            self.profile_slot = profile_slot
+
         @property
         def id(self) -> int: return self._id
 
@@ -139,25 +258,86 @@ class TreeBuilder:
                  alignment: Alignment,
                  thresh_cp: int=2,
                  refresh_interval: Optional[int]=None,
-                 enable_tophits_approx=True):
+                 enable_tophits_approx=True,
+                 distance_cache_layout: str="dense",
+                 arena_capacity: Optional[int]=None,
+                 up_distances: Optional[Dict[str, float]]=None,
+                 initial_tophits: Optional[List[List[Tuple[NodeID, float]]]]=None,
+                 sketch_index: Optional[SketchIndex]=None,
+                 adaptive_refresh: bool=False,
+                 refresh_fraction: float=0.8,
+                 batch_joins: bool=False,
+                 num_threads: Optional[int]=None,
+                 memory_report: Optional[MemoryReport]=None,
+                 bounded_distances: bool=False,
+                 time_budget: Optional[float]=None,
+                 estimate_join_distances: bool=False):
         logger.info("Initializing tree builder")
-        self._num_sequences = alignment.alignment_size
+        self._start_time = time.perf_counter()
+        self._time_budget = time_budget
+        self._budget_decisions = []
+        self._window_scan_time = 0.
+        self._window_active_sum = 0
+        self._window_steps = 0
+        self._window_joins = 0
+        self._refresh_time = 0.
+        self._refresh_work = 0
+        self._num_sequences = alignment.unique_alignment_size
+        self._duplicates = alignment.duplicates
         self._tophits_threshold = thresh_cp*math.isqrt(self._num_sequences)
         self._refresh_interval = refresh_interval if refresh_interval else 2*self._num_sequences
+        self._adaptive_refresh = adaptive_refresh
+        self._batch_joins = batch_joins
+        self._refresh_fraction = refresh_fraction
+        self._min_tophits_size = refresh_fraction * self._tophits_threshold
+        self._num_scheduled_refreshes = 0
+        self._num_skipped_refreshes = 0
+        self._num_stale_refreshes = 0
         self._enable_tophits_approx = enable_tophits_approx
-
-        node_infos = [NodeInfo(profile, label=label) for label, profile in alignment.profile_dict.items()]
-        self._distance_cache = [
-            [-1 for j in range(i)] for i in range(self._num_sequences)
-        ]
+        self._bounded_distances = bounded_distances
+        self._estimate_join_distances = estimate_join_distances
+        self._estimated_distances = dict()
+        self._num_estimated_distances = 0
+        self._num_replaced_estimates = 0
+        self._num_exact_join_distances = 0
+        self._num_bounded_distances = 0
+        self._num_exceeded_bounds = 0
+        self._num_bounded_columns = 0
+        self._num_skipped_columns = 0
+        self._num_threads = num_threads if num_threads else 1
+        self._executor = (ThreadPoolExecutor(self._num_threads)
+                          if self._num_threads > 1 else None)
+
+        up_distances = up_distances if up_distances is not None else dict()
+        node_infos = [NodeInfo(profile, up_distances.get(label, 0.), label=label)
+                      for label, profile in alignment.profile_dict.items()]
+        if distance_cache_layout == "dense":
+            self._distance_cache = [
+                [-1 for j in range(i)] for i in range(self._num_sequences)
+            ]
+        elif distance_cache_layout == "sparse":
+            self._distance_cache = dict()
+        else:
+            raise ValueError(f"Unknown distance cache layout: {distance_cache_layout}")
+        self._distance_cache_layout = distance_cache_layout
+        self._num_distances = 0
+        self._leaf_codes = alignment.leaf_codes
+        self._column_weights = alignment.column_weights
         self._nodes = [
             TreeBuilder.Node(i, node_info) for i, node_info in enumerate(node_infos)
         ]
+        # At most N/2 internal nodes are active at once, plus one slot for the node being joined.
+        if arena_capacity is None:
+            arena_capacity = self._num_sequences // 2 + 1
+        self._profile_arena = ProfileArena(alignment.profile_length, arena_capacity)
 
         logger.info("Initializing top-hits lists")
         self._num_nodes = self._num_sequences
         self._active_ids = set(range(self._num_sequences))
-        self._recompute_tophits()
+        if initial_tophits is None:
+            self._recompute_tophits(sketch_index)
+        else:
+            self._load_tophits(initial_tophits)
 
         ### initialize variance
 
@@ -165,7 +345,7 @@ class TreeBuilder:
         for nd_id1 in self._active_ids:
             for nd_id2 in self._nodes[nd_id1].tophit_ids:
                 raw_dist = self._distance_util(nd_id1, nd_id2)
-                dist = CORRECTION(raw_dist)
+                dist = constants.CORRECTION(raw_dist)
                 variance = math.exp(8.*dist/3.) * raw_dist*(1.-raw_dist) / alignment._alignment_length
 
                 leafVarSum[nd_id1] += variance
@@ -173,12 +353,19 @@ class TreeBuilder:
                 leafVarSum[nd_id2] += variance
                 leafVarCnt[nd_id2]+= 1
         for nd_id in self._active_ids:
-            self._nodes[nd_id].node_info.set_variance(leafVarSum[nd_id] / leafVarCnt[nd_id])
+            if leafVarCnt[nd_id] > 0:
+                self._nodes[nd_id].node_info.set_variance(leafVarSum[nd_id] / leafVarCnt[nd_id])
 
         self._steps = 0
+        self._num_joins = 0
         self._union_find = UnionFind(2*self._num_sequences)
         logger.info("Initialization of tree builder completed")
 
+        self._memory_report = memory_report
+        if memory_report is not None:
+            memory_report.track("tree builder", self.memory_usage)
+            memory_report.snapshot("initial top hits")
+
     def _distance_util(self, nd_id1: NodeID, nd_id2: NodeID):
         """Computes distance between two nodes identified by their IDs. Uses a cached distance
         matrix to avoid redundant computations.
@@ -195,11 +382,95 @@ class TreeBuilder:
         if nd_id1 == nd_id2:
             return 0
         nd_id1, nd_id2 = max(nd_id1, nd_id2), min(nd_id1, nd_id2)
-        if self._distance_cache[nd_id1][nd_id2] == -1:
+        distance = self._cached_distance(nd_id1, nd_id2)
+        if distance is None:
             distance = nodeinfo_distance(self._nodes[nd_id1].node_info,
                                          self._nodes[nd_id2].node_info)
+            self._store_distance(nd_id1, nd_id2, distance)
+        return distance
+
+    def _cached_distance(self, nd_id1: NodeID, nd_id2: NodeID, exact: bool=False) -> Optional[float]:
+        """Returns the cached distance between nodes nd_id1 > nd_id2, or None if it has not been
+        computed yet. Estimated distances are returned as well, unless exact is set.
+        """
+        if self._distance_cache_layout == "dense":
+            distance = self._distance_cache[nd_id1][nd_id2]
+            distance = None if distance == -1 else distance
+        else:
+            distance = self._distance_cache.get((nd_id1, nd_id2))
+        if distance is None and not exact and self._estimated_distances:
+            distance = self._estimated_distances.get((nd_id1, nd_id2))
+        return distance
+
+    def _store_distance(self, nd_id1: NodeID, nd_id2: NodeID, distance: float):
+        """Caches the distance between nodes nd_id1 > nd_id2.
+        """
+        self._num_distances += 1
+        if self._distance_cache_layout == "dense":
             self._distance_cache[nd_id1][nd_id2] = distance
-        return self._distance_cache[nd_id1][nd_id2]
+        else:
+            self._distance_cache[(nd_id1, nd_id2)] = distance
+        if self._estimated_distances:
+            self._estimated_distances.pop((nd_id1, nd_id2), None)
+
+    def _replace_estimate(self, nd_id1: NodeID, nd_id2: NodeID) -> bool:
+        """Replaces the distance between two nodes by the exact one if it was estimated.
+
+        Returns:
+            bool: Whether the distance was estimated.
+        """
+        nd_id1, nd_id2 = max(nd_id1, nd_id2), min(nd_id1, nd_id2)
+        if (nd_id1, nd_id2) not in self._estimated_distances:
+            return False
+        self._store_distance(nd_id1, nd_id2,
+                             nodeinfo_distance(self._nodes[nd_id1].node_info,
+                                               self._nodes[nd_id2].node_info))
+        self._num_replaced_estimates += 1
+        return True
+
+    def _prefetch_distances(self, nd_id: NodeID, candidates: List[NodeID]):
+        """Fills the distance cache with the distances from nd_id to every candidate.
+
+        The missing distances between two leaves are computed in blocks from the character
+        codes of the leaves (see code_pair_distances_uncorrected). The other missing distances
+        are computed in parallel on the thread pool, if any; the workers only read node
+        profiles, and results are written to the cache by the calling thread.
+
+        Parameters:
+
+            nd_id (NodeID): Identifier of the node.
+
+            candidates (List[NodeID]): Identifiers of the nodes to compute distances to.
+        """
+        if self._leaf_codes is None and self._executor is None:
+            return
+        missing = [(max(nd_id, j), min(nd_id, j)) for j in candidates
+                   if j != nd_id and self._cached_distance(max(nd_id, j), min(nd_id, j)) is None]
+
+        if self._leaf_codes is not None and nd_id < self._num_sequences:
+            leaf_pairs = [(i, j) for i, j in missing if i < self._num_sequences]
+            if leaf_pairs:
+                ids1, ids2 = zip(*leaf_pairs)
+                distances = code_pair_distances_uncorrected(self._leaf_codes,
+                                                            list(ids1), list(ids2),
+                                                            self._column_weights)
+                for i, j, distance in zip(ids1, ids2, distances.tolist()):
+                    self._store_distance(i, j, distance - self._nodes[i].node_info.up_distance
+                                         - self._nodes[j].node_info.up_distance)
+                missing = [(i, j) for i, j in missing if i >= self._num_sequences]
+
+        if self._executor is None or len(missing) < TreeBuilder.MIN_PARALLEL_BATCH:
+            return
+
+        def compute_batch(pairs: List[Tuple[NodeID, NodeID]]) -> List[float]:
+            return [nodeinfo_distance(self._nodes[i].node_info, self._nodes[j].node_info)
+                    for i, j in pairs]
+
+        batch_size = -(-len(missing) // self._num_threads)
+        batches = [missing[k:k+batch_size] for k in range(0, len(missing), batch_size)]
+        for batch, distances in zip(batches, self._executor.map(compute_batch, batches)):
+            for (i, j), distance in zip(batch, distances):
+                self._store_distance(i, j, distance)
 
     def _node_join(self, nd_id1: NodeID, nd_id2: NodeID):
         """Joins two active nodes into a new parent node. The parent node is set to be active
@@ -220,10 +491,20 @@ class TreeBuilder:
         nd2 = self._nodes[nd_id2]
 
         id = self._num_nodes
-        self._distance_cache.append([-1] * self._num_nodes)
+        if self._distance_cache_layout == "dense":
+            self._distance_cache.append([-1] * self._num_nodes)
         self._num_nodes += 1
 
-        node_info, leftchild_dist, rightchild_dist = nodeinfo_join(nd1.node_info, nd2.node_info)
+        weight = joined_profile_weight(nd1.node_info, nd2.node_info)
+        profile_slot = self._profile_arena.acquire()
+        node_info, leftchild_dist, rightchild_dist = nodeinfo_join(
+            nd1.node_info, nd2.node_info, out=self._profile_arena.buffers(profile_slot))
+        self._release_profile(nd1)
+        self._release_profile(nd2)
+        if isinstance(node_info.profile, SparseProfile):
+            # Sparse joins allocate their own (smaller) storage instead of an arena slot.
+            self._profile_arena.release(profile_slot)
+            profile_slot = None
         self._union_find.union(id, nd_id1)
         self._union_find.union(id, nd_id2)
 
@@ -235,24 +516,178 @@ class TreeBuilder:
         potential_tophit_ids = list(set(potential_tophit_ids))
         self._nodes.append(TreeBuilder.Node(id, node_info, set(),
                                             nd_id1, leftchild_dist,
-                                            nd_id2, rightchild_dist))
+                                            nd_id2, rightchild_dist,
+                                            profile_slot))
+        if self._estimate_join_distances:
+            self._estimate_distances(id, nd_id1, nd_id2, weight, potential_tophit_ids)
         self._update_tophits_list(id, potential_tophit_ids)
 
         self._active_ids.add(id)
         self._active_ids.remove(nd_id1)
         self._active_ids.remove(nd_id2)
+        self._num_joins += 1
+
+    def _estimate_distances(self, nd_id: NodeID, nd_id1: NodeID, nd_id2: NodeID, weight: float,
+                            candidates: List[NodeID]):
+        """Estimates the distances from a newly joined node to the candidates of its top-hits
+        list from the exact cached distances of its children (see _estimated_distances).
+
+        The uncorrected distance is bilinear in the profiles, and the joined profile is the
+        mixture weight * P1 + (1 - weight) * P2 of the children's profiles (up to gaps), so
+
+            d(P, C) = weight * d(P1, C) + (1 - weight) * d(P2, C)
+
+        before the up-distances are subtracted. The ESTIMATE_EXACT_HITS candidates with the
+        smallest estimates, which may become the node's best hit, are computed exactly, as are
+        the candidates whose exact distance to either child is not cached. With gaps, the
+        estimates are approximate, so the resulting tree may differ from an exact build.
+
+        Parameters:
+
+            nd_id (NodeID): Identifier of the joined node.
+
+            nd_id1 (NodeID): Identifier of the child with weight weight.
+
+            nd_id2 (NodeID): Identifier of the child with weight 1 - weight.
+
+            weight (float): The weight of nd_id1 in the joined profile (see
+                node_info.joined_profile_weight).
+
+            candidates (List[NodeID]): Identifiers of the active nodes to estimate distances to.
+        """
+        up_distance1 = self._nodes[nd_id1].node_info.up_distance
+        up_distance2 = self._nodes[nd_id2].node_info.up_distance
+        offset = (weight * up_distance1 + (1. - weight) * up_distance2
+                  - self._nodes[nd_id].node_info.up_distance)
+        estimates, exact = [], []
+        for j in candidates:
+            distance1 = self._cached_distance(max(nd_id1, j), min(nd_id1, j), exact=True)
+            distance2 = self._cached_distance(max(nd_id2, j), min(nd_id2, j), exact=True)
+            if distance1 is None or distance2 is None:
+                exact.append(j)
+            else:
+                estimates.append((weight * distance1 + (1. - weight) * distance2 + offset, j))
+        estimates.sort()
+        exact += [j for _, j in estimates[:TreeBuilder.ESTIMATE_EXACT_HITS]]
+        self._prefetch_distances(nd_id, exact)
+        for j in exact:
+            self._distance_util(nd_id, j)
+        for distance, j in estimates[TreeBuilder.ESTIMATE_EXACT_HITS:]:
+            self._estimated_distances[(nd_id, j)] = distance
+        self._num_exact_join_distances += len(exact)
+        self._num_estimated_distances += len(estimates) - min(len(estimates),
+                                                              TreeBuilder.ESTIMATE_EXACT_HITS)
+
+    def _join_next_candidates(self, candidate_join_ids: List[Tuple[NodeID, NodeID]]):
+        """Joins the candidate pairs that follow the best pair of a step for as long as a
+        one-pair-per-step build would have joined them next: in order of distance, while both
+        nodes of a pair are still active and each other's best candidate, and no node created
+        in this step has a closer top hit. The batch also ends when the number of joins reaches
+        a multiple of the refresh interval, so that scheduled refreshes happen after the same
+        joins as in a one-pair-per-step build.
+
+        Parameters:
+
+            candidate_join_ids (List[Tuple[NodeID, NodeID]]): The best candidate of every
+                active node at the start of the step, sorted by distance. The first pair has
+                already been joined.
+        """
+        best_ids = dict(candidate_join_ids)
+        threshold = self._best_tophit_distance(self._num_nodes - 1)
+        for nd_id1, nd_id2 in candidate_join_ids[1:]:
+            if not self._adaptive_refresh and self._num_joins % self._refresh_interval == 0:
+                break
+            if nd_id1 not in self._active_ids or nd_id2 not in self._active_ids:
+                continue
+            self._replace_estimate(nd_id1, nd_id2)
+            if (best_ids.get(nd_id2) != nd_id1
+                    or self._distance_util(nd_id1, nd_id2) > threshold):
+                break
+            self._node_join(nd_id1, nd_id2)
+            threshold = min(threshold, self._best_tophit_distance(self._num_nodes - 1))
+
+    def _best_tophit_distance(self, nd_id: NodeID) -> float:
+        """Returns the distance from a node to the closest active node of its top-hits list.
+        """
+        tophit_ids = {self._union_find.find(nd_id2) for nd_id2 in self._nodes[nd_id].tophit_ids}
+        return min((self._distance_util(nd_id, nd_id2) for nd_id2 in tophit_ids - {nd_id}),
+                   default=float("inf"))
+
+    def _release_profile(self, nd: "TreeBuilder.Node"):
+        """Releases the profile of a node that has been joined, returning its arena slot (if any)
+        to the profile arena.
+        """
+        nd.node_info.release_profile()
+        if nd.profile_slot is not None:
+            self._profile_arena.release(nd.profile_slot)
+            nd.profile_slot = None
 
     def _compute_single_tophits_list(self, nd_id: NodeID, candidates: Optional[List[NodeID]]=None) -> List[int]:
         """Compute the top-hits list of a single node.
+
+        With bounded distances, the cached distances are ranked first, and each uncached
+        candidate is then evaluated against the distance of the current m-th best candidate: a
+        candidate proven farther than it cannot enter the list, so its distance is neither
+        finished nor cached. Only the candidates computed before m distances are known are
+        prefetched (see _prefetch_distances), since prefetching computes full distances.
         """
         logger.info(f"Computing top-hits list of node {nd_id}")
         if candidates is None:
             candidates = list(self._active_ids)
-        sorted_node_ids = sorted(candidates,
-                                 key=lambda j: self._distance_util(nd_id, j))
-        assert sorted_node_ids[0] == nd_id
-        tophits = sorted_node_ids[1:self._tophits_threshold+1]
-        return tophits
+        # The node itself is excluded explicitly rather than expected to sort first, since
+        # sequences with no jointly non-gapped columns are also at distance 0.
+        if not self._bounded_distances:
+            self._prefetch_distances(nd_id, candidates)
+            sorted_node_ids = sorted((j for j in candidates if j != nd_id),
+                                     key=lambda j: self._distance_util(nd_id, j))
+            return sorted_node_ids[:self._tophits_threshold]
+
+        # Candidates are ranked by (distance, position), as by the stable sort above. The heap
+        # holds the m best so far, worst on top.
+        ranked, uncached = [], []
+        for k, j in enumerate(candidates):
+            if j == nd_id:
+                continue
+            distance = self._cached_distance(max(nd_id, j), min(nd_id, j))
+            if distance is None:
+                uncached.append((k, j))
+            else:
+                ranked.append((distance, k, j))
+        self._prefetch_distances(nd_id, [j for _, j in
+                                         uncached[:max(self._tophits_threshold - len(ranked), 0)]])
+        best = [(-distance, -k) for distance, k, _ in
+                heapq.nsmallest(self._tophits_threshold, ranked)]
+        heapq.heapify(best)
+        for k, j in uncached:
+            if len(best) < self._tophits_threshold:
+                distance = self._distance_util(nd_id, j)
+            else:
+                distance = self._bounded_distance(nd_id, j, -best[0][0])
+                if distance is None:
+                    continue
+            ranked.append((distance, k, j))
+            if len(best) < self._tophits_threshold:
+                heapq.heappush(best, (-distance, -k))
+            elif (distance, k) < (-best[0][0], -best[0][1]):
+                heapq.heapreplace(best, (-distance, -k))
+        return [j for _, _, j in heapq.nsmallest(self._tophits_threshold, ranked)]
+
+    def _bounded_distance(self, nd_id1: NodeID, nd_id2: NodeID, bound: float) -> Optional[float]:
+        """Computes and caches the distance between two nodes, unless it is proven to exceed
+        bound, in which case None is returned and nothing is cached.
+        """
+        nd_id1, nd_id2 = max(nd_id1, nd_id2), min(nd_id1, nd_id2)
+        distance, num_columns = nodeinfo_distance_bounded(self._nodes[nd_id1].node_info,
+                                                          self._nodes[nd_id2].node_info,
+                                                          bound)
+        self._num_bounded_distances += 1
+        self._num_bounded_columns += num_columns
+        if distance is None:
+            self._num_exceeded_bounds += 1
+            self._num_skipped_columns += self._profile_arena.profile_length - num_columns
+            return None
+        self._store_distance(nd_id1, nd_id2, distance)
+        return distance
 
     def _update_tophits_list(self, nd_id: NodeID, candidates: Optional[List[NodeID]]=None):
         """Sets the top-hits list of node nd_id to be the value returned by
@@ -260,17 +695,26 @@ class TreeBuilder:
         """
         self._nodes[nd_id].tophit_ids = set(self._compute_single_tophits_list(nd_id, candidates))
 
-    def _recompute_tophits(self):
-        """Recomputes the top-hit candidate set for every active node.
+    def _recompute_tophits(self, sketch_index: Optional[SketchIndex]=None):
+        """Recomputes the top-hit candidate set for every active node, from the candidates
+        retrieved from sketch_index (for leaves) if given.
         """
 
+        def candidates(nd_id: NodeID) -> Optional[List[NodeID]]:
+            if sketch_index is None or nd_id >= self._num_sequences:
+                return None
+            sketch_candidates = [j for j in sketch_index.candidates(nd_id) if j in self._active_ids]
+            if len(sketch_candidates) < self._tophits_threshold:
+                return None
+            return sketch_candidates
+
         if self._enable_tophits_approx:
             computed = set()
             for nd_id1 in self._active_ids:
                 if nd_id1 in computed:
                     continue
                 computed.add(nd_id1)
-                tophits = self._compute_single_tophits_list(nd_id1)
+                tophits = self._compute_single_tophits_list(nd_id1, candidates(nd_id1))
                 self._nodes[nd_id1].tophit_ids = set(tophits)
                 for nd_id2 in tophits:
                     if nd_id2 not in computed:
@@ -281,15 +725,26 @@ class TreeBuilder:
                         computed.add(nd_id2)
         else:
             for nd_id in self._active_ids:
-                self._update_tophits_list(nd_id)
+                self._update_tophits_list(nd_id, candidates(nd_id))
     
+    def _load_tophits(self, tophits: List[List[Tuple[NodeID, float]]]):
+        """Sets the top-hits lists of the leaves to precomputed lists and caches their distances.
+        """
+        if len(tophits) != self._num_sequences:
+            raise ValueError("Precomputed top hits must have one list per sequence.")
+        for nd_id1, tophits_list in enumerate(tophits):
+            self._nodes[nd_id1].tophit_ids = {nd_id2 for nd_id2, _ in tophits_list}
+            for nd_id2, distance in tophits_list:
+                self._store_distance(max(nd_id1, nd_id2), min(nd_id1, nd_id2), distance)
+
     def step(self):
         """Executes a single step of the tree-building process.
 
         In each step the algorithm:
           - Evaluates candidate joining pairs based on the current top-hit sets.
           - Determines the best pair to join (the pair with the smallest distance).
-          - Merges the chosen pair into a new node.
+          - Merges the chosen pair (and, with batch joins, every other mutually best pair) into
+            new nodes.
           - Periodically refreshes the top-hit candidate sets based on the refresh interval.
 
         Side Effects:
@@ -304,6 +759,8 @@ class TreeBuilder:
             best_distance = float("inf")
             if len(self._nodes[nd_id1].tophit_ids) == 0:
                 self._update_tophits_list(nd_id1)
+            if self._adaptive_refresh:
+                self._refresh_if_stale(nd_id1)
             for nd_id2_temp in self._nodes[nd_id1].tophit_ids:
                 nd_id2 = self._union_find.find(nd_id2_temp)
                 distance = self._distance_util(nd_id1, nd_id2)
@@ -312,21 +769,191 @@ class TreeBuilder:
                     best_distance = distance
             candidate_join_ids.append((nd_id1, best_nd_id))
         
-        # potential postprocessing step with candidate_join_ids
-
-        best_join_ids = min(candidate_join_ids,
-                            key=lambda nd_ids: self._distance_util(nd_ids[0], nd_ids[1]))
-        nd_id0, nd_id1 = best_join_ids
-        self._node_join(nd_id0, nd_id1)
+        candidate_join_ids.sort(key=lambda nd_ids: self._distance_util(nd_ids[0], nd_ids[1]))
+        # An estimated distance is not trusted to decide a join.
+        while self._replace_estimate(*candidate_join_ids[0]):
+            candidate_join_ids.sort(key=lambda nd_ids: self._distance_util(nd_ids[0], nd_ids[1]))
+        num_joins = self._num_joins
+        self._node_join(*candidate_join_ids[0])
+        if self._batch_joins:
+            self._join_next_candidates(candidate_join_ids)
+
+        if self._num_joins // self._refresh_interval > num_joins // self._refresh_interval:
+            if self._adaptive_refresh:
+                self._num_skipped_refreshes += 1
+            else:
+                self._num_scheduled_refreshes += 1
+                refresh_start = time.perf_counter()
+                self._recompute_tophits()
+                self._refresh_time += time.perf_counter() - refresh_start
+                self._refresh_work += len(self._active_ids) ** 2
+
+    def _refresh_if_stale(self, nd_id: NodeID):
+        """Resolves the top-hits list of a node to the active nodes its entries have been merged
+        into, and recomputes the list if fewer than refresh_fraction * _tophits_threshold
+        distinct nodes remain. With the top-hits approximation, the nodes of the new list are
+        refreshed from it as well.
+        """
+        nd = self._nodes[nd_id]
+        tophit_ids = {self._union_find.find(nd_id2) for nd_id2 in nd.tophit_ids} - {nd_id}
+        if len(tophit_ids) < self._min_tophits_size and len(self._active_ids) > len(tophit_ids) + 1:
+            tophits = self._compute_single_tophits_list(nd_id)
+            nd.tophit_ids = set(tophits)
+            self._num_stale_refreshes += 1
+            if self._enable_tophits_approx:
+                # As in _recompute_tophits, the node's new top hits share its list.
+                for nd_id2 in tophits:
+                    self._nodes[nd_id2].tophit_ids = (set(tophits) - {nd_id2}) | {nd_id}
+        else:
+            nd.tophit_ids = tophit_ids
 
-        if self._steps % self._refresh_interval == 0:
-            self._recompute_tophits()
+    @property
+    def refresh_counts(self) -> Dict[str, int]:
+        """The number of refreshes of all top-hits lists done every refresh_interval steps
+        ("scheduled"), the number of those skipped with adaptive refreshes ("avoided"), and the
+        number of single top-hits lists recomputed because they went stale ("stale").
+        """
+        return dict(scheduled=self._num_scheduled_refreshes,
+                    avoided=self._num_skipped_refreshes,
+                    stale=self._num_stale_refreshes)
+
+    def _adapt_to_time_budget(self):
+        """Projects the runtime of the remaining joins from the cost measured since the last
+        checkpoint and, if it overruns the time left in the budget, makes the build cheaper by
+        the first applicable decision:
+
+          1. stop refreshing top-hits lists (scheduled or stale refreshes),
+          2. batch joins (see _join_next_candidates),
+          3. shrink the top-hits lists of the nodes created from now on by
+             BUDGET_TOPHITS_SHRINK, down to half of sqrt(N).
+
+        A step scans every active node, so the remaining steps are projected as the measured
+        time per active node and step times the sum of the active counts to come. A refresh
+        with n active nodes is projected to cost n^2 times the measured time per n^2.
+        """
+        elapsed = time.perf_counter() - self._start_time
+        time_left = self._time_budget - elapsed
+        n = len(self._active_ids)
+        steps_per_join = self._window_steps / max(self._window_joins, 1)
+        time_per_node = self._window_scan_time / max(self._window_active_sum, 1)
+        projected = time_per_node * steps_per_join * (n * (n + 1) / 2 - 1)
+        refreshing = self._adaptive_refresh or self._refresh_interval < n
+        if self._refresh_work > 0 and self._refresh_interval < n:
+            projected += (self._refresh_time / self._refresh_work
+                          * sum(k * k for k in range(n - self._refresh_interval, 1,
+                                                     -self._refresh_interval)))
+        self._window_scan_time, self._window_active_sum = 0., 0
+        self._window_steps, self._window_joins = 0, 0
+        logger.info(f"Time budget: {elapsed:.3f} s elapsed, {projected:.3f} s projected for "
+                    f"the remaining {n - 1} joins, {time_left:.3f} s left")
+        if projected <= time_left:
+            return
+
+        min_tophits_size = max(math.isqrt(self._num_sequences) // 2, 1)
+        if refreshing:
+            self._refresh_interval = 2 * self._num_sequences
+            self._adaptive_refresh = False
+            decision = "stopped refreshing top-hits lists"
+        elif not self._batch_joins:
+            self._batch_joins = True
+            decision = "started batching joins"
+        elif self._tophits_threshold > min_tophits_size:
+            self._tophits_threshold = max(
+                int(self._tophits_threshold * TreeBuilder.BUDGET_TOPHITS_SHRINK), min_tophits_size)
+            self._min_tophits_size = self._refresh_fraction * self._tophits_threshold
+            decision = f"shrank top-hits lists to {self._tophits_threshold}"
+        else:
+            logger.warning(f"Time budget: projected to overrun by {projected - time_left:.3f} s "
+                           f"with no cheaper setting left")
+            return
+        decision = f"after {self._num_joins} joins, {decision}"
+        self._budget_decisions.append(decision)
+        logger.info(f"Time budget: {decision}")
+
+    @property
+    def budget_decisions(self) -> List[str]:
+        """The decisions made to fit the time budget, in order."""
+        return self._budget_decisions
+
+    @property
+    def join_distance_counts(self) -> Dict[str, int]:
+        """The number of distances from newly joined nodes that were estimated from their
+        children ("estimated") and computed exactly ("exact") with estimate_join_distances, and
+        the number of estimates replaced by exact distances to decide a join ("replaced").
+        """
+        return dict(estimated=self._num_estimated_distances,
+                    exact=self._num_exact_join_distances,
+                    replaced=self._num_replaced_estimates)
+
+    @property
+    def bounded_distance_counts(self) -> Dict[str, int]:
+        """The number of distances computed with a bound ("computed"), the number of those
+        abandoned because they exceeded it ("exceeded"), and the number of profile columns whose
+        dissimilarities were computed ("columns") or skipped ("skipped_columns") by them.
+        """
+        return dict(computed=self._num_bounded_distances,
+                    exceeded=self._num_exceeded_bounds,
+                    columns=self._num_bounded_columns,
+                    skipped_columns=self._num_skipped_columns)
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Returns the number of bytes held by each data structure of the builder (see
+        memory_report.MemoryReport), using the names of the estimates of planner.plan_build.
+
+        Container sizes are measured with sys.getsizeof; the float objects of the distance
+        cache are counted from the number of distances stored. The leaf profiles are counted by
+        Alignment.memory_usage instead. The profile arena is counted by the slots written to so
+        far rather than by its reserved capacity (see ProfileArena.touched_nbytes).
+        """
+        float_bytes = sys.getsizeof(0.5)
+        if self._distance_cache_layout == "dense":
+            cache_bytes = (sys.getsizeof(self._distance_cache)
+                           + sum(sys.getsizeof(row) for row in self._distance_cache))
+        else:
+            cache_bytes = (sys.getsizeof(self._distance_cache)
+                           + len(self._distance_cache) * sys.getsizeof((0, 0)))
+        cache_bytes += self._num_distances * float_bytes
+        cache_bytes += (sys.getsizeof(self._estimated_distances)
+                        + len(self._estimated_distances) * (sys.getsizeof((0, 0)) + float_bytes))
+
+        # Leaf profiles are owned by the alignment, and arena slots by the arena.
+        internal_profile_bytes = 0
+        for nd in self._nodes[self._num_sequences:]:
+            profile = nd.node_info.profile
+            if profile is not None and nd.profile_slot is None:
+                internal_profile_bytes += (profile.profile.nbytes + profile.ungapped.nbytes
+                                           + profile.columns.nbytes)
+
+        node_bytes = sys.getsizeof(self._nodes) + sum(
+            sys.getsizeof(nd) + sys.getsizeof(vars(nd))
+            + sys.getsizeof(nd.node_info) + sys.getsizeof(vars(nd.node_info))
+            for nd in self._nodes)
+        return {
+            "distance cache": cache_bytes,
+            "profile arena": self._profile_arena.touched_nbytes,
+            "sparse internal profiles": internal_profile_bytes,
+            "top-hits lists": sum(sys.getsizeof(nd.tophit_ids) for nd in self._nodes),
+            "nodes": node_bytes,
+        }
+
+    @property
+    def num_distances(self) -> int:
+        """The number of distances computed (or loaded as initial top hits) so far."""
+        return self._num_distances
+
+    @property
+    def root_node_info(self) -> NodeInfo:
+        """The NodeInfo of the root of the built tree, whose profile summarizes the whole tree.
+        """
+        assert len(self._active_ids) == 1
+        return self._nodes[next(iter(self._active_ids))].node_info
 
     def export_tree(self) -> newick.Node:
         """Exports the constructed tree as a newick.Node with corrected branch distances.
 
         The tree is represented as an object of type newick.Node. The leaves are labeled with
         the labels of the original sequences, and the edges are weighted according to the distances.
+        Sequences collapsed as duplicates are re-attached as zero-length clades.
 
         Returns:
             newick.Node: A newick.Node representing the final phylogenetic tree.
@@ -344,12 +971,12 @@ class TreeBuilder:
                                    (nd.rightchild_id, nd.rightchild_dist)]:
                 if child_id is None:
                     continue
-                dist = CORRECTION(raw_dist)
+                dist = constants.CORRECTION(raw_dist)
                 dfs_help(child_id)
                 newick_nodes[child_id].length = dist
                 newick_nodes[nd_id].add_descendant(newick_nodes[child_id])
         dfs_help(last_remaining)
-        return newick_nodes[last_remaining]
+        return expand_duplicates(newick_nodes[last_remaining], self._duplicates)
 
 
     def build(self):
@@ -360,7 +987,57 @@ class TreeBuilder:
                 phylogenetic tree.
         """
 
-        for i in range(self._num_sequences - 1):
-            logger.info(f"Step {i+1} of {self._num_sequences-1}")
+        snapshot_interval = max((self._num_sequences - 1) // TreeBuilder.MEMORY_SNAPSHOTS, 1)
+        next_snapshot = snapshot_interval
+        checkpoint_interval = max((self._num_sequences - 1) // TreeBuilder.BUDGET_CHECKPOINTS, 1)
+        next_checkpoint = checkpoint_interval
+        joins_start = time.perf_counter()
+        while len(self._active_ids) > 1:
+            logger.info(f"Step {self._steps+1} ({self._num_joins} of {self._num_sequences-1} "
+                        f"joins done)")
+            num_active, num_joins = len(self._active_ids), self._num_joins
+            refresh_time, step_start = self._refresh_time, time.perf_counter()
             self.step()
-        return self.export_tree()
+            self._window_scan_time += (time.perf_counter() - step_start
+                                       - (self._refresh_time - refresh_time))
+            self._window_active_sum += num_active
+            self._window_steps += 1
+            self._window_joins += self._num_joins - num_joins
+            if (self._time_budget is not None and self._num_joins >= next_checkpoint
+                    and len(self._active_ids) > 1):
+                self._adapt_to_time_budget()
+                next_checkpoint += checkpoint_interval
+            if (self._memory_report is not None and self._num_joins >= next_snapshot
+                    and len(self._active_ids) > 1):
+                self._memory_report.snapshot(f"{self._num_joins} joins")
+                next_snapshot += snapshot_interval
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._batch_joins:
+            logger.info(f"Performed {self._num_joins} joins in {self._steps} steps "
+                        f"({self._num_joins - self._steps} steps saved)")
+        refresh_counts = self.refresh_counts
+        logger.info(f"Refreshed all top-hits lists {refresh_counts['scheduled']} times "
+                    f"({refresh_counts['avoided']} scheduled refreshes avoided) and "
+                    f"{refresh_counts['stale']} stale top-hits lists")
+        if self._bounded_distances:
+            counts = self.bounded_distance_counts
+            total_columns = counts["columns"] + counts["skipped_columns"]
+            logger.info(f"Abandoned {counts['exceeded']} of {counts['computed']} bounded "
+                        f"distances, skipping {counts['skipped_columns']} of {total_columns} "
+                        f"columns")
+        if self._estimate_join_distances:
+            counts = self.join_distance_counts
+            logger.info(f"Estimated {counts['estimated']} of "
+                        f"{counts['estimated'] + counts['exact']} distances of joined nodes "
+                        f"({counts['replaced']} replaced by exact distances to decide joins)")
+        if self._time_budget is not None:
+            elapsed = time.perf_counter() - self._start_time
+            joins_time = time.perf_counter() - joins_start
+            logger.info(f"Finished the joins after {elapsed:.3f} s of a {self._time_budget:.3f} s "
+                        f"budget ({self._num_joins / max(joins_time, 1e-9):.1f} joins/s); "
+                        f"decisions: {'; '.join(self._budget_decisions) or 'none'}")
+        tree = self.export_tree()
+        if self._memory_report is not None:
+            self._memory_report.snapshot("export")
+        return tree
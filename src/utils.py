@@ -1,5 +1,12 @@
 import numpy as np
 
+from typing import TYPE_CHECKING, Dict, List
+
+if TYPE_CHECKING:
+    # Imported where it is needed at runtime, so that loading an alphabet (which uses
+    # normalize) does not import newick.
+    import newick
+
 def normalize(A: np.typing.NDArray) -> np.typing.NDArray:
     s = np.sum(A)
     if s == 0:
@@ -20,3 +27,21 @@ class UnionFind:
         if x == y:
             return
         self._parent[y] = x
+
+
+def expand_duplicates(tree: "newick.Node", duplicates: Dict[str, List[str]]) -> "newick.Node":
+    """Re-attaches sequences that were collapsed as duplicates (see Alignment) to a tree built
+    over the distinct sequences. Each leaf with duplicates is replaced by a clade holding the
+    leaf and its duplicates, all at distance 0.
+    """
+    import newick
+
+    if not duplicates:
+        return tree
+    for leaf in tree.get_leaves():
+        if leaf.name not in duplicates:
+            continue
+        for label in [leaf.name] + duplicates[leaf.name]:
+            leaf.add_descendant(newick.Node(label, length=0.0))
+        leaf.name = None
+    return tree